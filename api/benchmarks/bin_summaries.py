@@ -0,0 +1,132 @@
+"""
+Benchmarks the ways of summarising the BINs associated with a taxon, using the taxa
+with the most associated BINs in the database:
+
+    - precomputed: reading the BinSummary rows, which is what the API does
+    - sql: aggregating the specimens in the database with a single GROUP BY query (see
+      ukbol.data.bins.get_bin_summaries_select)
+    - python: fetching the specimens' BIN, identification, and country and grouping
+      and counting them in Python
+
+The database configured through the UKBOL_ environment variables is used and must
+already have the BOLD and UKSI data loaded. Nothing is written to it.
+
+Usage (from the api directory):
+
+    python -m benchmarks.bin_summaries --taxa 5 --repeats 3
+"""
+
+import argparse
+import time
+from collections import Counter
+from itertools import groupby
+from typing import Callable
+
+from ukbol.app import create_app
+from ukbol.bins import get_containing_bins, iter_associated_specimen_rows
+from ukbol.data.bins import get_bin_summaries_select, in_bins
+from ukbol.extensions import db
+from ukbol.model import BinSummary, Specimen, Taxon, TaxonBin
+
+
+def summarise_precomputed(taxon: Taxon) -> list[tuple]:
+    """
+    Summarises the taxon's BINs by reading their precomputed BinSummary rows.
+    """
+    bin_uris = list(get_containing_bins(taxon))
+    select = db.select(BinSummary).filter(in_bins(BinSummary.bin_uri, bin_uris))
+    return [
+        (summary.bin_uri, summary.count, summary.uk_count, summary.names)
+        for summary in db.session.scalars(select)
+    ]
+
+
+def summarise_sql(taxon: Taxon) -> list[tuple]:
+    """
+    Summarises the taxon's BINs by aggregating their specimens in the database.
+    """
+    bin_uris = list(get_containing_bins(taxon))
+    return [
+        tuple(row) for row in db.session.execute(get_bin_summaries_select(bin_uris))
+    ]
+
+
+def summarise_python(taxon: Taxon) -> list[tuple]:
+    """
+    Summarises the taxon's BINs by fetching their specimens and counting them here.
+    """
+    columns = [Specimen.bin_uri, Specimen.identification, Specimen.country_iso]
+    summaries = []
+    rows = iter_associated_specimen_rows(taxon, columns)
+    for bin_uri, group in groupby(rows, key=lambda row: row.bin_uri):
+        names = Counter()
+        uk_count = 0
+        for row in group:
+            names[row.identification] += 1
+            uk_count += row.country_iso == "GB"
+        count = sum(names.values())
+        # match the database's ordering of the names
+        ordered = sorted(names.items(), key=lambda item: (-item[1], item[0]))
+        summaries.append((bin_uri, count, uk_count, [list(name) for name in ordered]))
+    return summaries
+
+
+def time_path(path: Callable, taxon: Taxon, repeats: int) -> tuple[float, list]:
+    """
+    Runs the given path the given number of times and returns the best time and the
+    summaries it produced, sorted by BIN URI.
+
+    :param path: the summarising function
+    :param taxon: the taxon to summarise the BINs of
+    :param repeats: the number of times to run the path
+    :return: the fastest time in seconds and the summaries
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        summaries = path(taxon)
+        best = min(best, time.perf_counter() - start)
+        db.session.expunge_all()
+    return best, sorted(summaries, key=lambda summary: summary[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--taxa", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    paths = {
+        "precomputed": summarise_precomputed,
+        "sql": summarise_sql,
+        "python": summarise_python,
+    }
+
+    app = create_app()
+    with app.app_context():
+        largest = db.session.scalars(
+            db.select(TaxonBin.taxon_id)
+            .group_by(TaxonBin.taxon_id)
+            .order_by(db.func.count().desc())
+            .limit(args.taxa)
+        ).all()
+        for taxon_id in largest:
+            taxon = Taxon.get(taxon_id)
+            specimens = db.session.scalar(
+                db.select(db.func.sum(BinSummary.count)).filter(
+                    in_bins(BinSummary.bin_uri, list(get_containing_bins(taxon)))
+                )
+            )
+            print(f"{taxon.name} ({taxon.id}): {specimens} specimens")
+
+            expected = None
+            for name, path in paths.items():
+                elapsed, summaries = time_path(path, taxon, args.repeats)
+                if expected is None:
+                    expected = summaries
+                match = "" if summaries == expected else " (MISMATCH)"
+                print(f"  {name}: {len(summaries)} BINs in {elapsed:.3f}s{match}")
+
+
+if __name__ == "__main__":
+    main()
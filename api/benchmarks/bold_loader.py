@@ -0,0 +1,90 @@
+"""
+Benchmarks loading a BOLD snapshot into the specimen staging tables using each of the
+loading paths: parsing the TSV in Python, parsing it in Python using worker processes,
+and streaming it straight into the database to be cleaned there. The snapshot is
+synthetic: a tar.gz containing a TSV with the given number of rows where each value is
+a random word, blank, or "None".
+
+The database configured through the UKBOL_ environment variables is used, only the
+staging tables are written to and they are dropped after each run.
+
+Usage (from the api directory):
+
+    python -m benchmarks.bold_loader --rows 1000000 --workers 4
+"""
+
+import argparse
+import io
+import random
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+from ukbol.app import create_app
+from ukbol.data.bold import COLUMN_MAPPING, get_tsv_columns, load_specimens
+from ukbol.data.utils import drop_staging_table
+from ukbol.model import Specimen, SpecimenDetail
+
+WORDS = ["Vespa", "crabro", "Apis", "mellifera", "Bombus", "GB", "BOLD:AAA0001"]
+
+
+def generate_snapshot(path: Path, rows: int, seed: int = 42):
+    """
+    Writes a synthetic BOLD snapshot to the given path.
+
+    :param path: the path to write the tar.gz snapshot to
+    :param rows: the number of rows to put in the TSV
+    :param seed: the random seed to use
+    """
+    rng = random.Random(seed)
+    reverse_mapping = {column: field for field, column in COLUMN_MAPPING.items()}
+    columns = get_tsv_columns()
+    values = [*WORDS, "", " ", "None"]
+
+    tsv = io.BytesIO()
+    header = [reverse_mapping.get(column, column) for column in columns]
+    tsv.write(("\t".join(header) + "\n").encode("utf-8"))
+    for _ in range(rows):
+        row = [rng.choice(values) for _ in columns]
+        tsv.write(("\t".join(row) + "\n").encode("utf-8"))
+
+    info = tarfile.TarInfo("BOLD_Public.synthetic/BOLD_Public.synthetic.tsv")
+    info.size = tsv.tell()
+    tsv.seek(0)
+    with tarfile.open(path, "w:gz") as tar:
+        tar.addfile(info, tsv)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    paths = {
+        "python": {},
+        f"python, {args.workers} workers": {"workers": args.workers},
+        "raw": {"raw": True},
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        snapshot = Path(temp_dir) / "snapshot.tar.gz"
+        generate_snapshot(snapshot, args.rows)
+        print(f"Generated {args.rows} rows ({snapshot.stat().st_size} bytes)")
+
+        app = create_app()
+        with app.app_context():
+            for name, options in paths.items():
+                try:
+                    start = time.perf_counter()
+                    count = load_specimens(snapshot, **options)
+                    elapsed = time.perf_counter() - start
+                finally:
+                    drop_staging_table(Specimen.__table__)
+                    drop_staging_table(SpecimenDetail.__table__)
+                print(f"{name}: loaded {count} rows in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
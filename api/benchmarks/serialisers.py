@@ -0,0 +1,80 @@
+"""
+Benchmarks building an associated specimens JSON response with the marshmallow
+SpecimenSchema and with the LeanSerialiser created from it, each encoded with the
+standard library JSON provider and with the orjson one (if orjson is installed). The
+specimens are synthetic: Specimen objects with every value filled in, they are never
+added to a database.
+
+Usage (from the api directory):
+
+    python -m benchmarks.serialisers --specimens 1000 --repeats 10
+"""
+
+import argparse
+import time
+
+from flask.json.provider import DefaultJSONProvider
+
+from ukbol.app import create_app
+from ukbol.model import Specimen, SpecimenDetail
+from ukbol.schema import SpecimenSchema
+from ukbol.serialisers import FastJSONProvider, LeanSerialiser, orjson
+
+
+def make_specimens(count: int) -> list[Specimen]:
+    """
+    Creates the given number of Specimen objects with all their values set.
+
+    :param count: the number of specimens to create
+    :return: a list of Specimen objects
+    """
+    detail_columns = [
+        column.name
+        for column in SpecimenDetail.__table__.columns
+        if column.name != "specimen_id"
+    ]
+    return [
+        Specimen(
+            id=i,
+            processid=f"TEST{i:06}",
+            bin_uri=f"BOLD:AAA{i % 100:04}",
+            identification="vespa crabro",
+            identification_rank="species",
+            country_iso="GB",
+            detail=SpecimenDetail(
+                **{column: f"{column} {i}" for column in detail_columns}
+            ),
+        )
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--specimens", type=int, default=1000)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    specimens = make_specimens(args.specimens)
+    schema = SpecimenSchema()
+    serialisers = {"marshmallow": schema, "lean": LeanSerialiser(schema)}
+
+    app = create_app()
+    providers = {"json": DefaultJSONProvider(app)}
+    if orjson is not None:
+        providers["orjson"] = FastJSONProvider(app)
+
+    with app.app_context():
+        for serialiser_name, serialiser in serialisers.items():
+            for provider_name, provider in providers.items():
+                start = time.perf_counter()
+                for _ in range(args.repeats):
+                    provider.response(
+                        {"specimens": serialiser.dump(specimens, many=True)}
+                    )
+                elapsed = (time.perf_counter() - start) / args.repeats
+                print(f"{serialiser_name} + {provider_name}: {elapsed * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
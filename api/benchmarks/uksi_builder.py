@@ -0,0 +1,99 @@
+"""
+Benchmarks building the taxonomy from NBN records, reporting the wall time and peak
+traced memory use. The records are synthetic: a tree of roughly the given number of
+taxa spread across the root kingdoms, plus some synonyms and some non-UKSI records.
+
+Usage (from the api directory):
+
+    python -m benchmarks.uksi_builder --taxa 300000
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from ukbol.data.uksi import ROOT_NAMES, build_taxonomy
+
+# the ranks used at each level of the synthetic tree
+RANKS = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]
+
+
+def generate_records(taxa: int, seed: int = 42) -> list[dict]:
+    """
+    Generates a list of synthetic NBN records making up a taxonomy of roughly the given
+    size.
+
+    :param taxa: the approximate number of taxa to generate
+    :param seed: the random seed to use
+    :return: a list of NBN record dicts
+    """
+    rng = random.Random(seed)
+    records = []
+
+    def add(rank: str, name: str, parent_id: str | None, **extras) -> str:
+        guid = f"NBNSYS{len(records):010}"
+        record = {
+            "guid": guid,
+            "scientificName": name,
+            "scientificNameAuthorship": rng.choice([None, "L.", "Smith, 1900"]),
+            "rank": rank,
+            "parentGuid": parent_id,
+            "taxonomicStatus": "accepted",
+            "infoSourceName": "UKSI",
+            "acceptedConceptID": None,
+        }
+        record.update(extras)
+        records.append(record)
+        return guid
+
+    root_id = add("domain", "Eukaryota", None)
+    level = [add("kingdom", name.capitalize(), root_id) for name in ROOT_NAMES]
+    # work out a branching factor which gets us roughly the right number of taxa
+    branching = max(2, round((taxa / len(ROOT_NAMES)) ** (1 / (len(RANKS) - 1))))
+    for rank in RANKS[1:]:
+        next_level = []
+        for parent_id in level:
+            for _ in range(rng.randint(1, branching * 2 - 1)):
+                if len(records) >= taxa:
+                    break
+                name = f"{rank} {len(records)}"
+                next_level.append(add(rank, name, parent_id))
+                # add some synonyms and non-UKSI records too
+                if rng.random() < 0.1:
+                    add(
+                        rank,
+                        f"{name} syn",
+                        None,
+                        taxonomicStatus="synonym",
+                        acceptedConceptID=next_level[-1],
+                    )
+                if rng.random() < 0.05:
+                    add(rank, f"{name} other", parent_id, infoSourceName="Other")
+        level = next_level
+    rng.shuffle(records)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--taxa", type=int, default=300_000)
+    args = parser.parse_args()
+
+    records = generate_records(args.taxa)
+    print(f"Generated {len(records)} records")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    taxa, synonyms = build_taxonomy(records)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"Built {len(taxa)} taxa and {len(synonyms)} synonyms")
+    print(f"Wall time: {elapsed:.2f}s")
+    print(f"Peak memory: {peak / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -87,7 +87,17 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # the trigram indexes on the name columns are created by hand in a migration as they
+    # rely on the pg_trgm extension, therefore they aren't defined on the models and
+    # need to be ignored by autogenerate to avoid it trying to drop them
+    def include_object(object, name, type_, reflected, compare_to):
+        if type_ == 'index' and reflected and compare_to is None:
+            return not name.endswith('_trgm')
+        return True
+
     conf_args = current_app.extensions['migrate'].configure_args
+    if conf_args.get("include_object") is None:
+        conf_args["include_object"] = include_object
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
 
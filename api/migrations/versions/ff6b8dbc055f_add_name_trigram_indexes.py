@@ -0,0 +1,70 @@
+"""add name trigram indexes
+
+Revision ID: ff6b8dbc055f
+Revises: 22fe8d857a10
+Create Date: 2026-10-18 16:16:19.814108
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "ff6b8dbc055f"
+down_revision = "22fe8d857a10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the trigram indexes can't help with queries shorter than a trigram, so those are
+    # only matched against the start of names using these indexes instead
+    with op.batch_alter_table("taxon", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_taxon_name_prefix",
+            ["name"],
+            unique=False,
+            postgresql_ops={"name": "text_pattern_ops"},
+        )
+
+    with op.batch_alter_table("synonym", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_synonym_name_prefix",
+            ["name"],
+            unique=False,
+            postgresql_ops={"name": "text_pattern_ops"},
+        )
+
+    # the trigram indexes are maintained by hand rather than in the models as they
+    # depend on the pg_trgm extension (see include_object in env.py)
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    with op.batch_alter_table("taxon", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_taxon_name_trgm",
+            ["name"],
+            unique=False,
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        )
+
+    with op.batch_alter_table("synonym", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_synonym_name_trgm",
+            ["name"],
+            unique=False,
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("synonym", schema=None) as batch_op:
+        batch_op.drop_index("ix_synonym_name_trgm")
+
+    with op.batch_alter_table("taxon", schema=None) as batch_op:
+        batch_op.drop_index("ix_taxon_name_trgm")
+
+    with op.batch_alter_table("synonym", schema=None) as batch_op:
+        batch_op.drop_index("ix_synonym_name_prefix")
+
+    with op.batch_alter_table("taxon", schema=None) as batch_op:
+        batch_op.drop_index("ix_taxon_name_prefix")
@@ -0,0 +1,247 @@
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+
+from tests.api.test_taxon import create_specimens
+from ukbol.data.utils import update_status
+from ukbol.export_jobs import (
+    _on_job_done,
+    get_export_path,
+    run_export_job,
+    shutdown_executor,
+)
+from ukbol.extensions import db
+from ukbol.model import ExportJob, Taxon
+
+TAXON_ID = "BMSSYS0000000015"
+
+
+@pytest.fixture
+def export_app(app: Flask, tmp_path: Path) -> Flask:
+    app.config["EXPORT_DIR"] = str(tmp_path)
+    yield app
+    shutdown_executor()
+
+
+@pytest.fixture
+def export_client(export_app: Flask) -> FlaskClient:
+    return export_app.test_client()
+
+
+@pytest.fixture
+def executor() -> MagicMock:
+    # stop the jobs actually being run in the background
+    with patch("ukbol.export_jobs.get_executor") as get_executor:
+        yield get_executor.return_value
+
+
+def wait_for_job(client: FlaskClient, job_id: str, timeout: float = 60) -> dict:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        job = client.get(f"/api/exports/{job_id}").json
+        if job["status"] in ("complete", "failed"):
+            return job
+        time.sleep(0.1)
+    raise TimeoutError(f"Export job {job_id} didn't finish")
+
+
+class TestCreateExport:
+    def test_404(self, export_client: FlaskClient):
+        response = export_client.post("/api/taxon/nope/exports")
+        assert response.status_code == 404
+
+    def test_bad_format(self, export_client: FlaskClient):
+        response = export_client.post(f"/api/taxon/{TAXON_ID}/exports?format=xlsx")
+        assert response.status_code == 400
+
+    def test_end_to_end(self, export_client: FlaskClient):
+        taxon = Taxon.get(TAXON_ID)
+        create_specimens(taxon, 4, 3, 9)
+
+        response = export_client.post(f"/api/taxon/{TAXON_ID}/exports?format=csv")
+        assert response.status_code == 202
+        assert response.json["status"] == "pending"
+
+        job = wait_for_job(export_client, response.json["id"])
+        assert job["status"] == "complete"
+        download = export_client.get(f"/api/exports/{job['id']}/download")
+        assert download.status_code == 200
+        assert download.mimetype == "text/csv"
+        assert download.headers["Content-Disposition"] == (
+            f"attachment; filename={taxon.name.replace(' ', '_')}_specimens.csv"
+        )
+        expected = export_client.get(f"/api/taxon/{TAXON_ID}/download/specimens")
+        assert download.data == expected.data
+        assert job["size"] == len(expected.data)
+
+        # asking again gives the completed job
+        response = export_client.post(f"/api/taxon/{TAXON_ID}/exports?format=csv")
+        assert response.status_code == 200
+        assert response.json == job
+
+    def test_dedupe(self, export_client: FlaskClient, executor: MagicMock):
+        url = f"/api/taxon/{TAXON_ID}/exports?format=fasta"
+        first = export_client.post(url).json
+        second = export_client.post(url).json
+        assert first["id"] == second["id"]
+        assert executor.submit.call_count == 1
+        # different options get a different job
+        third = export_client.post(f"{url}&include_descendants=true").json
+        assert third["id"] != first["id"]
+        assert executor.submit.call_count == 2
+
+    def test_new_data_version(self, export_client: FlaskClient, executor: MagicMock):
+        url = f"/api/taxon/{TAXON_ID}/exports"
+        first = export_client.post(url).json
+        update_status("bold-specimens", 10)
+        second = export_client.post(url).json
+        assert first["id"] != second["id"]
+        assert executor.submit.call_count == 2
+
+    def test_failed_job_restarts(self, export_client: FlaskClient, executor: MagicMock):
+        url = f"/api/taxon/{TAXON_ID}/exports"
+        first = export_client.post(url).json
+        job = ExportJob.get(first["id"])
+        job.status = "failed"
+        job.error = "oh no"
+        db.session.commit()
+
+        second = export_client.post(url).json
+        assert second["id"] == first["id"]
+        assert second["status"] == "pending"
+        assert second["error"] is None
+        assert executor.submit.call_count == 2
+
+    @pytest.mark.parametrize("status", ["pending", "running"])
+    def test_stale_job_restarts(
+        self, export_client: FlaskClient, executor: MagicMock, status: str
+    ):
+        url = f"/api/taxon/{TAXON_ID}/exports"
+        first = export_client.post(url).json
+        job = ExportJob.get(first["id"])
+        job.status = status
+        db.session.commit()
+
+        # a job which is still alive is left alone
+        assert export_client.post(url).json["id"] == first["id"]
+        assert executor.submit.call_count == 1
+
+        job = ExportJob.get(first["id"])
+        job.heartbeat_at = datetime.now(timezone.utc) - timedelta(hours=1)
+        db.session.commit()
+
+        second = export_client.post(url).json
+        assert second["id"] == first["id"]
+        assert second["status"] == "pending"
+        assert executor.submit.call_count == 2
+
+    def test_old_versions_removed(
+        self, export_client: FlaskClient, executor: MagicMock, tmp_path: Path
+    ):
+        url = f"/api/taxon/{TAXON_ID}/exports"
+        complete = export_client.post(url).json
+        running = export_client.post(f"{url}?format=fasta").json
+        job = ExportJob.get(complete["id"])
+        job.status = "complete"
+        ExportJob.get(running["id"]).status = "running"
+        db.session.commit()
+        path = get_export_path(job, tmp_path)
+        path.write_text("old")
+        partial_path = path.with_name(f"{path.name}.abc.part")
+        partial_path.write_text("old")
+
+        update_status("bold-specimens", 10)
+        export_client.post(url)
+
+        assert ExportJob.get(complete["id"]) is None
+        assert not path.exists()
+        assert not partial_path.exists()
+        # the running job is left until it finishes
+        assert ExportJob.get(running["id"]) is not None
+
+
+class TestGetExport:
+    def test_404(self, export_client: FlaskClient):
+        assert export_client.get("/api/exports/nope").status_code == 404
+        assert export_client.get("/api/exports/nope/download").status_code == 404
+
+    def test_not_complete(self, export_client: FlaskClient, executor: MagicMock):
+        job = export_client.post(f"/api/taxon/{TAXON_ID}/exports").json
+        response = export_client.get(f"/api/exports/{job['id']}/download")
+        assert response.status_code == 409
+
+
+class TestOnJobDone:
+    def test_failed_to_run(self, export_app: Flask, executor: MagicMock):
+        with export_app.test_client() as client:
+            job_id = client.post(f"/api/taxon/{TAXON_ID}/exports").json["id"]
+        future = Future()
+        future.set_exception(RuntimeError("worker died"))
+
+        _on_job_done(export_app, job_id, executor, future)
+
+        job = ExportJob.get(job_id)
+        assert job.status == "failed"
+        assert "worker died" in job.error
+        assert job.completed_at is not None
+
+    def test_ok(self, export_app: Flask, executor: MagicMock):
+        with export_app.test_client() as client:
+            job_id = client.post(f"/api/taxon/{TAXON_ID}/exports").json["id"]
+        future = Future()
+        future.set_result(None)
+
+        _on_job_done(export_app, job_id, executor, future)
+
+        assert ExportJob.get(job_id).status == "pending"
+
+
+class TestRunExportJob:
+    def test_ok(self, export_app: Flask, tmp_path: Path, executor: MagicMock):
+        taxon = Taxon.get(TAXON_ID)
+        create_specimens(taxon, 4, 3, 9)
+        with export_app.test_client() as client:
+            job_id = client.post(f"/api/taxon/{TAXON_ID}/exports").json["id"]
+
+        run_export_job(job_id, tmp_path)
+
+        job = ExportJob.get(job_id)
+        assert job.status == "complete"
+        path = get_export_path(job, tmp_path)
+        assert path.exists()
+        assert job.size == path.stat().st_size
+        assert job.completed_at is not None
+        # no partial files should be left around
+        assert list(tmp_path.iterdir()) == [path]
+
+    def test_missing_taxon(self, export_app: Flask, tmp_path: Path, executor):
+        with export_app.test_client() as client:
+            job_id = client.post(f"/api/taxon/{TAXON_ID}/exports").json["id"]
+        job = ExportJob.get(job_id)
+        job.taxon_id = "nope"
+        db.session.commit()
+
+        run_export_job(job_id, tmp_path)
+
+        job = ExportJob.get(job_id)
+        assert job.status == "failed"
+        assert "nope" in job.error
+        assert list(tmp_path.iterdir()) == []
+
+    def test_already_running(self, export_app: Flask, tmp_path: Path, executor):
+        with export_app.test_client() as client:
+            job_id = client.post(f"/api/taxon/{TAXON_ID}/exports").json["id"]
+        job = ExportJob.get(job_id)
+        job.status = "running"
+        db.session.commit()
+
+        run_export_job(job_id, tmp_path)
+
+        assert ExportJob.get(job_id).status == "running"
+        assert list(tmp_path.iterdir()) == []
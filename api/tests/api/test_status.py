@@ -10,6 +10,10 @@ def test_status(client: FlaskClient):
     assert len(sources) == 4
     assert sources[0]["name"] == "bold-specimens"
     assert sources[0]["total"] == 999
+    # the data was fully rebuilt, not incrementally updated
+    assert sources[0]["added"] is None
+    assert sources[0]["updated"] is None
+    assert sources[0]["removed"] is None
     assert sources[1]["name"] == "pantheon-species"
     assert sources[1]["total"] == 11779
     assert sources[2]["name"] == "uksi-synonym"
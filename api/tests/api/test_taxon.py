@@ -1,11 +1,20 @@
+import csv
+import gzip
+import io
 from itertools import cycle
+from unittest.mock import patch
 
+import pytest
 from flask.testing import FlaskClient
+from sqlalchemy import insert
 
+from tests.test_taxonomy import count_queries
+from ukbol.data.bins import rebuild_bin_summaries, rebuild_taxon_bins
 from ukbol.data.uksi import ROOT_NAMES
 from ukbol.extensions import db
-from ukbol.model import Specimen, Taxon
+from ukbol.model import Specimen, SpecimenDetail, Synonym, Taxon, TaxonBin
 from ukbol.schema import SpecimenSchema, TaxonSchema
+from ukbol.utils import encode_cursor
 
 taxon_schema = TaxonSchema()
 specimen_schema = SpecimenSchema()
@@ -23,6 +32,81 @@ def test_roots(client: FlaskClient):
     assert response.json == expected_json
 
 
+def test_roots_query_count(client: FlaskClient):
+    with count_queries() as statements:
+        response = client.get("/api/taxon/roots")
+    assert response.is_json
+    # the roots, their children, and their synonyms
+    assert len(statements) == 3
+
+
+class TestSuggestions:
+    def get_names(self, client: FlaskClient, **params) -> list[str]:
+        response = client.get("/api/taxon/suggest", query_string=params)
+        assert response.is_json
+        return [suggestion["name"] for suggestion in response.json]
+
+    def test_no_query(self, client: FlaskClient):
+        names = self.get_names(client, size=5)
+        assert names == sorted(names)
+        assert len(names) == 5
+
+    def test_ranking(self, client: FlaskClient):
+        assert self.get_names(client, query="absidia") == [
+            # exact match
+            "absidia",
+            # prefix matches, shortest first
+            "absidia spinosa",
+            "absidia cylindrospora",
+        ]
+        assert self.get_names(client, query="abrothall") == [
+            "abrothallus",
+            "abrothallales",
+            "abrothallaceae",
+            "abrothallus cetrariae",
+        ]
+        assert self.get_names(client, query="Cetrariae") == ["abrothallus cetrariae"]
+        # word prefix matches come before other matches
+        assert self.get_names(client, query="spi") == ["absidia spinosa"]
+
+    def test_short_query(self, client: FlaskClient):
+        # queries shorter than a trigram only match the start of names
+        assert self.get_names(client, query="ab")[:4] == [
+            "absidia",
+            "abrothallus",
+            "abrothallales",
+            "abrothallaceae",
+        ]
+        assert self.get_names(client, query="sp") == []
+
+    def test_synonyms(self, client: FlaskClient):
+        # only the synonyms of these species have "var." in them
+        assert self.get_names(client, query="var.") == [
+            "absidia spinosa",
+            "absidia cylindrospora",
+        ]
+
+    def test_ranks(self, client: FlaskClient):
+        assert self.get_names(client, query="absidia", ranks="Genus") == ["absidia"]
+        assert self.get_names(client, query="absidia", ignore_ranks="genus") == [
+            "absidia spinosa",
+            "absidia cylindrospora",
+        ]
+        assert self.get_names(client, query="absidia", ranks="species,genus") == [
+            "absidia",
+            "absidia spinosa",
+            "absidia cylindrospora",
+        ]
+
+    def test_escaping(self, client: FlaskClient):
+        assert self.get_names(client, query="%") == []
+        assert self.get_names(client, query="_") == []
+
+    def test_size(self, client: FlaskClient):
+        assert len(self.get_names(client, query="a", size=2)) == 2
+        assert len(self.get_names(client, size=100)) == 14
+
+
 class TestGetTaxon:
     def test_404(self, client: FlaskClient):
         response = client.get("/api/taxon/nope")
@@ -46,6 +130,37 @@ class TestTaxonChildren:
         child_ids = ["NHMSYS0020535046", "BMSSYS0000052700"]
         assert response.json == taxon_schema.dump(map(Taxon.get, child_ids), many=True)
 
+    def test_query_count(self, client: FlaskClient):
+        url = "/api/taxon/NHMSYS0020535450/children"
+        with count_queries() as statements:
+            client.get(url)
+        query_count = len(statements)
+
+        # add a load more children, each with their own children and synonyms
+        for i in range(10):
+            child_id = f"child-{i}"
+            db.session.add(
+                Taxon(
+                    id=child_id,
+                    name=f"child {i}",
+                    rank="phylum",
+                    parent_id="NHMSYS0020535450",
+                )
+            )
+            db.session.add(
+                Taxon(id=f"grandchild-{i}", name="x", rank="class", parent_id=child_id)
+            )
+            db.session.add(
+                Synonym(id=f"synonym-{i}", name="y", rank="phylum", taxon_id=child_id)
+            )
+        db.session.commit()
+
+        with count_queries() as statements:
+            response = client.get(url)
+        assert len(response.json) == 12
+        # the number of queries shouldn't depend on the number of children
+        assert len(statements) == query_count
+
 
 class TestTaxonParents:
     def test_404(self, client: FlaskClient):
@@ -86,30 +201,37 @@ def create_specimens(
     for i in range(matches):
         matching_specimens.append(
             Specimen(
-                specimenid=f"m-specimen-{i}",
                 identification=taxon.name,
                 bin_uri="bin001",
+                detail=SpecimenDetail(specimenid=f"m-specimen-{i}"),
             )
         )
 
     for i, synonym in zip(range(synonym_matches), cycle(taxon.synonyms)):
         matching_specimens.append(
             Specimen(
-                specimenid=f"s-specimen-{i}",
                 identification=synonym.name,
                 bin_uri="bin002",
+                detail=SpecimenDetail(specimenid=f"s-specimen-{i}"),
             )
         )
 
     for i in range(no_matches):
         not_matching_specimens.append(
-            Specimen(specimenid=f"n-specimen-{i}", identification="beans")
+            Specimen(
+                identification="beans",
+                detail=SpecimenDetail(specimenid=f"n-specimen-{i}"),
+            )
         )
 
     db.session.add_all(matching_specimens)
     db.session.add_all(not_matching_specimens)
     db.session.commit()
 
+    # update the derived BIN tables to include the new specimens
+    rebuild_bin_summaries()
+    rebuild_taxon_bins()
+
     # sort by identification and id just like the API does
     matching_specimens.sort(key=lambda spec: (spec.identification, spec.id))
 
@@ -131,6 +253,21 @@ class TestTaxonSpecimens:
             "specimens": specimen_schema.dump(specimens, many=True),
         }
 
+    def test_include_descendants(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        specimens, _ = create_specimens(taxon, 4, 3, 9)
+        # the genus has no specimens itself, but the species below it does
+        response = client.get(
+            f"/api/taxon/{taxon.parent_id}/associated_specimens?include_descendants=true"
+        )
+        assert response.is_json
+        assert response.json == {
+            "count": len(specimens),
+            "specimens": specimen_schema.dump(specimens, many=True),
+        }
+        response = client.get(f"/api/taxon/{taxon.parent_id}/associated_specimens")
+        assert response.json == {"count": 0, "specimens": []}
+
     def test_paging(self, client: FlaskClient):
         taxon = Taxon.get("BMSSYS0000000015")
         specimens, _ = create_specimens(taxon, 4, 3, 9)
@@ -142,3 +279,224 @@ class TestTaxonSpecimens:
             "count": len(specimens),
             "specimens": specimen_schema.dump(specimens[4:6], many=True),
         }
+
+    def get_pages(self, client: FlaskClient, url: str) -> list[dict]:
+        pages = []
+        cursor = ""
+        while cursor is not None:
+            response = client.get(url, query_string={"cursor": cursor, "per_page": 2})
+            assert response.status_code == 200
+            pages.append(response.json)
+            cursor = response.json["next"]
+        return pages
+
+    def test_cursor_paging(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        specimens, _ = create_specimens(taxon, 4, 3, 9)
+        # specimens without an identification should come last
+        for i in range(2):
+            specimen = Specimen(
+                bin_uri="bin001", detail=SpecimenDetail(specimenid=f"u-{i}")
+            )
+            db.session.add(specimen)
+            specimens.append(specimen)
+        db.session.commit()
+
+        pages = self.get_pages(client, f"/api/taxon/{taxon.id}/associated_specimens")
+        assert len(pages) == 5
+        assert all("count" not in page for page in pages)
+        assert [len(page["specimens"]) for page in pages] == [2, 2, 2, 2, 1]
+        assert [
+            specimen for page in pages for specimen in page["specimens"]
+        ] == specimen_schema.dump(specimens, many=True)
+
+    def test_cursor_count(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        specimens, _ = create_specimens(taxon, 4, 3, 9)
+        response = client.get(
+            f"/api/taxon/{taxon.id}/associated_specimens?cursor=&count=true"
+        )
+        assert response.json["count"] == len(specimens)
+        assert len(response.json["specimens"]) == len(specimens)
+        assert response.json["next"] is None
+
+    def test_cursor_empty(self, client: FlaskClient):
+        response = client.get(
+            "/api/taxon/BMSSYS0000000015/associated_specimens?cursor=&count=true"
+        )
+        assert response.json == {"specimens": [], "next": None, "count": 0}
+
+    @pytest.mark.parametrize(
+        "cursor",
+        [
+            "nope",
+            encode_cursor([1]),
+            encode_cursor([1, 2]),
+            encode_cursor(["a", True]),
+        ],
+    )
+    def test_invalid_cursor(self, client: FlaskClient, cursor: str):
+        response = client.get(
+            "/api/taxon/BMSSYS0000000015/associated_specimens",
+            query_string={"cursor": cursor},
+        )
+        assert response.status_code == 400
+
+
+class TestDownloadSpecimens:
+    def test_404(self, client: FlaskClient):
+        response = client.get("/api/taxon/nope/download/specimens")
+        assert response.status_code == 404
+
+    def test_ok(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        specimens, _ = create_specimens(taxon, 4, 3, 9)
+        # add some values which need quoting
+        specimens[0].detail.notes = 'a note, with "quotes"\nand a newline'
+        db.session.commit()
+        specimens.sort(key=lambda spec: (spec.bin_uri, spec.id))
+
+        response = client.get(f"/api/taxon/{taxon.id}/download/specimens")
+        assert response.status_code == 200
+        assert response.mimetype == "text/csv"
+        assert response.headers["Content-Disposition"] == (
+            f"attachment; filename={taxon.name.replace(' ', '_')}_specimens.csv"
+        )
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        # the CSV should have the same values as the JSON output, just as strings
+        assert rows == [
+            {
+                key: "" if value is None else str(value)
+                for key, value in specimen.items()
+            }
+            for specimen in specimen_schema.dump(specimens, many=True)
+        ]
+
+    def test_no_specimens(self, client: FlaskClient):
+        response = client.get("/api/taxon/BMSSYS0000000015/download/specimens")
+        assert response.status_code == 200
+        header = next(csv.reader(io.StringIO(response.text)))
+        assert header == [
+            field.data_key or name
+            for name, field in specimen_schema.dump_fields.items()
+        ]
+
+    def test_bad_format(self, client: FlaskClient):
+        response = client.get(
+            "/api/taxon/BMSSYS0000000015/download/specimens?format=xlsx"
+        )
+        assert response.status_code == 400
+
+    def test_csv_gz(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        create_specimens(taxon, 4, 3, 9)
+        url = f"/api/taxon/{taxon.id}/download/specimens"
+
+        response = client.get(f"{url}?format=csv.gz")
+        assert response.status_code == 200
+        assert response.mimetype == "application/gzip"
+        assert response.headers["Content-Disposition"].endswith(".csv.gz")
+        assert gzip.decompress(response.data) == client.get(url).data
+
+    def test_parquet(self, client: FlaskClient):
+        pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+        taxon = Taxon.get("BMSSYS0000000015")
+        specimens, _ = create_specimens(taxon, 4, 3, 9)
+        specimens.sort(key=lambda spec: (spec.bin_uri, spec.id))
+
+        # use a small row group size so that the file is streamed in a few parts
+        with patch("ukbol.export.PARQUET_ROW_GROUP_SIZE", 3):
+            response = client.get(
+                f"/api/taxon/{taxon.id}/download/specimens?format=parquet"
+            )
+        assert response.status_code == 200
+        assert response.mimetype == "application/vnd.apache.parquet"
+        parquet_file = pyarrow_parquet.ParquetFile(io.BytesIO(response.data))
+        assert parquet_file.num_row_groups == 3
+        assert parquet_file.read().to_pylist() == specimen_schema.dump(
+            specimens, many=True
+        )
+
+    def test_fasta(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        specimens, _ = create_specimens(taxon, 4, 3, 9)
+        specimens.sort(key=lambda spec: (spec.bin_uri, spec.id))
+        for i, specimen in enumerate(specimens):
+            specimen.processid = f"TEST-{i}"
+            specimen.detail.marker_code = "COI-5P"
+            specimen.detail.nuc = "ACGT" * (i + 1)
+        # specimens without a sequence are left out
+        specimens[0].detail.nuc = None
+        db.session.commit()
+
+        response = client.get(f"/api/taxon/{taxon.id}/download/specimens?format=fasta")
+        assert response.status_code == 200
+        assert response.mimetype == "text/x-fasta"
+        assert response.text == "".join(
+            f">{s.processid}|{s.identification.capitalize()}|COI-5P|{s.bin_uri}\n"
+            f"{s.detail.nuc}\n"
+            for s in specimens[1:]
+        )
+
+
+class TestTaxonBins:
+    def test_404(self, client: FlaskClient):
+        response = client.get("/api/taxon/nope/bin_summaries")
+        assert response.status_code == 404
+
+    def test_no_bins(self, client: FlaskClient):
+        response = client.get("/api/taxon/BMSSYS0000000015/bin_summaries")
+        assert response.is_json
+        assert response.json == []
+
+    def test_ok(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        create_specimens(taxon, 4, 3, 9)
+
+        response = client.get(f"/api/taxon/{taxon.id}/bin_summaries")
+        assert response.is_json
+        assert response.json == [
+            {
+                "bin": "bin001",
+                "count": 4,
+                "uk_count": 0,
+                "names": [[taxon.name, 4]],
+            },
+            {
+                "bin": "bin002",
+                "count": 3,
+                "uk_count": 0,
+                # this taxon only has one synonym
+                "names": [[taxon.synonyms[0].name, 3]],
+            },
+        ]
+
+    def test_include_descendants(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        create_specimens(taxon, 4, 3, 9)
+        # the genus has no specimens itself, but the species below it does
+        genus_url = f"/api/taxon/{taxon.parent_id}/bin_summaries"
+        response = client.get(f"{genus_url}?include_descendants=true")
+        assert response.is_json
+        assert response.json == client.get(f"/api/taxon/{taxon.id}/bin_summaries").json
+        assert client.get(genus_url).json == []
+
+    def test_more_bins_than_parameters(self, client: FlaskClient):
+        taxon = Taxon.get("BMSSYS0000000015")
+        create_specimens(taxon, 4, 3, 9)
+        expected = client.get(f"/api/taxon/{taxon.id}/bin_summaries").json
+        # link the genus to more BINs than can be sent as individual query parameters,
+        # the BINs have no summaries so the response shouldn't change
+        db.session.execute(
+            insert(TaxonBin),
+            [
+                {"taxon_id": taxon.parent_id, "bin_uri": f"extra{i:05}"}
+                for i in range(70_000)
+            ],
+        )
+        db.session.commit()
+
+        genus_url = f"/api/taxon/{taxon.parent_id}/bin_summaries"
+        response = client.get(f"{genus_url}?include_descendants=true")
+        assert response.status_code == 200
+        assert response.json == expected
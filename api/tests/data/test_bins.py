@@ -0,0 +1,134 @@
+from pathlib import Path
+
+from tests.data.test_uksi import mock_nbn_records
+from ukbol.data.bins import (
+    get_bin_summaries_select,
+    rebuild_bin_summaries,
+    rebuild_taxon_bins,
+)
+from ukbol.data.bold import rebuild_bold_tables
+from ukbol.data.uksi import rebuild_uksi_tables
+from ukbol.extensions import db
+from ukbol.model import BinSummary, Specimen, TaxonBin
+
+bold_tar_gz = Path(__file__).parent.parent / "files" / "BOLD_Public.24-JAN-2025.tar.gz"
+
+
+class TestRebuildBinSummaries:
+    def test_basic(self, app_no_data):
+        rebuild_bold_tables(bold_tar_gz)
+
+        # the BIN summaries are rebuilt as part of the BOLD rebuild
+        bin_count = db.session.scalar(
+            db.select(db.func.count(Specimen.bin_uri.distinct()))
+        )
+        assert BinSummary.query.count() == bin_count
+
+        for summary in BinSummary.query.all():
+            specimens = Specimen.query.filter(Specimen.bin_uri == summary.bin_uri)
+            assert summary.count == specimens.count()
+            assert (
+                summary.uk_count
+                == specimens.filter(Specimen.country_iso == "GB").count()
+            )
+            assert sum(count for _, count in summary.names) == summary.count
+
+    def test_names(self, app_no_data):
+        db.session.add_all(
+            [
+                Specimen(identification="beans", bin_uri="bin001", country_iso="GB"),
+                Specimen(identification="beans", bin_uri="bin001", country_iso="GB"),
+                Specimen(identification="peas", bin_uri="bin001"),
+                Specimen(identification="carrots", bin_uri="bin001", country_iso="GB"),
+                Specimen(identification="carrots", bin_uri="bin001"),
+                Specimen(identification="carrots", bin_uri="bin001"),
+                Specimen(identification="beans", bin_uri="bin002"),
+                Specimen(identification="beans"),
+            ]
+        )
+        db.session.commit()
+
+        rebuild_bin_summaries()
+
+        assert BinSummary.query.count() == 2
+        bin001 = BinSummary.get("bin001")
+        assert bin001.count == 6
+        assert bin001.uk_count == 3
+        assert bin001.names == [["carrots", 3], ["beans", 2], ["peas", 1]]
+        bin002 = BinSummary.get("bin002")
+        assert bin002.count == 1
+        assert bin002.uk_count == 0
+        assert bin002.names == [["beans", 1]]
+
+
+class TestGetBinSummariesSelect:
+    def test_matches_bin_summaries(self, app_no_data):
+        rebuild_bold_tables(bold_tar_gz)
+
+        select = get_bin_summaries_select().order_by("bin_uri")
+        summaries = db.session.scalars(
+            db.select(BinSummary).order_by(BinSummary.bin_uri)
+        ).all()
+        assert db.session.execute(select).all() == [
+            (summary.bin_uri, summary.count, summary.uk_count, summary.names)
+            for summary in summaries
+        ]
+
+    def test_bin_uris(self, app_no_data):
+        rebuild_bold_tables(bold_tar_gz)
+        bin_uris = [summary.bin_uri for summary in BinSummary.query.limit(3)]
+
+        rows = db.session.execute(get_bin_summaries_select(bin_uris)).all()
+        assert sorted(row.bin_uri for row in rows) == sorted(bin_uris)
+        for row in rows:
+            assert row.count == BinSummary.get(row.bin_uri).count
+
+
+class TestRebuildTaxonBins:
+    def test_names_and_synonyms(self, app_no_data):
+        with mock_nbn_records():
+            rebuild_uksi_tables()
+
+        db.session.add_all(
+            [
+                # the accepted name of BMSSYS0000000015
+                Specimen(identification="absidia cylindrospora", bin_uri="bin001"),
+                Specimen(identification="absidia cylindrospora", bin_uri="bin001"),
+                # a synonym of BMSSYS0000000015
+                Specimen(
+                    identification="absidia cylindrospora var. cylindrospora",
+                    bin_uri="bin002",
+                ),
+                # the accepted name of BMSSYS0000000023
+                Specimen(identification="absidia spinosa", bin_uri="bin002"),
+                # no BIN
+                Specimen(identification="absidia spinosa"),
+                # doesn't match anything
+                Specimen(identification="beans", bin_uri="bin003"),
+            ]
+        )
+        db.session.commit()
+
+        rebuild_taxon_bins()
+
+        taxon_bins = db.session.execute(
+            db.select(TaxonBin.taxon_id, TaxonBin.bin_uri).order_by(
+                TaxonBin.taxon_id, TaxonBin.bin_uri
+            )
+        ).all()
+        assert taxon_bins == [
+            ("BMSSYS0000000015", "bin001"),
+            ("BMSSYS0000000015", "bin002"),
+            ("BMSSYS0000000023", "bin002"),
+        ]
+
+    def test_rebuilt_with_uksi(self, app_no_data):
+        db.session.add(Specimen(identification="absidia spinosa", bin_uri="bin001"))
+        db.session.commit()
+        rebuild_taxon_bins()
+        assert TaxonBin.query.count() == 0
+
+        # the taxon to BIN lookup should be rebuilt after the taxonomy is rebuilt
+        with mock_nbn_records():
+            rebuild_uksi_tables()
+        assert TaxonBin.query.count() == 1
@@ -1,15 +1,76 @@
 import tarfile
+from datetime import date
+from io import BytesIO
 from pathlib import Path
+from unittest.mock import patch
 
 import pytest
+from sqlalchemy import func, select
 
-from ukbol.data.bold import get_tsv_name, rebuild_bold_tables
-from ukbol.model import Specimen
+from ukbol.data.bins import rebuild_bin_summaries, rebuild_taxon_bins
+from ukbol.data.bold import (
+    SpecimenRowSplitter,
+    encode_chunk,
+    escape_copy_value,
+    get_tsv_name,
+    iter_chunks,
+    number_chunks,
+    parse_coord,
+    parse_date,
+    rebuild_bold_tables,
+)
+from ukbol.extensions import db
+from ukbol.model import BinSummary, DataSourceStatus, Specimen, SpecimenDetail
+from ukbol.schema import SpecimenSchema
 
 bold_tar_gz = Path(__file__).parent.parent / "files" / "BOLD_Public.24-JAN-2025.tar.gz"
 bad_bold_tar_gz = Path(__file__).parent.parent / "files" / "bad.tar.gz"
 
 
+def get_specimen_query():
+    """
+    Returns a select of all the specimen values, including the details, apart from the
+    ids, in a stable order.
+    """
+    columns = [
+        *(column for column in Specimen.__table__.columns if column.name != "id"),
+        *(
+            column
+            for column in SpecimenDetail.__table__.columns
+            if column.name != "specimen_id"
+        ),
+    ]
+    return (
+        select(*columns)
+        .outerjoin(SpecimenDetail, SpecimenDetail.specimen_id == Specimen.id)
+        .order_by(*columns)
+    )
+
+
+def make_snapshot(snapshot: Path, changes: dict[str, dict[str, str]]):
+    """
+    Writes a copy of the sample BOLD snapshot to the given path with the given changes
+    made to it. The changes are keyed by processid and then by column name.
+    """
+    with tarfile.open(bold_tar_gz) as tar:
+        tsv_name = get_tsv_name(tar)
+        lines = tar.extractfile(tsv_name).read().decode("utf-8").split("\n")
+    header = lines[0].split("\t")
+    processid_index = header.index("processid")
+    for i, line in enumerate(lines[1:], start=1):
+        values = line.split("\t")
+        if len(values) > processid_index and values[processid_index] in changes:
+            for name, value in changes[values[processid_index]].items():
+                values[header.index(name)] = value
+            lines[i] = "\t".join(values)
+    data = "\n".join(lines).encode("utf-8")
+
+    with tarfile.open(snapshot, "w:gz") as tar:
+        info = tarfile.TarInfo(tsv_name)
+        info.size = len(data)
+        tar.addfile(info, BytesIO(data))
+
+
 class TestGetTSVName:
     def test_ok(self):
         with tarfile.open(bold_tar_gz) as tar:
@@ -31,7 +92,12 @@ class TestRebuildBoldTables:
         # there are 1000 rows in the sample bold tar.gz
         assert Specimen.query.count() == 999
         # 9513374 is a value in the sample
-        assert Specimen.query.filter(Specimen.specimenid == "1575613").count() == 1
+        assert (
+            Specimen.query.join(Specimen.detail)
+            .filter(SpecimenDetail.specimenid == "1575613")
+            .count()
+            == 1
+        )
         # there are 168 mexico country values in the sample
         assert Specimen.query.filter(Specimen.country_iso == "MX").count() == 168
 
@@ -45,3 +111,306 @@ class TestRebuildBoldTables:
         rebuild_bold_tables(bold_tar_gz)
         second_count = Specimen.query.count()
         assert first_count == second_count
+
+    def test_typed_values(self, app_no_data):
+        rebuild_bold_tables(bold_tar_gz)
+
+        specimen = Specimen.query.filter(Specimen.processid == "AANIC003-10").one()
+        assert specimen.collection_start == date(2009, 1, 18)
+        assert specimen.collection_end is None
+        assert specimen.latitude == -17.32
+        assert specimen.longitude == 145.31
+        # the raw values are kept in the details
+        assert specimen.detail.collection_date_start == "2009-01-18"
+        assert specimen.detail.coord == "[-17.32, 145.31]"
+
+        specimen = Specimen.query.filter(Specimen.processid == "AACTA2950-20").one()
+        assert specimen.collection_start == date(2011, 11, 14)
+        assert specimen.collection_end == date(2011, 11, 21)
+
+        # there are 30 specimens without a coord in the sample
+        assert Specimen.query.filter(Specimen.latitude.is_(None)).count() == 30
+        assert Specimen.query.filter(Specimen.longitude.is_(None)).count() == 30
+
+    @pytest.mark.parametrize(
+        "options",
+        [{}, {"workers": 2}, {"raw": True}],
+        ids=["serial", "parallel", "raw"],
+    )
+    def test_unparseable_values(self, app_no_data, tmp_path: Path, options: dict):
+        snapshot = tmp_path / "bold.tar.gz"
+        make_snapshot(
+            snapshot,
+            {
+                "AANIC003-10": {
+                    "collection_date_start": "2019-05",
+                    "collection_date_end": "2019-02-30",
+                    "coord": "[NaN, not a number]",
+                }
+            },
+        )
+        rebuild_bold_tables(snapshot, **options)
+
+        specimen = Specimen.query.filter(Specimen.processid == "AANIC003-10").one()
+        assert specimen.collection_start is None
+        assert specimen.collection_end is None
+        assert specimen.latitude is None
+        assert specimen.longitude is None
+        # the original values are kept and still output
+        assert specimen.detail.collection_date_start == "2019-05"
+        assert specimen.detail.collection_date_end == "2019-02-30"
+        data = SpecimenSchema().dump(specimen)
+        assert data["collection_date_start"] == "2019-05"
+        assert data["collection_date_end"] == "2019-02-30"
+        assert data["coord"] == "[NaN, not a number]"
+
+    def test_details(self, app_no_data):
+        rebuild_bold_tables(bold_tar_gz)
+
+        # every specimen gets a details row
+        assert SpecimenDetail.query.count() == Specimen.query.count()
+        # and they are deleted with their specimen
+        db.session.delete(Specimen.query.first())
+        db.session.commit()
+        assert SpecimenDetail.query.count() == Specimen.query.count()
+
+    def test_in_parallel(self, app_no_data):
+        query = get_specimen_query()
+
+        rebuild_bold_tables(bold_tar_gz)
+        expected = db.session.execute(query).all()
+
+        # use a small chunk size so that the TSV is split over lots of chunks
+        with patch("ukbol.data.bold.CHUNK_SIZE", 16 * 1024):
+            rebuild_bold_tables(bold_tar_gz, workers=2, writers=2)
+        assert db.session.execute(query).all() == expected
+
+    def test_raw(self, app_no_data):
+        query = get_specimen_query()
+
+        rebuild_bold_tables(bold_tar_gz)
+        expected = db.session.execute(query).all()
+
+        rebuild_bold_tables(bold_tar_gz, raw=True)
+        assert db.session.execute(query).all() == expected
+
+    def test_raw_whitespace(self, app_no_data, tmp_path: Path):
+        snapshot = tmp_path / "bold.tar.gz"
+        # values which only contain characters str.strip removes should be NULLs
+        make_snapshot(
+            snapshot,
+            {
+                "AANIC003-10": {
+                    "identification": "\u00a0",
+                    "country_iso": " \u3000",
+                    "coord": "\x1f\u2009",
+                },
+                "AACTA2950-20": {
+                    "identification": "\u00a0Diptera\u00a0",
+                },
+            },
+        )
+        query = get_specimen_query()
+
+        rebuild_bold_tables(snapshot)
+        expected = db.session.execute(query).all()
+
+        rebuild_bold_tables(snapshot, raw=True)
+        assert db.session.execute(query).all() == expected
+
+        specimen = Specimen.query.filter(Specimen.processid == "AANIC003-10").one()
+        assert specimen.identification is None
+        assert specimen.country_iso is None
+        assert specimen.detail.coord is None
+        specimen = Specimen.query.filter(Specimen.processid == "AACTA2950-20").one()
+        assert specimen.identification == "\u00a0diptera\u00a0"
+
+
+class TestIncrementalRebuild:
+    @pytest.fixture
+    def specimen_query(self):
+        return get_specimen_query()
+
+    @pytest.fixture
+    def bins_query(self):
+        return select(BinSummary.bin_uri, BinSummary.count, BinSummary.names).order_by(
+            BinSummary.bin_uri
+        )
+
+    def test_no_changes(self, app_no_data, specimen_query):
+        rebuild_bold_tables(bold_tar_gz)
+        expected = db.session.execute(specimen_query).all()
+        ids = db.session.scalars(select(Specimen.id).order_by(Specimen.id)).all()
+
+        rebuild_bold_tables(bold_tar_gz, incremental=True)
+
+        assert db.session.execute(specimen_query).all() == expected
+        # nothing should have been rewritten
+        assert (
+            db.session.scalars(select(Specimen.id).order_by(Specimen.id)).all() == ids
+        )
+        status = DataSourceStatus.get("bold-specimens")
+        assert status.total == 999
+        assert (status.added, status.updated, status.removed) == (0, 0, 0)
+
+    def test_changes(self, app_no_data, specimen_query, bins_query):
+        rebuild_bold_tables(bold_tar_gz)
+        expected = db.session.execute(specimen_query).all()
+        expected_bins = db.session.execute(bins_query).all()
+
+        # mess with the data so that the incremental rebuild has something to do
+        specimens = db.session.scalars(
+            select(Specimen).where(Specimen.bin_uri.isnot(None)).order_by(Specimen.id)
+        ).all()
+        for specimen in specimens[:3]:
+            db.session.delete(specimen)
+        for specimen in specimens[3:8]:
+            specimen.identification = "not a real name"
+            specimen.bin_uri = "BOLD:NOTREAL"
+        # only change the details of this one
+        specimens[8].detail.sampleid = None
+        db.session.add(Specimen(processid="NOTREAL-01", bin_uri=specimens[9].bin_uri))
+        db.session.commit()
+        rebuild_bin_summaries()
+        rebuild_taxon_bins()
+        kept_id = specimens[10].id
+
+        rebuild_bold_tables(bold_tar_gz, incremental=True)
+
+        assert db.session.execute(specimen_query).all() == expected
+        assert db.session.execute(bins_query).all() == expected_bins
+        assert BinSummary.get("BOLD:NOTREAL") is None
+        assert Specimen.get(kept_id) is not None
+        status = DataSourceStatus.get("bold-specimens")
+        assert status.total == 999
+        assert (status.added, status.updated, status.removed) == (3, 6, 1)
+
+    def test_ids(self, app_no_data):
+        rebuild_bold_tables(bold_tar_gz)
+        rebuild_bold_tables(bold_tar_gz)
+        # each full rebuild numbers the specimens from 1 again
+        assert db.session.scalar(select(func.min(Specimen.id))) == 1
+        max_id = db.session.scalar(select(func.max(Specimen.id)))
+
+        db.session.delete(Specimen.get(1))
+        db.session.commit()
+        rebuild_bold_tables(bold_tar_gz, incremental=True)
+
+        # only the re-added specimen should have been given an id from the sequence
+        assert db.session.scalar(select(func.max(Specimen.id))) == max_id + 1
+        assert Specimen.query.count() == 999
+
+    def test_full_rebuild_clears_changes(self, app_no_data):
+        rebuild_bold_tables(bold_tar_gz)
+        rebuild_bold_tables(bold_tar_gz, incremental=True)
+        rebuild_bold_tables(bold_tar_gz)
+
+        status = DataSourceStatus.get("bold-specimens")
+        assert (status.added, status.updated, status.removed) == (None, None, None)
+
+
+class TestIterChunks:
+    def test_whole_lines(self):
+        data = b"".join(f"line {i}\tvalue\n".encode("utf-8") for i in range(100))
+        chunks = list(iter_chunks(BytesIO(data), 64))
+        assert len(chunks) > 1
+        assert all(chunk.endswith(b"\n") for chunk in chunks)
+        assert b"".join(chunks) == data
+
+    def test_no_trailing_newline(self):
+        chunks = list(iter_chunks(BytesIO(b"a\tb\nc\td"), 3))
+        assert b"".join(chunks) == b"a\tb\nc\td"
+        assert chunks[-1] == b"c\td"
+
+    def test_long_line(self):
+        # a line longer than the chunk size is still returned whole
+        assert list(iter_chunks(BytesIO(b"abcdefghij\nk\n"), 4)) == [
+            b"abcdefghij\n",
+            b"k\n",
+        ]
+
+
+class TestEncodeChunk:
+    def test_escape_copy_value(self):
+        assert escape_copy_value(None) == "\\N"
+        assert escape_copy_value("plain") == "plain"
+        assert escape_copy_value("a\\b") == "a\\\\b"
+        assert escape_copy_value("a\rb") == "a\\rb"
+
+    def test_encode_chunk(self):
+        columns = [
+            "processid",
+            "sampleid",
+            "identification",
+            "collection_date_start",
+            "coord",
+        ]
+        splitter = SpecimenRowSplitter(columns)
+        chunk = (
+            "P1\tNone\tVespa Crabro\t2019-05-01\t[1.5, -2]\n"
+            "P2\t  \tApis\t2019-05\tNone\r\n"
+        ).encode("utf-8")
+        specimens, details, rows = encode_chunk((chunk, 5), splitter, (2,))
+        assert rows == 2
+        assert splitter.specimen_columns == [
+            "id",
+            "processid",
+            "identification",
+            "collection_start",
+            "latitude",
+            "longitude",
+        ]
+        assert specimens == (
+            b"5\tP1\tvespa crabro\t2019-05-01\t1.5\t-2.0\n6\tP2\tapis\t\\N\t\\N\t\\N\n"
+        )
+        assert splitter.detail_columns == [
+            "specimen_id",
+            "sampleid",
+            "collection_date_start",
+            "coord",
+        ]
+        assert details == b"5\t\\N\t2019-05-01\t[1.5, -2]\n6\t\\N\t2019-05\t\\N\n"
+
+    def test_encode_chunk_row_mismatch(self):
+        # a carriage return on its own ends a row but not a line
+        splitter = SpecimenRowSplitter(["processid", "sampleid"])
+        with pytest.raises(Exception):
+            encode_chunk((b"P1\ta\rb\n", 1), splitter, ())
+
+    def test_number_chunks(self):
+        chunks = [b"a\nb\n", b"c\n", b"d"]
+        assert list(number_chunks(chunks)) == [
+            (b"a\nb\n", 1),
+            (b"c\n", 3),
+            (b"d", 4),
+        ]
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("2019-05-01", "2019-05-01"),
+        ("2019-05", None),
+        ("2019-5-1", None),
+        ("2019-02-30", None),
+        ("2019-05-01\n", None),
+        (None, None),
+    ],
+)
+def test_parse_date(value, expected):
+    assert parse_date(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("[18.677, -88.395]", ("18.677", "-88.395")),
+        ("[ 1e1 , .5]", ("10.0", "0.5")),
+        ("[1.5]", ("1.5", None)),
+        ("[NaN, Infinity]", (None, None)),
+        ("[1e400, x]", (None, None)),
+        (None, (None, None)),
+    ],
+)
+def test_parse_coord(value, expected):
+    assert parse_coord(value) == expected
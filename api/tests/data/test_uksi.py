@@ -1,9 +1,24 @@
 import json
+from collections import Counter
 from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from threading import Thread
 from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs, urlparse
 
-from ukbol.data.uksi import rebuild_uksi_tables
+import pytest
+import requests
+
+from ukbol.data.uksi import (
+    NBN_PAGE_CACHE_DIR,
+    TaxonRecord,
+    get_from_nbn,
+    get_nested_sets,
+    read_snapshot,
+    rebuild_uksi_tables,
+    write_snapshot,
+)
 from ukbol.model import Synonym, Taxon
 
 nbn_mock_data = Path(__file__).parent.parent / "files" / "mock_nbn_records.json"
@@ -18,6 +33,142 @@ def mock_nbn_records():
         yield
 
 
+class StandInNBN(ThreadingHTTPServer):
+    """
+    A local stand-in for the NBN species search endpoint which serves the mock records.
+    Requests are counted by start offset and failures can be injected for specific
+    start offsets.
+    """
+
+    def __init__(self, records: list[dict]):
+        self.records = records
+        self.requests = Counter()
+        # start offset -> number of times to fail requests for it
+        self.failures = Counter()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                params = parse_qs(urlparse(handler.path).query)
+                start = int(params["start"][0])
+                size = int(params["pageSize"][0])
+                self.requests[start] += 1
+                if self.failures[start] > 0:
+                    self.failures[start] -= 1
+                    handler.send_response(503)
+                    handler.end_headers()
+                    return
+                body = json.dumps(
+                    {
+                        "searchResults": {
+                            "totalRecords": len(self.records),
+                            "results": self.records[start : start + size],
+                        }
+                    }
+                ).encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "application/json")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/search"
+
+
+@pytest.fixture
+def nbn_server() -> StandInNBN:
+    with nbn_mock_data.open() as f:
+        records = json.load(f)
+    server = StandInNBN(records)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # use small pages so that we get lots of them, and don't wait between retries
+    with (
+        patch("ukbol.data.uksi.PAGE_SIZE", 3),
+        patch("ukbol.data.uksi.BACKOFF_FACTOR", 0),
+    ):
+        yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestGetFromNBN:
+    @pytest.mark.parametrize("workers", [1, 4])
+    def test_all_records(self, nbn_server: StandInNBN, workers: int):
+        records = list(get_from_nbn(workers, url=nbn_server.url))
+        assert records == nbn_server.records
+        # 20 records in pages of 3 means 7 pages, plus 1 empty page at the end
+        assert sorted(nbn_server.requests) == list(range(0, 24, 3))
+
+    def test_retries(self, nbn_server: StandInNBN):
+        nbn_server.failures[6] = 2
+        nbn_server.failures[12] = 1
+        records = list(get_from_nbn(4, url=nbn_server.url))
+        assert records == nbn_server.records
+        assert nbn_server.requests[6] == 3
+        assert nbn_server.requests[12] == 2
+
+    def test_too_many_failures(self, nbn_server: StandInNBN):
+        nbn_server.failures[6] = 100
+        with pytest.raises(requests.RequestException):
+            list(get_from_nbn(4, url=nbn_server.url))
+
+    def test_resume(self, nbn_server: StandInNBN, tmp_path: Path):
+        cache_dir = tmp_path / "cache"
+        nbn_server.failures[9] = 100
+        with pytest.raises(requests.RequestException):
+            list(get_from_nbn(1, cache_dir, url=nbn_server.url))
+
+        # the pages before the failure should have been cached
+        page_dir = cache_dir / NBN_PAGE_CACHE_DIR
+        assert (page_dir / "0-3.json").exists()
+        assert (page_dir / "6-3.json").exists()
+        assert not (page_dir / "9-3.json").exists()
+
+        nbn_server.failures.clear()
+        nbn_server.requests.clear()
+        records = list(get_from_nbn(4, cache_dir, url=nbn_server.url))
+        assert records == nbn_server.records
+        # only the pages which weren't cached should have been requested
+        assert 0 not in nbn_server.requests
+        assert 6 not in nbn_server.requests
+        assert nbn_server.requests[9] == 1
+
+    def test_rebuild_removes_cache(
+        self, app_no_data, nbn_server: StandInNBN, tmp_path: Path
+    ):
+        cache_dir = tmp_path / "cache"
+        cache_dir.mkdir()
+        other_file = cache_dir / "other.txt"
+        other_file.write_text("not ours")
+        with patch("ukbol.data.uksi.NBN_SEARCH_URL", nbn_server.url):
+            rebuild_uksi_tables(4, cache_dir)
+        assert Taxon.query.count() == 14
+        # only the pages should have been removed
+        assert not (cache_dir / NBN_PAGE_CACHE_DIR).exists()
+        assert other_file.read_text() == "not ours"
+
+    def test_rebuild_from_snapshot_keeps_cache(
+        self, app_no_data, nbn_server: StandInNBN, tmp_path: Path
+    ):
+        cache_dir = tmp_path / "cache"
+        snapshot = tmp_path / "uksi.jsonl.gz"
+        nbn_server.failures[9] = 100
+        with pytest.raises(requests.RequestException):
+            list(get_from_nbn(1, cache_dir, url=nbn_server.url))
+        list(write_snapshot(nbn_server.records, snapshot))
+
+        rebuild_uksi_tables(4, cache_dir, from_snapshot=snapshot)
+        # the pages weren't used so they should be left for a resumed harvest
+        assert (cache_dir / NBN_PAGE_CACHE_DIR / "0-3.json").exists()
+
+
 class TestRebuildUKSITables:
     def test_basic(self, app_no_data):
         with mock_nbn_records():
@@ -65,3 +216,79 @@ class TestRebuildUKSITables:
             second_synonym_count = Synonym.query.count()
             assert first_taxon_count == second_taxon_count
             assert first_synonym_count == second_synonym_count
+
+    def test_nested_sets(self, app_no_data):
+        with mock_nbn_records():
+            rebuild_uksi_tables()
+
+        for taxon in Taxon.query.all():
+            assert taxon.lft < taxon.rgt
+            descendants = Taxon.query.filter(
+                Taxon.lft > taxon.lft, Taxon.lft < taxon.rgt
+            ).all()
+            # check the interval contains all the descendants and nothing else
+            expected = []
+            queue = list(taxon.children)
+            while queue:
+                child = queue.pop()
+                expected.append(child)
+                queue.extend(child.children)
+            assert sorted(descendants, key=lambda t: t.id) == sorted(
+                expected, key=lambda t: t.id
+            )
+
+
+class TestSnapshots:
+    def test_round_trip(self, tmp_path: Path):
+        with nbn_mock_data.open() as f:
+            records = json.load(f)
+        snapshot = tmp_path / "snapshots" / "uksi.jsonl.gz"
+        assert list(write_snapshot(records, snapshot)) == records
+        assert snapshot.exists()
+        assert list(read_snapshot(snapshot)) == records
+
+    def test_failed_write(self, tmp_path: Path):
+        def broken_records():
+            yield {"guid": "1"}
+            raise Exception("oh no")
+
+        snapshot = tmp_path / "uksi.jsonl.gz"
+        with pytest.raises(Exception, match="oh no"):
+            list(write_snapshot(broken_records(), snapshot))
+        assert not snapshot.exists()
+
+    def test_rebuild(self, app_no_data, tmp_path: Path):
+        def get_data():
+            taxa = Taxon.query.order_by(Taxon.id).all()
+            synonyms = Synonym.query.order_by(Synonym.id).all()
+            return [(t.id, t.name, t.parent_id, t.lft, t.rgt) for t in taxa], [
+                (s.id, s.name, s.taxon_id) for s in synonyms
+            ]
+
+        snapshot = tmp_path / "uksi.jsonl.gz"
+        with mock_nbn_records():
+            rebuild_uksi_tables(save_snapshot=snapshot)
+        data = get_data()
+
+        broken_get_from_nbn = MagicMock(side_effect=Exception("should not be called"))
+        with patch("ukbol.data.uksi.get_from_nbn", broken_get_from_nbn):
+            rebuild_uksi_tables(from_snapshot=snapshot)
+        assert get_data() == data
+        assert len(data[0]) == 14
+
+
+def test_get_nested_sets():
+    taxa = [
+        TaxonRecord("1", "a", None, "kingdom", None),
+        TaxonRecord("2", "b", None, "phylum", "1"),
+        TaxonRecord("3", "c", None, "phylum", "1"),
+        TaxonRecord("4", "d", None, "class", "2"),
+        TaxonRecord("5", "e", None, "kingdom", None),
+    ]
+    assert get_nested_sets(taxa) == {
+        "1": (1, 8),
+        "2": (2, 5),
+        "3": (6, 7),
+        "4": (3, 4),
+        "5": (9, 10),
+    }
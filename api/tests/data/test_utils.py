@@ -1,4 +1,17 @@
-from ukbol.data.utils import get
+import pytest
+from sqlalchemy import Table, func, insert, select, text
+
+from ukbol.data.utils import (
+    build_staging_indexes,
+    create_staging_table,
+    drop_staging_table,
+    get,
+    get_copy_sql,
+    get_staging_name,
+    swap_in_staging_tables,
+)
+from ukbol.extensions import db
+from ukbol.model import PantheonSpecies, Synonym, Taxon
 
 
 class TestGet:
@@ -16,3 +29,185 @@ class TestGet:
 
     def test_value_lowercase_default(self):
         assert get({"test": "VaLuE"}, "test") == "VaLuE"
+
+
+def test_get_copy_sql():
+    assert (
+        get_copy_sql(Taxon.__table__, ["id", "name", "rank"])
+        == 'COPY taxon ("id", "name", "rank") FROM STDIN'
+    )
+
+
+def get_table_structure(table_name: str) -> tuple[list, list]:
+    indexes = db.session.execute(
+        text(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = :table "
+            "ORDER BY indexname"
+        ),
+        {"table": table_name},
+    ).all()
+    constraints = db.session.execute(
+        text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = CAST(:table AS regclass) ORDER BY conname"
+        ),
+        {"table": table_name},
+    ).all()
+    return indexes, constraints
+
+
+def staging_table_exists(live_table: Table) -> bool:
+    return (
+        db.session.execute(
+            text("SELECT to_regclass(:table)"), {"table": get_staging_name(live_table)}
+        ).scalar()
+        is not None
+    )
+
+
+class TestStagingTables:
+    @pytest.fixture(autouse=True)
+    def drop_staging_tables(self, app_no_data):
+        yield
+        # make sure the staging tables don't stop the fixture dropping the live tables
+        db.session.rollback()
+        for live_table in (
+            Taxon.__table__,
+            Synonym.__table__,
+            PantheonSpecies.__table__,
+        ):
+            drop_staging_table(live_table)
+
+    def test_create_staging_table(self, app_no_data):
+        staging_table = create_staging_table(Taxon.__table__)
+        assert staging_table.name == "taxon_staging"
+        assert staging_table_exists(Taxon.__table__)
+        # the staging table starts without any indexes or constraints
+        indexes, constraints = get_table_structure(staging_table.name)
+        assert not indexes
+        assert not constraints
+
+    def test_create_staging_table_replaces_leftovers(self, app_no_data):
+        staging_table = create_staging_table(PantheonSpecies.__table__)
+        db.session.execute(insert(staging_table), [{"species": "beetle"}])
+        db.session.commit()
+
+        staging_table = create_staging_table(PantheonSpecies.__table__)
+        assert (
+            db.session.execute(select(func.count()).select_from(staging_table)).scalar()
+            == 0
+        )
+
+    def test_swap(self, app_no_data):
+        db.session.add(Taxon(id="old", name="old", rank="species"))
+        db.session.commit()
+        before = {
+            table.name: get_table_structure(table.name)
+            for table in (Taxon.__table__, Synonym.__table__)
+        }
+
+        taxon_staging = create_staging_table(Taxon.__table__)
+        synonym_staging = create_staging_table(Synonym.__table__)
+        db.session.execute(
+            insert(taxon_staging),
+            [
+                {"id": "t1", "name": "root", "rank": "kingdom", "parent_id": None},
+                {"id": "t2", "name": "child", "rank": "phylum", "parent_id": "t1"},
+            ],
+        )
+        db.session.execute(
+            insert(synonym_staging),
+            [{"id": "s1", "name": "another", "rank": "phylum", "taxon_id": "t2"}],
+        )
+        db.session.commit()
+        build_staging_indexes(Taxon.__table__, Synonym.__table__)
+        swap_in_staging_tables(Taxon.__table__, Synonym.__table__)
+
+        assert Taxon.get("old") is None
+        assert Taxon.get("t2").parent.name == "root"
+        assert [synonym.id for synonym in Taxon.get("t2").synonyms] == ["s1"]
+        assert not staging_table_exists(Taxon.__table__)
+        assert not staging_table_exists(Synonym.__table__)
+        # the indexes, keys, and foreign keys should all be back as they were
+        for table_name, structure in before.items():
+            assert get_table_structure(table_name) == structure
+
+    def test_swap_keeps_sequence(self, app_no_data):
+        db.session.add(PantheonSpecies(species="beetle"))
+        db.session.commit()
+
+        staging_table = create_staging_table(PantheonSpecies.__table__)
+        db.session.execute(insert(staging_table), [{"species": "fly"}])
+        db.session.commit()
+        build_staging_indexes(PantheonSpecies.__table__)
+        swap_in_staging_tables(PantheonSpecies.__table__)
+
+        # the id sequence should have survived the swap and carry on where it was
+        db.session.add(PantheonSpecies(species="moth"))
+        db.session.commit()
+        ids = db.session.scalars(
+            select(PantheonSpecies.id).order_by(PantheonSpecies.id)
+        ).all()
+        assert ids == [2, 3]
+
+    def test_swap_with_broken_foreign_key(self, app_no_data):
+        db.session.add(Taxon(id="old", name="old", rank="species"))
+        db.session.commit()
+
+        create_staging_table(Taxon.__table__)
+        synonym_staging = create_staging_table(Synonym.__table__)
+        db.session.execute(
+            insert(synonym_staging),
+            [{"id": "s1", "name": "another", "rank": "phylum", "taxon_id": "nope"}],
+        )
+        db.session.commit()
+
+        build_staging_indexes(Taxon.__table__, Synonym.__table__)
+        with pytest.raises(Exception, match="violates foreign key"):
+            swap_in_staging_tables(Taxon.__table__, Synonym.__table__)
+        db.session.rollback()
+
+        # the old data should still be there
+        assert Taxon.get("old") is not None
+        assert Synonym.query.count() == 0
+
+    def test_swap_blocked(self, app_no_data):
+        db.session.add(PantheonSpecies(species="beetle"))
+        db.session.commit()
+
+        staging_table = create_staging_table(PantheonSpecies.__table__)
+        db.session.execute(insert(staging_table), [{"species": "fly"}])
+        db.session.commit()
+        build_staging_indexes(PantheonSpecies.__table__)
+
+        # simulate a long running query holding a lock on the live table
+        with db.engine.connect() as connection:
+            connection.execute(select(PantheonSpecies.id))
+            with pytest.raises(Exception, match="Could not lock pantheon_species"):
+                swap_in_staging_tables(
+                    PantheonSpecies.__table__,
+                    lock_timeout="100ms",
+                    attempts=2,
+                    retry_delay=0,
+                )
+            connection.rollback()
+
+        # the live table should be untouched and the staging table still there
+        species = db.session.scalars(select(PantheonSpecies.species)).all()
+        assert species == ["beetle"]
+        assert staging_table_exists(PantheonSpecies.__table__)
+
+    def test_build_staging_indexes_in_parallel(self, app_no_data):
+        live_indexes, _ = get_table_structure(PantheonSpecies.__table__.name)
+        staging_table = create_staging_table(PantheonSpecies.__table__)
+        db.session.execute(insert(staging_table), [{"species": "fly"}])
+        db.session.commit()
+
+        build_staging_indexes(
+            PantheonSpecies.__table__, workers=3, maintenance_work_mem="64MB"
+        )
+
+        staging_indexes, _ = get_table_structure(staging_table.name)
+        assert sorted(name for name, _ in staging_indexes) == sorted(
+            f"{name}_staging" for name, _ in live_indexes
+        )
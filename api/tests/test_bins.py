@@ -0,0 +1,140 @@
+from flask import Flask
+from sqlalchemy import insert
+
+from tests.test_taxonomy import count_queries
+from ukbol.bins import (
+    clear_count_cache,
+    count_associated_specimens,
+    get_associated_specimens_page_select,
+    get_associated_specimens_select,
+    get_containing_bins,
+    iter_associated_specimen_rows,
+    iter_associated_specimens,
+)
+from ukbol.data.bins import rebuild_bin_summaries, rebuild_taxon_bins
+from ukbol.data.utils import update_status
+from ukbol.extensions import db
+from ukbol.model import Specimen, SpecimenDetail, Taxon, TaxonBin
+
+
+def add_specimens(taxon: Taxon, count: int):
+    for i in range(count):
+        db.session.add(
+            Specimen(
+                processid=f"TEST-{i:02}",
+                identification=taxon.name,
+                bin_uri=f"bin{i % 3:03}",
+                country_iso="GB" if i % 2 else None,
+                detail=SpecimenDetail(notes=f"note {i}"),
+            )
+        )
+    db.session.commit()
+    rebuild_bin_summaries()
+    rebuild_taxon_bins()
+
+
+class TestIterAssociatedSpecimens:
+    def test_ok(self, app: Flask):
+        taxon = Taxon.get("BMSSYS0000000015")
+        add_specimens(taxon, 10)
+
+        specimens = list(iter_associated_specimens(taxon))
+        assert len(specimens) == 10
+        assert [s.bin_uri for s in specimens] == sorted(s.bin_uri for s in specimens)
+
+
+class TestIterAssociatedSpecimenRows:
+    def test_matches_specimens(self, app: Flask):
+        taxon = Taxon.get("BMSSYS0000000015")
+        add_specimens(taxon, 10)
+
+        columns = [Specimen.processid, Specimen.bin_uri, Specimen.country_iso]
+        rows = list(iter_associated_specimen_rows(taxon, columns))
+        assert rows == [
+            (specimen.processid, specimen.bin_uri, specimen.country_iso)
+            for specimen in iter_associated_specimens(taxon)
+        ]
+
+    def test_detail_columns(self, app: Flask):
+        taxon = Taxon.get("BMSSYS0000000015")
+        add_specimens(taxon, 10)
+
+        columns = [Specimen.processid, SpecimenDetail.notes]
+        rows = list(iter_associated_specimen_rows(taxon, columns))
+        assert len(rows) == 10
+        for processid, notes in rows:
+            assert notes == f"note {int(processid[-2:])}"
+
+        # labelled columns should still get the details joined in
+        columns = [Specimen.processid, SpecimenDetail.notes.label("note")]
+        assert list(iter_associated_specimen_rows(taxon, columns)) == rows
+
+    def test_no_bins(self, app: Flask):
+        taxon = Taxon.get("BMSSYS0000000015")
+        assert list(iter_associated_specimen_rows(taxon, [Specimen.processid])) == []
+
+
+class TestGetAssociatedSpecimensPageSelect:
+    def test_after(self, app: Flask):
+        taxon = Taxon.get("BMSSYS0000000015")
+        add_specimens(taxon, 10)
+        specimens = db.session.scalars(
+            get_associated_specimens_page_select(taxon)
+        ).all()
+        assert [specimen.id for specimen in specimens] == sorted(
+            specimen.id for specimen in specimens
+        )
+
+        after = (specimens[3].identification, specimens[3].id)
+        page = db.session.scalars(
+            get_associated_specimens_page_select(taxon, after=after)
+        ).all()
+        assert page == specimens[4:]
+
+
+class TestCountAssociatedSpecimens:
+    def test_cached(self, app: Flask):
+        clear_count_cache()
+        taxon = Taxon.get("BMSSYS0000000015")
+        add_specimens(taxon, 10)
+        assert count_associated_specimens(taxon) == 10
+
+        with count_queries() as statements:
+            assert count_associated_specimens(taxon) == 10
+        # only the data version is queried
+        assert len(statements) == 1
+
+        # a new data version means a recount
+        add_specimens(taxon, 5)
+        assert count_associated_specimens(taxon) == 10
+        update_status("bold-specimens", 15)
+        assert count_associated_specimens(taxon) == 15
+        clear_count_cache()
+
+
+class TestManyBins:
+    def test_more_bins_than_parameters(self, app: Flask):
+        # more BINs than can be sent as individual query parameters
+        bin_count = 70_000
+        clear_count_cache()
+        taxon = Taxon.get("BMSSYS0000000015")
+        add_specimens(taxon, 10)
+        db.session.execute(
+            insert(TaxonBin),
+            [
+                {"taxon_id": taxon.id, "bin_uri": f"extra{i:05}"}
+                for i in range(bin_count)
+            ],
+        )
+        db.session.commit()
+
+        assert len(get_containing_bins(taxon)) == bin_count + 3
+        for include_descendants in (False, True):
+            select = get_associated_specimens_select(taxon, include_descendants)
+            assert len(db.session.scalars(select).all()) == 10
+            assert count_associated_specimens(taxon, include_descendants) == 10
+            rows = iter_associated_specimen_rows(
+                taxon, [Specimen.processid], include_descendants
+            )
+            assert len(list(rows)) == 10
+        clear_count_cache()
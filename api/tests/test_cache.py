@@ -0,0 +1,208 @@
+from pathlib import Path
+
+import pytest
+from flask import Flask
+
+from tests.test_taxonomy import count_queries
+from ukbol.cache import (
+    ResponseCache,
+    clear_response_cache,
+    get_response_cache,
+    get_taxa_at_or_above_rank,
+    warm_response_cache,
+)
+from ukbol.data.utils import update_status
+from ukbol.model import Taxon
+
+
+@pytest.fixture
+def cache_app(app: Flask) -> Flask:
+    app.config["RESPONSE_CACHE"] = True
+    app.config["RESPONSE_CACHE_CHECK_INTERVAL"] = 60
+    clear_response_cache()
+    yield app
+    clear_response_cache()
+
+
+def test_disabled(app: Flask):
+    assert get_response_cache() is None
+    response = app.test_client().get("/api/taxon/roots")
+    assert response.status_code == 200
+    assert response.get_etag() == (None, None)
+
+
+class TestResponseCache:
+    def test_lru(self):
+        cache = ResponseCache("v1", 10)
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        # use a so that b is the least recently used
+        assert cache.get("a") == b"1234"
+        cache.set("c", b"1234")
+        assert cache.get("a") == b"1234"
+        assert cache.get("b") is None
+        assert cache.get("c") == b"1234"
+        assert cache.size == 8
+
+    def test_too_big(self):
+        cache = ResponseCache("v1", 10)
+        cache.set("a", b"12345678901")
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_disk(self, tmp_path: Path):
+        cache = ResponseCache("v1", 10, tmp_path)
+        cache.set("a", b"1234")
+        # a second cache sharing the directory, like another worker would
+        other_cache = ResponseCache("v1", 10, tmp_path)
+        assert other_cache.get("a") == b"1234"
+        assert len(other_cache) == 1
+
+    def test_disk_new_version(self, tmp_path: Path):
+        cache = ResponseCache("v1", 10, tmp_path)
+        cache.set("a", b"1234")
+        new_cache = ResponseCache("v2", 10, tmp_path)
+        assert new_cache.get("a") is None
+        assert [path.name for path in tmp_path.iterdir()] == ["v2"]
+
+    def test_disk_full(self, tmp_path: Path):
+        cache = ResponseCache("v1", 10, tmp_path, max_disk_size=6)
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        # b is held in memory but isn't written to disk as that would exceed the limit
+        assert cache.get("b") == b"1234"
+        assert cache.disk_size == 4
+        other_cache = ResponseCache("v1", 10, tmp_path, max_disk_size=6)
+        assert other_cache.disk_size == 4
+        assert other_cache.get("a") == b"1234"
+        assert other_cache.get("b") is None
+
+
+class TestCachedResponse:
+    def test_hit(self, cache_app: Flask):
+        client = cache_app.test_client()
+        url = "/api/taxon/NHMSYS0020535450/bin_summaries"
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.get_etag()[0] is not None
+        assert response.cache_control.public
+        assert response.cache_control.max_age == 60
+
+        with count_queries() as statements:
+            cached_response = client.get(url)
+        assert statements == []
+        assert cached_response.status_code == 200
+        assert cached_response.json == response.json
+        assert cached_response.get_etag() == response.get_etag()
+
+    def test_args_order(self, cache_app: Flask):
+        client = cache_app.test_client()
+        client.get("/api/taxon/suggest?query=absidia&size=2")
+        with count_queries() as statements:
+            response = client.get("/api/taxon/suggest?size=2&query=absidia")
+        assert statements == []
+        assert len(response.json) == 2
+
+    def test_different_args(self, cache_app: Flask):
+        client = cache_app.test_client()
+        first = client.get("/api/taxon/suggest?query=absidia&size=1")
+        second = client.get("/api/taxon/suggest?query=absidia&size=2")
+        assert len(first.json) == 1
+        assert len(second.json) == 2
+        assert first.get_etag() != second.get_etag()
+
+    def test_ignored_args(self, cache_app: Flask):
+        client = cache_app.test_client()
+        url = "/api/taxon/NHMSYS0020535450/bin_summaries"
+        response = client.get(url)
+        with count_queries() as statements:
+            other_response = client.get(f"{url}?junk=1&more=junk")
+        assert statements == []
+        assert other_response.get_etag() == response.get_etag()
+        assert len(get_response_cache()) == 1
+
+    def test_not_modified(self, cache_app: Flask):
+        client = cache_app.test_client()
+        url = "/api/taxon/NHMSYS0020535450"
+        etag, _ = client.get(url).get_etag()
+
+        with count_queries() as statements:
+            response = client.get(url, headers={"If-None-Match": f'"{etag}"'})
+        assert statements == []
+        assert response.status_code == 304
+        assert response.get_etag()[0] == etag
+        assert response.data == b""
+
+    def test_404_not_cached(self, cache_app: Flask):
+        client = cache_app.test_client()
+        assert client.get("/api/taxon/nope").status_code == 404
+        assert client.get("/api/taxon/nope").status_code == 404
+        assert len(get_response_cache()) == 0
+
+    def test_downloads_not_cached(self, cache_app: Flask):
+        client = cache_app.test_client()
+        response = client.get("/api/taxon/NHMSYS0020535450/download/specimens")
+        assert response.status_code == 200
+        assert response.get_etag() == (None, None)
+        assert len(get_response_cache()) == 0
+
+    def test_invalidation(self, cache_app: Flask):
+        cache_app.config["RESPONSE_CACHE_CHECK_INTERVAL"] = 0
+        client = cache_app.test_client()
+        url = "/api/taxon/NHMSYS0020535450/children"
+        etag, _ = client.get(url).get_etag()
+        cache = get_response_cache()
+
+        # a new uksi-taxa status should mean a new cache and new etags
+        update_status("uksi-taxa", Taxon.query.count())
+        response = client.get(url, headers={"If-None-Match": f'"{etag}"'})
+        assert response.status_code == 200
+        assert response.get_etag()[0] != etag
+        assert get_response_cache() is not cache
+
+    def test_shared_disk_store(self, cache_app: Flask, tmp_path: Path):
+        cache_app.config["RESPONSE_CACHE_DIR"] = str(tmp_path)
+        client = cache_app.test_client()
+        url = "/api/taxon/NHMSYS0020535450/parents"
+        response = client.get(url)
+
+        # simulate another worker by clearing the in-memory cache
+        clear_response_cache()
+        with count_queries() as statements:
+            cached_response = client.get(url)
+        # only the data version is queried
+        assert len(statements) == 1
+        assert cached_response.json == response.json
+
+
+def test_get_taxa_at_or_above_rank(app: Flask):
+    taxon_ids = get_taxa_at_or_above_rank("Genus")
+    ranks = {Taxon.get(taxon_id).rank for taxon_id in taxon_ids}
+    assert ranks == {
+        "kingdom",
+        "phylum",
+        "subphylum",
+        "class",
+        "order",
+        "family",
+        "genus",
+    }
+    assert len(taxon_ids) == Taxon.query.filter(Taxon.rank != "species").count()
+    assert get_taxa_at_or_above_rank("nope") == []
+
+
+def test_warm_response_cache(cache_app: Flask, tmp_path: Path):
+    cache_app.config["RESPONSE_CACHE_DIR"] = str(tmp_path)
+    taxon_ids = ["NHMSYS0020535450", "BMSSYS0000000010", "nope"]
+    assert warm_response_cache(cache_app, taxon_ids, workers=2) == 6
+
+    # simulate a server worker which shares the cache directory
+    clear_response_cache()
+    client = cache_app.test_client()
+    with count_queries() as statements:
+        for taxon_id in taxon_ids[:2]:
+            for endpoint in ("bin_summaries", "children", "parents"):
+                response = client.get(f"/api/taxon/{taxon_id}/{endpoint}")
+                assert response.status_code == 200
+    # only the data version is queried
+    assert len(statements) == 1
@@ -0,0 +1,130 @@
+import json
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+
+import pytest
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from marshmallow import Schema, fields
+
+from tests.api.test_taxon import create_specimens
+from ukbol.data.utils import update_status
+from ukbol.extensions import db
+from ukbol.model import (
+    BinSummary,
+    DataSourceStatus,
+    ExportJob,
+    Specimen,
+    SpecimenDetail,
+    Taxon,
+)
+from ukbol.schema import (
+    DataSourceStatusSchema,
+    ExportJobSchema,
+    SpecimenSchema,
+    TaxonBinSchema,
+    TaxonSchema,
+    TaxonSuggestionSchema,
+)
+from ukbol.serialisers import FastJSONProvider, LeanSerialiser
+
+
+def assert_parity(schema: Schema, objects: list):
+    assert objects
+    serialiser = LeanSerialiser(schema)
+    expected = json.dumps(schema.dump(objects, many=True), sort_keys=True)
+    assert json.dumps(serialiser.dump(objects, many=True), sort_keys=True) == expected
+    for obj in objects:
+        expected = json.dumps(schema.dump(obj), sort_keys=True)
+        assert json.dumps(serialiser.dump(obj), sort_keys=True) == expected
+
+
+class TestLeanSerialiserParity:
+    def test_specimens(self, app: Flask):
+        taxon = Taxon.get("BMSSYS0000000015")
+        create_specimens(taxon, 4, 3, 9)
+        specimens = db.session.scalars(db.select(Specimen)).all()
+        # include some specimens with missing values
+        specimens.append(Specimen(id=1, detail=SpecimenDetail(nuc="ACGT")))
+        specimens.append(Specimen(id=2, identification="vespa crabro"))
+        assert_parity(SpecimenSchema(), specimens)
+
+    def test_taxa(self, app: Flask):
+        taxa = db.session.scalars(db.select(Taxon)).all()
+        assert_parity(TaxonSchema(), taxa)
+        assert_parity(TaxonSuggestionSchema(), taxa)
+
+    def test_bin_summaries(self, app: Flask):
+        assert_parity(TaxonBinSchema(), db.session.scalars(db.select(BinSummary)).all())
+
+    def test_statuses(self, app: Flask):
+        update_status("test", 10, "v1", added=1, updated=2, removed=3)
+        statuses = db.session.scalars(db.select(DataSourceStatus)).all()
+        assert_parity(DataSourceStatusSchema(), statuses)
+
+    def test_export_jobs(self, app: Flask, tmp_path):
+        app.config["EXPORT_DIR"] = str(tmp_path)
+        job = ExportJob(
+            id="abc",
+            taxon_id="BMSSYS0000000015",
+            format="csv",
+            include_descendants=False,
+            data_version="v1",
+            status="complete",
+            file_name="test.csv",
+            created_at=datetime.now(timezone.utc),
+            completed_at=datetime.now(timezone.utc),
+            size=10,
+        )
+        db.session.add(job)
+        db.session.commit()
+        assert_parity(ExportJobSchema(), [job])
+
+    def test_unsupported(self):
+        class TestSchema(Schema):
+            value = fields.Decimal()
+
+        with pytest.raises(TypeError):
+            LeanSerialiser(TestSchema())
+
+
+@dataclass
+class Thing:
+    name: str
+    when: date
+
+
+class TestFastJSONProvider:
+    def test_same_values(self, app: Flask):
+        data = {
+            "b": [1, 2.5, None, True, "ascii", "naïve"],
+            "a": {
+                "when": datetime(2025, 1, 2, 3, 4, 5),
+                "thing": Thing("x", date.today()),
+            },
+            "c": (1, 2),
+        }
+        fast = FastJSONProvider(app).response(data)
+        default = DefaultJSONProvider(app).response(data)
+        assert json.loads(fast.get_data()) == json.loads(default.get_data())
+
+    @pytest.mark.parametrize("path", ["", "/associated_specimens"])
+    def test_same_response(self, client, path: str):
+        taxon = Taxon.get("BMSSYS0000000015")
+        specimens, _ = create_specimens(taxon, 4, 3, 9)
+        # make sure there are characters which need escaping in the data
+        taxon.authorship = "(Müller, 1850)"
+        specimens[0].detail.notes = "Zürich, 日本 🐝"
+        db.session.commit()
+        data = client.get(f"/api/taxon/{taxon.id}{path}").json
+        with client.application.app_context():
+            fast = FastJSONProvider(client.application).response(data)
+            default = DefaultJSONProvider(client.application).response(data)
+        assert b"\\u00fc" in default.get_data()
+        assert fast.get_data() == default.get_data()
+
+    def test_same_dumps(self, app: Flask):
+        data = {"name": "Müller 🐝", "values": [1, 2.5, "日本"]}
+        fast = FastJSONProvider(app)
+        default = DefaultJSONProvider(app)
+        assert fast.dumps(data) == default.dumps(data)
@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+from typing import Iterator
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from sqlalchemy import event
+
+from ukbol.data.utils import update_status
+from ukbol.extensions import db
+from ukbol.model import Taxon
+from ukbol.taxonomy import (
+    TaxonomySnapshot,
+    clear_taxonomy_snapshot,
+    get_taxonomy_snapshot,
+)
+
+
+@pytest.fixture
+def snapshot_app(app: Flask) -> Flask:
+    app.config["TAXONOMY_CACHE"] = True
+    app.config["TAXONOMY_CACHE_CHECK_INTERVAL"] = 0
+    clear_taxonomy_snapshot()
+    yield app
+    clear_taxonomy_snapshot()
+
+
+@contextmanager
+def count_queries() -> Iterator[list[str]]:
+    statements = []
+
+    def listener(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", listener)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", listener)
+
+
+def test_disabled(app: Flask):
+    assert get_taxonomy_snapshot() is None
+
+
+def test_snapshot_structure(snapshot_app: Flask):
+    snapshot = get_taxonomy_snapshot()
+    assert len(snapshot) == Taxon.query.count()
+    for taxon in Taxon.query.all():
+        assert taxon.id in snapshot
+        assert snapshot.dump(snapshot.index[taxon.id])["parent"] == taxon.parent_id
+    assert "nope" not in snapshot
+
+
+class TestEndpoints:
+    def compare(self, client: FlaskClient, url: str, app: Flask):
+        app.config["TAXONOMY_CACHE"] = False
+        db_response = client.get(url)
+        app.config["TAXONOMY_CACHE"] = True
+        snapshot_response = client.get(url)
+        assert db_response.status_code == snapshot_response.status_code
+        return db_response.json, snapshot_response.json
+
+    def test_roots(self, snapshot_app: Flask):
+        client = snapshot_app.test_client()
+        db_json, snapshot_json = self.compare(client, "/api/taxon/roots", snapshot_app)
+        assert sorted(db_json, key=lambda t: t["id"]) == sorted(
+            snapshot_json, key=lambda t: t["id"]
+        )
+
+    def test_ranks(self, snapshot_app: Flask):
+        client = snapshot_app.test_client()
+        db_json, snapshot_json = self.compare(client, "/api/taxon/ranks", snapshot_app)
+        assert sorted(db_json) == snapshot_json
+
+    @pytest.mark.parametrize(
+        "taxon_id", ["NHMSYS0020535450", "BMSSYS0000000010", "BMSSYS0000000001"]
+    )
+    def test_children(self, snapshot_app: Flask, taxon_id: str):
+        client = snapshot_app.test_client()
+        db_json, snapshot_json = self.compare(
+            client, f"/api/taxon/{taxon_id}/children", snapshot_app
+        )
+        assert db_json == snapshot_json
+
+    @pytest.mark.parametrize(
+        "taxon_id", ["NHMSYS0020535450", "BMSSYS0000000010", "BMSSYS0000000001"]
+    )
+    def test_parents(self, snapshot_app: Flask, taxon_id: str):
+        client = snapshot_app.test_client()
+        db_json, snapshot_json = self.compare(
+            client, f"/api/taxon/{taxon_id}/parents", snapshot_app
+        )
+        assert db_json == snapshot_json
+
+    def test_404(self, snapshot_app: Flask):
+        client = snapshot_app.test_client()
+        assert client.get("/api/taxon/nope/children").status_code == 404
+        assert client.get("/api/taxon/nope/parents").status_code == 404
+
+
+def test_no_queries(snapshot_app: Flask):
+    snapshot_app.config["TAXONOMY_CACHE_CHECK_INTERVAL"] = 60
+    client = snapshot_app.test_client()
+    # load the snapshot
+    client.get("/api/taxon/roots")
+
+    with count_queries() as statements:
+        client.get("/api/taxon/roots")
+        client.get("/api/taxon/ranks")
+        client.get("/api/taxon/NHMSYS0020535450/children")
+        client.get("/api/taxon/BMSSYS0000000001/parents")
+    assert statements == []
+
+
+def test_invalidation(snapshot_app: Flask):
+    snapshot = get_taxonomy_snapshot()
+    assert get_taxonomy_snapshot() is snapshot
+
+    # a new uksi-taxa status should cause the snapshot to be reloaded
+    update_status("uksi-taxa", Taxon.query.count())
+    new_snapshot = get_taxonomy_snapshot()
+    assert new_snapshot is not snapshot
+    assert isinstance(new_snapshot, TaxonomySnapshot)
+    assert new_snapshot.version > snapshot.version
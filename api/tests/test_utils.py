@@ -1,4 +1,13 @@
-from ukbol.utils import log
+import pytest
+
+from ukbol.utils import (
+    PhaseTimer,
+    decode_cursor,
+    encode_cursor,
+    log,
+    parse_bool,
+    parse_list,
+)
 
 
 def test_log(capsys):
@@ -6,3 +15,52 @@ def test_log(capsys):
     log(message)
     logged_text = capsys.readouterr().out
     assert logged_text.endswith(f"{message}\n")
+
+
+def test_parse_bool():
+    for value in ["true", "True", "1", "yes", "on", " TRUE "]:
+        assert parse_bool(value)
+    for value in ["false", "0", "no", "", "beans"]:
+        assert not parse_bool(value)
+
+
+def test_parse_list():
+    assert parse_list("a,b,c") == ["a", "b", "c"]
+    assert parse_list(" a , b,, c ,") == ["a", "b", "c"]
+    assert parse_list("") == []
+
+
+class TestCursors:
+    def test_round_trip(self):
+        values = ["vespa crabro", 1234, None]
+        cursor = encode_cursor(values)
+        assert "=" not in cursor
+        assert decode_cursor(cursor) == values
+
+    @pytest.mark.parametrize("cursor", ["!!!", "bm9wZQ", encode_cursor({"a": 1})])
+    def test_invalid(self, cursor: str):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
+
+
+class TestPhaseTimer:
+    def test_phases(self, capsys):
+        timer = PhaseTimer()
+        with timer.phase("first"):
+            pass
+        with pytest.raises(ValueError):
+            with timer.phase("second"):
+                raise ValueError()
+
+        assert list(timer.timings) == ["first", "second"]
+        assert all(seconds >= 0 for seconds in timer.timings.values())
+        assert "first took" in capsys.readouterr().out
+
+    def test_report(self, capsys):
+        timer = PhaseTimer()
+        timer.timings = {"first": 1.5, "second": 2.25}
+        timer.report()
+        logged_text = capsys.readouterr().out
+        assert "first: 1.50 seconds" in logged_text
+        assert "second: 2.25 seconds" in logged_text
+        assert "Total: 3.75 seconds" in logged_text
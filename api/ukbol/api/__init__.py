@@ -1,9 +1,10 @@
 from flask import Flask
 
-from ukbol.api import status, taxon
+from ukbol.api import exports, status, taxon
 
 
 def bind_api_routes(app: Flask):
     url_prefix = "/api"
     app.register_blueprint(status.blueprint, url_prefix=url_prefix)
     app.register_blueprint(taxon.blueprint, url_prefix=url_prefix)
+    app.register_blueprint(exports.blueprint, url_prefix=url_prefix)
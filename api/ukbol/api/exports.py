@@ -0,0 +1,78 @@
+from flask import Blueprint, abort, request, send_file
+
+from ukbol.api.taxon import validate_taxon_id
+from ukbol.export import EXPORT_FORMATS, get_available_formats
+from ukbol.export_jobs import create_export_job, get_export_path
+from ukbol.extensions import db
+from ukbol.model import ExportJob, Taxon
+from ukbol.schema import ExportJobSchema
+from ukbol.utils import parse_bool
+
+blueprint = Blueprint("exports_api", __name__)
+
+export_job_schema = ExportJobSchema()
+
+
+@blueprint.post("/taxon/<taxon_id>/exports")
+@validate_taxon_id
+def create_export(taxon: Taxon):
+    """
+    Given a taxon_id as part of the path, creates a job to export the specimens
+    associated with the taxon to a file in the background. This should be used instead
+    of the download/specimens endpoint for taxa with lots of specimens. The format and
+    include_descendants parameters are the same as the download/specimens endpoint's.
+
+    If an export of the taxon with the same options has already been made from the
+    current data, the existing job is returned instead of creating a new one. The
+    response status is 200 if the returned job is complete and 202 if it isn't yet.
+    Use the exports/<job_id> endpoint to check the job's status and the
+    exports/<job_id>/download endpoint to download the file once it is complete.
+
+    :param taxon: the Taxon object, retrieved via the validate_taxon_id decorator
+    :return: the ExportJob, serialised as JSON
+    """
+    include_descendants = request.args.get(
+        "include_descendants", False, type=parse_bool
+    )
+    export_format = request.args.get("format", "csv", type=str)
+    if export_format not in get_available_formats():
+        abort(400, f"format must be one of {', '.join(get_available_formats())}")
+
+    job = create_export_job(taxon, export_format, include_descendants)
+    return export_job_schema.dump(job), 200 if job.status == "complete" else 202
+
+
+@blueprint.get("/exports/<job_id>")
+def get_export(job_id: str):
+    """
+    Given a job_id as part of the path, returns the ExportJob with that ID. If the job
+    doesn't exist, a 404 is raised.
+
+    :param job_id: the ExportJob's ID
+    :return: the ExportJob, serialised as JSON
+    """
+    return export_job_schema.dump(db.get_or_404(ExportJob, job_id))
+
+
+@blueprint.get("/exports/<job_id>/download")
+def download_export(job_id: str):
+    """
+    Given a job_id as part of the path, returns the ExportJob's file. If the job doesn't
+    exist, or its file has been removed, a 404 is raised. If the job isn't complete yet,
+    a 409 is raised.
+
+    :param job_id: the ExportJob's ID
+    :return: the export file
+    """
+    job = db.get_or_404(ExportJob, job_id)
+    if job.status != "complete":
+        abort(409, f"Export is {job.status}")
+    path = get_export_path(job)
+    if not path.exists():
+        abort(404)
+    return send_file(
+        path,
+        mimetype=EXPORT_FORMATS[job.format].mimetype,
+        as_attachment=True,
+        download_name=job.file_name,
+    )
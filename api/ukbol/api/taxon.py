@@ -1,32 +1,47 @@
-import csv
-import io
-from collections import Counter
-from dataclasses import dataclass
 from functools import wraps
-from itertools import batched, groupby
-from typing import Iterator
 
-from flask import Blueprint, Response, request, stream_with_context
-from sqlalchemy.orm import aliased
+from flask import Blueprint, Response, abort, request, stream_with_context
+from sqlalchemy.orm import selectinload
 
-from ukbol.bins import get_associated_specimens_select, iter_associated_specimens
+from ukbol.bins import (
+    count_associated_specimens,
+    get_associated_specimens_page_select,
+    get_associated_specimens_select,
+    get_containing_bins_select,
+)
+from ukbol.cache import cached_response
+from ukbol.export import EXPORT_FORMATS, get_available_formats
 from ukbol.extensions import db
-from ukbol.model import Specimen, Taxon
+from ukbol.model import BinSummary, Specimen, Taxon
 from ukbol.schema import (
     SpecimenSchema,
     TaxonBinSchema,
     TaxonSchema,
     TaxonSuggestionSchema,
 )
-from ukbol.utils import clamp
+from ukbol.serialisers import LeanSerialiser
+from ukbol.suggestions import get_suggestions_select
+from ukbol.taxonomy import TaxonomySnapshot, taxonomy_snapshot
+from ukbol.utils import clamp, decode_cursor, encode_cursor, parse_bool, parse_list
 
 blueprint = Blueprint("taxon_api", __name__)
 
-# create the schemas we're going to use to build JSON responses
-taxon_schema = TaxonSchema()
-specimen_schema = SpecimenSchema()
-suggestion_schema = TaxonSuggestionSchema()
-taxon_bin_schema = TaxonBinSchema()
+# create the serialisers we're going to use to build JSON responses, these produce the
+# same output as the schemas they're created from but are a lot quicker
+taxon_serialiser = LeanSerialiser(TaxonSchema())
+specimen_serialiser = LeanSerialiser(SpecimenSchema())
+suggestion_serialiser = LeanSerialiser(TaxonSuggestionSchema())
+taxon_bin_serialiser = LeanSerialiser(TaxonBinSchema())
+
+# loader options for the relationships dumped by the TaxonSchema, these load them for
+# all the taxa in a list at once instead of lazy loading them one taxon at a time. Only
+# the IDs of the children are dumped so that's all we load of them. The parents aren't
+# loaded as the lists are either of root taxa, which don't have one, or of the children
+# of a taxon we already have in the session
+taxon_schema_options = (
+    selectinload(Taxon.children).load_only(Taxon.id),
+    selectinload(Taxon.synonyms),
+)
 
 
 def validate_taxon_id(func):
@@ -51,6 +66,8 @@ def validate_taxon_id(func):
 
 
 @blueprint.get("/taxon/roots")
+@cached_response()
+@taxonomy_snapshot(TaxonomySnapshot.get_roots)
 def get_roots():
     """
     Returns a list of the root Taxon objects in the taxonomy, these are ones that have
@@ -58,15 +75,23 @@ def get_roots():
     loader which specifically trims the parents to just the 4 kingdoms we want:
     Animalia, Chromista, Fungi, and Plantae.
 
+    This, and the other taxonomy navigation endpoints, are served from the in-memory
+    taxonomy snapshot if it is enabled (see ukbol.taxonomy). The responses of all the
+    JSON endpoints here are cached if the response cache is enabled (see ukbol.cache).
+
     :return: a list of Taxon serialised objects
     """
-    return taxon_schema.dump(
-        db.session.scalars(db.select(Taxon).filter(Taxon.parent_id.is_(None))).all(),
-        many=True,
+    select = (
+        db.select(Taxon)
+        .filter(Taxon.parent_id.is_(None))
+        .options(*taxon_schema_options)
     )
+    return taxon_serialiser.dump(db.session.scalars(select).all(), many=True)
 
 
 @blueprint.get("/taxon/ranks")
+@cached_response()
+@taxonomy_snapshot(TaxonomySnapshot.get_ranks)
 def get_ranks():
     """
     Returns a list of the available taxon ranks in the taxonomy.
@@ -77,29 +102,32 @@ def get_ranks():
 
 
 @blueprint.get("/taxon/suggest")
+@cached_response("query", "size", "ranks", "ignore_ranks")
 def get_suggestions():
     """
-    Given a query parameter, returns a list of suggested names from the taxonomy that
-    match the query. Names are matched just using a full wildcard query so the matching
-    isn't particularly sophisticated. A size parameter is available to limit the number
-    of results (min 1, max 20). Use ignore_ranks to exclude taxa with ranks in the given
-    comma-separated list of ranks from the results.
+    Given a query parameter, returns a list of suggested taxa from the taxonomy that
+    match the query. The query is matched anywhere in the taxa's names and their
+    synonyms' names, with exact and prefix matches ranked first (see the
+    get_suggestions_select function for details). A size parameter is available to
+    limit the number of results (min 1, max 20). Use ranks to only include taxa with
+    ranks in the given comma-separated list of ranks, and use ignore_ranks to exclude
+    taxa with ranks in the given comma-separated list of ranks from the results.
 
     :return: a list of suggested taxa
     """
     query = request.args.get("query", "", type=str)
     size = clamp(request.args.get("size", 10, type=int), 1, 20)
+    ranks = request.args.get("ranks", None, type=parse_list)
+    ignore_ranks = request.args.get("ignore_ranks", None, type=parse_list)
 
-    select = db.select(Taxon)
-    if query:
-        select = select.filter(Taxon.name.ilike(f"%{query}%"))
+    select = get_suggestions_select(query, ranks, ignore_ranks)
+    result = db.session.scalars(select.limit(size))
 
-    result = db.session.scalars(select.order_by(Taxon.name).limit(size))
-
-    return suggestion_schema.dump(result.all(), many=True)
+    return suggestion_serialiser.dump(result.all(), many=True)
 
 
 @blueprint.get("/taxon/<taxon_id>")
+@cached_response()
 @validate_taxon_id
 def get_taxon(taxon: Taxon):
     """
@@ -109,10 +137,12 @@ def get_taxon(taxon: Taxon):
     :param taxon: the Taxon object, retrieved via the validate_taxon_id decorator
     :return: a Taxon object, serialised as a JSON
     """
-    return taxon_schema.dump(taxon)
+    return taxon_serialiser.dump(taxon)
 
 
 @blueprint.get("/taxon/<taxon_id>/children")
+@cached_response()
+@taxonomy_snapshot(TaxonomySnapshot.get_children)
 @validate_taxon_id
 def get_taxon_children(taxon: Taxon):
     """
@@ -126,12 +156,19 @@ def get_taxon_children(taxon: Taxon):
     :param taxon: the Taxon object, retrieved via the validate_taxon_id decorator
     :return: a list of child Taxon objects, serialised as a JSON
     """
-    select = db.select(Taxon).filter_by(parent_id=taxon.id)
-    result = db.session.scalars(select.order_by(Taxon.name))
-    return taxon_schema.dump(result.all(), many=True)
+    select = (
+        db.select(Taxon)
+        .filter_by(parent_id=taxon.id)
+        .options(*taxon_schema_options)
+        .order_by(Taxon.name)
+    )
+    result = db.session.scalars(select)
+    return taxon_serialiser.dump(result.all(), many=True)
 
 
 @blueprint.get("/taxon/<taxon_id>/parents")
+@cached_response()
+@taxonomy_snapshot(TaxonomySnapshot.get_parents)
 @validate_taxon_id
 def get_taxon_parents(taxon: Taxon):
     """
@@ -144,17 +181,22 @@ def get_taxon_parents(taxon: Taxon):
     provided taxon is not included in the list. If the taxon doesn't have any parents,
     an empty list is returned.
 
+    The parents are found using the taxon's nested set interval, the ancestors of a
+    taxon are all the taxa with intervals which contain the taxon's interval.
+
     :param taxon: the Taxon object, retrieved via the validate_taxon_id decorator
     :return: a list of parent Taxon IDs, serialised as a JSON
     """
-    base_query = Taxon.query.filter(Taxon.id == taxon.id).cte(recursive=True)
-    base_alias = aliased(base_query)
-    join_query = Taxon.query.join(base_alias, Taxon.id == base_alias.c.parent_id)
-    recursive_query = base_query.union(join_query)
-    return [row[0] for row in db.session.query(recursive_query).all()][1:]
+    select = (
+        db.select(Taxon.id)
+        .filter(Taxon.lft < taxon.lft, Taxon.rgt > taxon.rgt)
+        .order_by(Taxon.lft.desc())
+    )
+    return db.session.scalars(select).all()
 
 
 @blueprint.get("/taxon/<taxon_id>/associated_specimens")
+@cached_response("include_descendants", "page", "per_page", "cursor", "count")
 @validate_taxon_id
 def get_taxon_associated_specimens(taxon: Taxon):
     """
@@ -162,96 +204,147 @@ def get_taxon_associated_specimens(taxon: Taxon):
     finds the specimens in those BINs and returns them.
 
     Paging can be achieved using the "page" and "per_page" parameters. The results are
-    ordered by name and ID ascending.
+    ordered by name and ID ascending. Use include_descendants=true to also include the
+    specimens in the BINs of all the taxa below this taxon in the taxonomy.
+
+    For large sets of specimens, use the "cursor" parameter instead of "page". Pass an
+    empty cursor to get the first page and then the "next" value from each response to
+    get the page after it, until "next" is null. Unlike page, the total count isn't
+    worked out for every request and the earlier specimens aren't counted past, but the
+    database still has to sort all the matching specimens to find each page. The total
+    count is only included in cursor responses when count=true is passed, it is cached
+    so passing it with every page is fine.
 
     :param taxon: the Taxon object, retrieved via the validate_taxon_id decorator
     :return: a list of Specimen objects, serialised as a JSON
     """
-    select = get_associated_specimens_select(taxon).order_by(
+    include_descendants = request.args.get(
+        "include_descendants", False, type=parse_bool
+    )
+    if "cursor" in request.args:
+        return get_associated_specimens_by_cursor(taxon, include_descendants)
+
+    select = get_associated_specimens_select(taxon, include_descendants).order_by(
         Specimen.identification, Specimen.id
     )
     page = db.paginate(select)
     return {
         "count": page.total,
-        "specimens": specimen_schema.dump(page.items, many=True),
+        "specimens": specimen_serialiser.dump(page.items, many=True),
     }
 
 
-@dataclass
-class BINSummary:
-    bin: str
-    count: int
-    uk_count: int
-    names: list[tuple[str, int]]
+def get_associated_specimens_by_cursor(taxon: Taxon, include_descendants: bool) -> dict:
+    """
+    Returns a page of the specimens associated with the given taxon using keyset
+    pagination (see ukbol.bins.get_associated_specimens_page_select). The cursor
+    parameter holds the identification and ID of the last specimen on the previous
+    page, or is empty for the first page.
+
+    :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: a dict containing the page of serialised specimens and the next cursor
+    """
+    per_page = clamp(request.args.get("per_page", 20, type=int), 1, 100)
+    after = None
+    if cursor := request.args.get("cursor", "", type=str):
+        try:
+            identification, specimen_id = decode_cursor(cursor)
+        except ValueError:
+            abort(400, "Invalid cursor")
+        # bools are ints too, so check the id's type exactly
+        if not isinstance(identification, str | None) or type(specimen_id) is not int:
+            abort(400, "Invalid cursor")
+        after = (identification, specimen_id)
+
+    select = get_associated_specimens_page_select(taxon, include_descendants, after)
+    # get one more than we need to find out if there's another page
+    specimens = db.session.scalars(select.limit(per_page + 1)).all()
+    next_cursor = None
+    if len(specimens) > per_page:
+        specimens = specimens[:per_page]
+        last = specimens[-1]
+        next_cursor = encode_cursor([last.identification, last.id])
+
+    result = {
+        "specimens": specimen_serialiser.dump(specimens, many=True),
+        "next": next_cursor,
+    }
+    if request.args.get("count", False, type=parse_bool):
+        result["count"] = count_associated_specimens(taxon, include_descendants)
+    return result
 
 
 @blueprint.get("/taxon/<taxon_id>/bin_summaries")
+@cached_response("include_descendants")
 @validate_taxon_id
 def get_taxon_bins(taxon: Taxon):
     """
     Given a taxon_id as part of the path, matches BOLD specimens with the same taxon
-    name, groups them by their assigned BIN and then returns a list of all BINs in
-    descending count order with summary details about counts etc.
+    name, finds the BINs they are assigned to and then returns a list of all these BINs
+    in descending count order with summary details about counts etc.
 
     The BOLD specimens are matched in the local database using a direct lowercase string
-    match currently. All synonyms of the taxon are also used during matching.
+    match currently. All synonyms of the taxon are also used during matching. The
+    summaries themselves are precomputed for every BIN when the BOLD data is loaded so
+    the cost of this is related to the number of BINs, not the number of specimens.
+
+    Use include_descendants=true to also include the BINs of all the taxa below this
+    taxon in the taxonomy.
 
     :param taxon: the Taxon object, retrieved via the validate_taxon_id decorator
     :return: a list of JSON objects summarising a single BIN
     """
-    bins = []
-    for bin_uri, specimens in groupby(
-        iter_associated_specimens(taxon), lambda s: s.bin_uri
-    ):
-        count = 0
-        uk_count = 0
-        names = Counter()
-        for specimen in specimens:
-            count += 1
-            if specimen.country_iso == "GB":
-                uk_count += 1
-            names[specimen.identification] += 1
-
-        bins.append(BINSummary(bin_uri, count, uk_count, names.most_common()))
-
-    # return sorted by specimen count
-    return taxon_bin_schema.dump(
-        sorted(bins, key=lambda taxon_bin: taxon_bin.count, reverse=True), many=True
+    include_descendants = request.args.get(
+        "include_descendants", False, type=parse_bool
     )
+    bins = get_containing_bins_select(taxon, include_descendants)
+    select = (
+        db.select(BinSummary)
+        .filter(BinSummary.bin_uri.in_(bins))
+        # return sorted by specimen count
+        .order_by(BinSummary.count.desc(), BinSummary.bin_uri)
+    )
+    return taxon_bin_serialiser.dump(db.session.scalars(select).all(), many=True)
 
 
 @blueprint.get("/taxon/<taxon_id>/download/specimens")
 @validate_taxon_id
 def download_specimens(taxon: Taxon) -> Response:
     """
-    Download the taxon bin data as a CSV file. This is done synchronously because the
-    number of specimens is likely not to be that large but if this becomes a burden it
-    should be changed to something asynchronous. The data is streamed in chunks to avoid
-    building up lots of rows in memory.
+    Download the specimens associated with the taxon as a file. The file is streamed
+    straight through to the response as it is produced so the specimens are never all
+    held in memory here. Use include_descendants=true to also include the specimens in
+    the BINs of all the taxa below this taxon in the taxonomy. For taxa with lots of
+    specimens, use the exports endpoints to create the file in the background instead
+    (see ukbol.api.exports).
+
+    The format parameter selects the type of file produced:
+
+        - csv (the default): a CSV file with the same columns as the specimens returned
+          by the associated_specimens endpoint, produced by the database using COPY
+        - csv.gz: the same CSV file, gzipped
+        - parquet: a parquet file with the same columns as the CSV, streamed a row
+          group at a time. This requires pyarrow, which is an optional dependency
+        - fasta: the specimens' sequences in FASTA format
 
     :param taxon: the Taxon object, retrieved via the validate_taxon_id decorator
-    :return: a streamed CSV response
+    :return: a streamed file response
     """
-
-    def iter_rows() -> Iterator[str]:
-        header_written = False
-
-        for batch in batched(iter_associated_specimens(taxon), 1000):
-            rows = specimen_schema.dump(batch, many=True)
-            data = io.StringIO()
-            writer = csv.DictWriter(data, rows[0].keys())
-            if not header_written:
-                writer.writeheader()
-                header_written = True
-            writer.writerows(rows)
-            yield data.getvalue()
+    include_descendants = request.args.get(
+        "include_descendants", False, type=parse_bool
+    )
+    export_format = EXPORT_FORMATS.get(request.args.get("format", "csv", type=str))
+    if export_format is None or not export_format.available:
+        abort(400, f"format must be one of {', '.join(get_available_formats())}")
 
     # use the taxon name in the filename
-    filename = f"{taxon.name.replace(' ', '_')}_specimens.csv"
+    filename = f"{taxon.name.replace(' ', '_')}_specimens.{export_format.extension}"
     headers = {
-        "Content-type": "text/csv",
+        "Content-type": export_format.mimetype,
         "Content-Disposition": f"attachment; filename={filename}",
     }
-    # stream the rows so that we don't have to buffer the whole lot in memory first. The
+    data = export_format.exporter(taxon, include_descendants)
+    # stream the data so that we don't have to buffer the whole lot in memory first. The
     # generator needs the request context for the database
-    return Response(stream_with_context(iter_rows()), headers=headers)
+    return Response(stream_with_context(data), headers=headers)
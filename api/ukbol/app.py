@@ -2,6 +2,7 @@ from flask import Flask
 
 from ukbol.api import bind_api_routes
 from ukbol.extensions import db, ma, migrate
+from ukbol.serialisers import FastJSONProvider
 
 
 def create_app() -> Flask:
@@ -11,6 +12,8 @@ def create_app() -> Flask:
     :return: the Flask application object
     """
     app = Flask(__name__)
+    # use orjson for JSON responses, if it's installed
+    app.json = FastJSONProvider(app)
 
     # setup the config from env vars
     app.config.from_prefixed_env()
@@ -1,56 +1,237 @@
-from typing import Iterator
+from collections import OrderedDict
+from threading import Lock
+from typing import Iterable, Iterator
 
-from sqlalchemy import Select
+from sqlalchemy import ColumnElement, Row, Select, or_, tuple_
+from sqlalchemy.orm import selectinload
 
+from ukbol.data.utils import TAXON_DATA_SOURCES, get_data_version
 from ukbol.extensions import db
-from ukbol.model import Specimen, Taxon
+from ukbol.model import Specimen, SpecimenDetail, Taxon, TaxonBin
 
+# the number of specimens fetched from the database at a time when iterating over them
+YIELD_PER = 1000
+# the number of associated specimen counts to keep in memory
+COUNT_CACHE_SIZE = 10_000
 
-def get_containing_bins(taxon: Taxon) -> set[str]:
+# (data version, taxon ID, include_descendants) -> associated specimen count, and a lock
+# to protect it
+_counts: OrderedDict[tuple[str, str, bool], int] = OrderedDict()
+_counts_lock = Lock()
+
+
+def get_containing_bins_select(
+    taxon: Taxon, include_descendants: bool = False
+) -> Select:
     """
-    Given a taxa, find all the BINs its name appears in and return them as a set.
+    Given a taxa, return a select which will find all the BINs its name, or the name of
+    any of its synonyms, appears in. The links between taxa and BINs are precomputed
+    when the data is loaded (see ukbol.data.bins.rebuild_taxon_bins) so this is just a
+    lookup.
+
+    If include_descendants is True, the BINs of all the taxa below the given taxon in
+    the taxonomy are included too. The descendants are found using the taxon's nested
+    set interval so this is still a single query.
+
+    The select can be used as a subquery to filter on the BINs in the database. Higher
+    taxa can have far more BINs than can be sent back to the database as parameters so
+    the BINs should be filtered on this way rather than fetched first.
 
     :param taxon: the taxon to look up
-    :return: a set of BIN URIs
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: a select statement to find the BIN URIs
+    """
+    select = db.select(TaxonBin.bin_uri).distinct()
+    if include_descendants:
+        select = select.join(Taxon, Taxon.id == TaxonBin.taxon_id).filter(
+            Taxon.lft.between(taxon.lft, taxon.rgt)
+        )
+    else:
+        select = select.filter(TaxonBin.taxon_id == taxon.id)
+    return select
+
+
+def get_containing_bins(taxon: Taxon, include_descendants: bool = False) -> set[str]:
     """
-    # gather up all the names this taxon has
-    names = {taxon.name}
-    names.update(synonym.name for synonym in taxon.synonyms)
+    Given a taxa, find all the BINs its name, or the name of any of its synonyms,
+    appears in and return them as a set (see get_containing_bins_select).
 
-    # find the BINs associated with the found names (ignore None BIN URIs)
+    :param taxon: the taxon to look up
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: a set of BIN URIs
+    """
     return set(
-        db.session.scalars(
-            db.select(Specimen.bin_uri)
-            .distinct()
-            # todo: should we also match on rank?
-            .filter(Specimen.identification.in_(names))
-            .filter(Specimen.bin_uri.isnot(None))
-        )
+        db.session.scalars(get_containing_bins_select(taxon, include_descendants))
     )
 
 
-def get_associated_specimens_select(taxon: Taxon) -> Select:
+def get_associated_specimens_select(
+    taxon: Taxon, include_descendants: bool = False
+) -> Select:
     """
     Given a taxon, return a select which will find all specimens in the BINs associated
-    with that taxon. This is achieved by first finding the BINs using the
-    get_containing_bins function above and then returning a select based on those BINs.
+    with that taxon. The BINs are found in the database using the select from the
+    get_containing_bins_select function above.
+    The specimens' details are loaded alongside them in a single extra query as they
+    are always serialised with the specimens.
 
     :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
     :return: a select statement to find associated specimens
     """
-    distinct_bins = get_containing_bins(taxon)
-    return db.select(Specimen).filter(Specimen.bin_uri.in_(distinct_bins))
+    bins = get_containing_bins_select(taxon, include_descendants)
+    return (
+        db.select(Specimen)
+        .filter(Specimen.bin_uri.in_(bins))
+        .options(selectinload(Specimen.detail))
+    )
+
+
+def get_associated_specimens_page_select(
+    taxon: Taxon,
+    include_descendants: bool = False,
+    after: tuple[str | None, int] | None = None,
+) -> Select:
+    """
+    Given a taxon, return a select which will find the specimens in the BINs associated
+    with that taxon (see get_associated_specimens_select) in identification and ID
+    order, starting after the specimen with the given identification and ID. This is
+    keyset pagination: unlike an offset, the earlier specimens are filtered out rather
+    than produced and thrown away. The specimens are spread over many BINs though, so no
+    index can give them in this order and the database still gathers and sorts all the
+    remaining matching specimens to find each page. Specimens without an identification
+    come last.
+
+    :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :param after: the identification and ID of the last specimen on the previous page,
+                  or None to start from the beginning
+    :return: a select statement to find a page of associated specimens
+    """
+    select = get_associated_specimens_select(taxon, include_descendants).order_by(
+        Specimen.identification, Specimen.id
+    )
+    if after is not None:
+        identification, specimen_id = after
+        if identification is None:
+            select = select.filter(
+                Specimen.identification.is_(None), Specimen.id > specimen_id
+            )
+        else:
+            select = select.filter(
+                or_(
+                    tuple_(Specimen.identification, Specimen.id)
+                    > (identification, specimen_id),
+                    Specimen.identification.is_(None),
+                )
+            )
+    return select
+
+
+def count_associated_specimens(taxon: Taxon, include_descendants: bool = False) -> int:
+    """
+    Given a taxon, return the number of specimens in the BINs associated with that
+    taxon. Counting is as expensive as finding all the specimens so the counts are
+    cached in memory until the data they were counted from changes.
 
+    :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: the number of associated specimens
+    """
+    key = (get_data_version(TAXON_DATA_SOURCES), taxon.id, include_descendants)
+    with _counts_lock:
+        count = _counts.get(key)
+        if count is not None:
+            _counts.move_to_end(key)
+            return count
+
+    bins = get_containing_bins_select(taxon, include_descendants)
+    count = db.session.scalar(
+        db.select(db.func.count())
+        .select_from(Specimen)
+        .filter(Specimen.bin_uri.in_(bins))
+    )
+
+    with _counts_lock:
+        _counts[key] = count
+        while len(_counts) > COUNT_CACHE_SIZE:
+            _counts.popitem(last=False)
+    return count
+
+
+def clear_count_cache():
+    """
+    Removes all the cached associated specimen counts.
+    """
+    with _counts_lock:
+        _counts.clear()
+
+
+def get_associated_specimen_rows_select(
+    taxon: Taxon,
+    columns: Iterable[ColumnElement],
+    include_descendants: bool = False,
+) -> Select:
+    """
+    Given a taxon, return a select which will find the given columns of all specimens in
+    the BINs associated with that taxon. This is the same as the select returned by
+    get_associated_specimens_select except that only the given columns are loaded, and
+    the rows are returned as tuples rather than as Specimen objects. Columns from the
+    SpecimenDetail table can be included, in which case the details are joined in.
 
-def iter_associated_specimens(taxon: Taxon) -> Iterator[Specimen]:
+    :param taxon: the Taxon object
+    :param columns: the Specimen and SpecimenDetail columns to select
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: a select statement to find the associated specimens' values
+    """
+    bins = get_containing_bins_select(taxon, include_descendants)
+    select = (
+        db.select(*columns).select_from(Specimen).filter(Specimen.bin_uri.in_(bins))
+    )
+    # the columns could be labelled or wrapped in expressions so check the froms they
+    # bring with them rather than the columns themselves
+    if SpecimenDetail.__table__ in select.get_final_froms():
+        select = select.outerjoin(Specimen.detail)
+    return select
+
+
+def iter_associated_specimens(
+    taxon: Taxon, include_descendants: bool = False
+) -> Iterator[Specimen]:
     """
     Given a taxon, yield the specimens which are found in the BINs the taxon appears in.
-    The BINs are found using the get_containing_bins function above. The specimens are
-    returned in BIN URI order, in part because a known calling function needs this for
-    a subsequent groupby.
+    The BINs are found using the get_containing_bins_select function above. The
+    specimens are returned in BIN URI order and are fetched from the database in
+    batches using a server-side cursor so that they aren't all held in memory at once.
 
     :param taxon: a Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
     :return: yields Specimen objects
     """
-    select = get_associated_specimens_select(taxon).order_by(Specimen.bin_uri)
-    yield from db.session.scalars(select)
+    select = get_associated_specimens_select(taxon, include_descendants).order_by(
+        Specimen.bin_uri, Specimen.id
+    )
+    yield from db.session.scalars(select.execution_options(yield_per=YIELD_PER))
+
+
+def iter_associated_specimen_rows(
+    taxon: Taxon,
+    columns: Iterable[ColumnElement],
+    include_descendants: bool = False,
+) -> Iterator[Row]:
+    """
+    Given a taxon, yield the given column values of the specimens which are found in the
+    BINs the taxon appears in. Use this instead of iter_associated_specimens when only a
+    few of the specimens' values are needed, it avoids loading the rest of the values
+    and building Specimen objects from them. The rows are returned in BIN URI order and
+    are fetched from the database in batches using a server-side cursor.
+
+    :param taxon: a Taxon object
+    :param columns: the Specimen and SpecimenDetail columns to get the values of
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: yields rows of the requested values
+    """
+    select = get_associated_specimen_rows_select(
+        taxon, columns, include_descendants
+    ).order_by(Specimen.bin_uri, Specimen.id)
+    yield from db.session.execute(select.execution_options(yield_per=YIELD_PER))
@@ -0,0 +1,413 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from pathlib import Path
+from threading import Lock
+from typing import Iterable
+from urllib.parse import urlencode
+
+from flask import Flask, Response, current_app, request
+from sqlalchemy.orm import aliased
+
+from ukbol.data.utils import TAXON_DATA_SOURCES, get_data_version
+from ukbol.extensions import db
+from ukbol.model import Taxon
+from ukbol.utils import log
+
+
+class ResponseCache:
+    """
+    A cache of response bodies for a single version of the data. Bodies are held in an
+    in-memory LRU which is bounded by the total size of the bodies in it and,
+    optionally, in a directory on disk which can be shared between processes (e.g.
+    gunicorn workers) so that a response only needs to be computed once across all of
+    them. The disk store has a subdirectory for each version of the data so that bodies
+    from old versions are never served, and the directories of old versions are removed.
+
+    The disk store is bounded too: once the version's directory holds max_disk_size
+    bytes of bodies, no more are written to it. The size of the directory is measured
+    when the cache is created and then every DISK_SIZE_CHECK_INTERVAL writes, as other
+    processes write to it too, so it can go a little over the limit.
+    """
+
+    # the number of bodies written to disk between measurements of the disk store's size
+    DISK_SIZE_CHECK_INTERVAL = 100
+
+    def __init__(
+        self,
+        version: str,
+        max_size: int,
+        cache_dir: Path | None = None,
+        max_disk_size: int | None = None,
+    ):
+        """
+        :param version: the version of the data the responses were created from
+        :param max_size: the maximum total size of the bodies held in memory, in bytes
+        :param cache_dir: the directory to store bodies on disk in, or None to only
+                          hold them in memory
+        :param max_disk_size: the maximum total size of the bodies stored on disk for
+                              the version, in bytes, or None for no limit
+        """
+        self.version = version
+        self.max_size = max_size
+        self.size = 0
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.lock = Lock()
+        self.version_dir = None
+        self.max_disk_size = max_disk_size
+        self.disk_size = 0
+        self.writes_since_check = 0
+        if cache_dir is not None:
+            self.version_dir = cache_dir / version
+            self.version_dir.mkdir(parents=True, exist_ok=True)
+            # remove the bodies from any other versions of the data
+            for path in cache_dir.iterdir():
+                if path.is_dir() and path != self.version_dir:
+                    shutil.rmtree(path, ignore_errors=True)
+            self.disk_size = self._measure_disk_size()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _measure_disk_size(self) -> int:
+        """
+        Returns the total size of the bodies in the version's directory on disk.
+
+        :return: the size in bytes
+        """
+        size = 0
+        for path in self.version_dir.glob("*.json"):
+            try:
+                size += path.stat().st_size
+            except OSError:
+                # removed by another process since we listed it
+                pass
+        return size
+
+    def _has_disk_space(self, body: bytes) -> bool:
+        """
+        Returns whether the given body can be written to the disk store without going
+        over its size limit, measuring the disk store's size again if it's been a while.
+
+        :param body: the body
+        :return: True if the body can be written, False if not
+        """
+        if self.max_disk_size is None:
+            return True
+        with self.lock:
+            self.writes_since_check += 1
+            check = self.writes_since_check >= self.DISK_SIZE_CHECK_INTERVAL
+            if check:
+                self.writes_since_check = 0
+        if check:
+            size = self._measure_disk_size()
+            with self.lock:
+                self.disk_size = size
+        with self.lock:
+            if self.disk_size + len(body) > self.max_disk_size:
+                return False
+            self.disk_size += len(body)
+            return True
+
+    def _get_path(self, key: str) -> Path:
+        """
+        Returns the path the body with the given key is stored at on disk.
+
+        :param key: the cache key
+        :return: the path
+        """
+        return self.version_dir / f"{hashlib.md5(key.encode('utf-8')).hexdigest()}.json"
+
+    def get(self, key: str) -> bytes | None:
+        """
+        Returns the body with the given key, checking memory first and then the disk
+        store, if there is one. Bodies found on disk are added to memory.
+
+        :param key: the cache key
+        :return: the body or None if it isn't in the cache
+        """
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+                return body
+
+        if self.version_dir is None:
+            return None
+        try:
+            body = self._get_path(key).read_bytes()
+        except OSError:
+            return None
+        self._remember(key, body)
+        return body
+
+    def set(self, key: str, body: bytes):
+        """
+        Adds the given body to the cache under the given key. The body is written to
+        the disk store via a temporary file so that other processes never read a
+        partially written body. If the disk store is full, the body is only held in
+        memory.
+
+        :param key: the cache key
+        :param body: the body
+        """
+        self._remember(key, body)
+
+        if self.version_dir is None or not self._has_disk_space(body):
+            return
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.version_dir, suffix=".part")
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(temp_path, self._get_path(key))
+        except OSError:
+            # the version's directory may have been removed by another process which
+            # has seen a newer version, the body is still in memory so just move on
+            pass
+
+    def _remember(self, key: str, body: bytes):
+        """
+        Adds the given body to the in-memory LRU, evicting the least recently used
+        bodies to keep the total size under the limit. Bodies bigger than the limit are
+        not held in memory at all.
+
+        :param key: the cache key
+        :param body: the body
+        """
+        if len(body) > self.max_size:
+            return
+        with self.lock:
+            existing = self.entries.pop(key, None)
+            if existing is not None:
+                self.size -= len(existing)
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+# the current cache, the time we last checked it was up to date, and a lock to make
+# sure only one thread replaces it at a time
+_cache: ResponseCache | None = None
+_last_checked: float | None = None
+_lock = Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    """
+    Returns the response cache, if it is enabled via the RESPONSE_CACHE config option.
+    The cache is created on first use and then replaced with an empty one whenever the
+    version of the taxon data sources changes (see ukbol.data.utils.get_data_version).
+    The version is checked at most once every RESPONSE_CACHE_CHECK_INTERVAL seconds
+    (default: 60). The size of the in-memory cache is set by the RESPONSE_CACHE_SIZE
+    config option in bytes (default: 64MB) and the shared disk store is enabled by
+    setting the RESPONSE_CACHE_DIR config option. The size of the disk store is set by
+    the RESPONSE_CACHE_DIR_SIZE config option in bytes (default: 1GB).
+
+    :return: the ResponseCache or None if the cache isn't enabled
+    """
+    global _cache, _last_checked
+
+    if not current_app.config.get("RESPONSE_CACHE", False):
+        return None
+
+    check_interval = current_app.config.get("RESPONSE_CACHE_CHECK_INTERVAL", 60)
+    now = time.monotonic()
+    if (
+        _cache is not None
+        and _last_checked is not None
+        and now - _last_checked < check_interval
+    ):
+        return _cache
+
+    with _lock:
+        version = get_data_version(TAXON_DATA_SOURCES)
+        if _cache is None or _cache.version != version:
+            cache_dir = current_app.config.get("RESPONSE_CACHE_DIR")
+            _cache = ResponseCache(
+                version,
+                current_app.config.get("RESPONSE_CACHE_SIZE", 64 * 1024 * 1024),
+                Path(cache_dir) if cache_dir else None,
+                current_app.config.get("RESPONSE_CACHE_DIR_SIZE", 1024 * 1024 * 1024),
+            )
+        _last_checked = now
+        return _cache
+
+
+def clear_response_cache():
+    """
+    Removes the current response cache, forcing it to be recreated next time it is
+    used. This doesn't remove anything from the disk store.
+    """
+    global _cache, _last_checked
+
+    with _lock:
+        _cache = None
+        _last_checked = None
+
+
+def get_cache_key(arg_names: Iterable[str]) -> str:
+    """
+    Returns the cache key for the current request, this is the path and the values of
+    the given query parameters in a stable order. Only the parameters the endpoint
+    reads are included so that other parameters can't be used to fill the cache with
+    copies of the same response.
+
+    :param arg_names: the names of the query parameters the endpoint reads
+    :return: the cache key
+    """
+    args = sorted(
+        (name, value) for name in set(arg_names) for value in request.args.getlist(name)
+    )
+    return f"{request.path}?{urlencode(args)}"
+
+
+def cached_response(*arg_names: str):
+    """
+    Decorator factory which caches the JSON responses of the wrapped endpoint in the
+    response cache, if it is enabled (see get_response_cache). The names of the query
+    parameters the endpoint reads must be given as they are used in the cache key (see
+    get_cache_key). Responses get an ETag derived from the cache key and the data
+    version, which means requests with a matching If-None-Match header can be answered
+    with a 304 before anything is computed, and a Cache-Control header with a max-age
+    of RESPONSE_CACHE_MAX_AGE seconds (default: 60). Only successful JSON responses are
+    cached. If the cache isn't enabled, the wrapped endpoint is called as normal.
+
+    :param arg_names: the names of the query parameters the endpoint reads
+    :return: a decorator
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = get_response_cache()
+            if cache is None:
+                return func(*args, **kwargs)
+
+            key = get_cache_key(arg_names)
+            etag = hashlib.md5(f"{cache.version}|{key}".encode("utf-8")).hexdigest()
+
+            def add_headers(response: Response) -> Response:
+                response.set_etag(etag)
+                response.cache_control.public = True
+                response.cache_control.max_age = current_app.config.get(
+                    "RESPONSE_CACHE_MAX_AGE", 60
+                )
+                return response
+
+            if request.if_none_match.contains(etag):
+                return add_headers(Response(status=304))
+
+            body = cache.get(key)
+            if body is not None:
+                return add_headers(Response(body, mimetype="application/json"))
+
+            response = current_app.make_response(func(*args, **kwargs))
+            if (
+                response.status_code == 200
+                and response.mimetype == "application/json"
+                and not response.is_streamed
+            ):
+                cache.set(key, response.get_data())
+                add_headers(response)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def get_taxa_at_or_above_rank(rank: str) -> list[str]:
+    """
+    Returns the IDs of the taxa with the given rank and all of their ancestors, i.e.
+    every taxon at or above the rank in the taxonomy. Ranks aren't ordered so the
+    ancestors are found using the taxa's nested set intervals.
+
+    :param rank: the rank
+    :return: a list of taxon IDs, in name order
+    """
+    ranked = aliased(Taxon)
+    select = (
+        db.select(Taxon.id)
+        .filter(
+            db.select(ranked.id)
+            .filter(
+                ranked.rank == rank.lower(),
+                ranked.lft >= Taxon.lft,
+                ranked.rgt <= Taxon.rgt,
+            )
+            .exists()
+        )
+        .order_by(Taxon.name, Taxon.id)
+    )
+    return list(db.session.scalars(select))
+
+
+def get_warm_urls(taxon_id: str, include_descendants: bool = False) -> list[str]:
+    """
+    Returns the URLs of the endpoints to request to warm the response cache for the
+    given taxon: its BIN summaries, children, and parents.
+
+    :param taxon_id: the taxon ID
+    :param include_descendants: whether to also warm the BIN summaries including the
+                                taxon's descendants
+    :return: a list of URLs
+    """
+    urls = [
+        f"/api/taxon/{taxon_id}/bin_summaries",
+        f"/api/taxon/{taxon_id}/children",
+        f"/api/taxon/{taxon_id}/parents",
+    ]
+    if include_descendants:
+        urls.append(f"/api/taxon/{taxon_id}/bin_summaries?include_descendants=true")
+    return urls
+
+
+def warm_response_cache(
+    app: Flask,
+    taxon_ids: list[str],
+    workers: int = 4,
+    include_descendants: bool = False,
+) -> int:
+    """
+    Requests the BIN summaries, children, and parents of each of the given taxa so that
+    their responses are in the response cache (see get_warm_urls). The requests are
+    made through the app using the given number of threads. For this to be of use to
+    the app's server processes, the response cache must be enabled with a
+    RESPONSE_CACHE_DIR they share. The throughput is logged as the cache is warmed.
+
+    :param app: the Flask app
+    :param taxon_ids: the IDs of the taxa to warm the cache for
+    :param workers: the number of requests to make at once
+    :param include_descendants: whether to also warm the BIN summaries including each
+                                taxon's descendants
+    :return: the number of responses cached
+    """
+    urls = [
+        url
+        for taxon_id in taxon_ids
+        for url in get_warm_urls(taxon_id, include_descendants)
+    ]
+
+    def warm(url: str) -> bool:
+        # each request gets its own client as they aren't thread safe
+        return app.test_client().get(url).status_code == 200
+
+    warmed = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        for i, ok in enumerate(executor.map(warm, urls), start=1):
+            warmed += ok
+            if i % 1000 == 0 or i == len(urls):
+                elapsed = time.perf_counter() - start
+                log(
+                    f"Requested {i}/{len(urls)} responses in {elapsed:.2f} seconds "
+                    f"({i / elapsed:.1f} per second)"
+                )
+    return warmed
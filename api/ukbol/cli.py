@@ -1,12 +1,15 @@
 from pathlib import Path
 
 import click
+from flask import current_app
 from flask.cli import FlaskGroup
 
 from ukbol.app import create_app
+from ukbol.cache import get_taxa_at_or_above_rank, warm_response_cache
 from ukbol.data.bold import rebuild_bold_tables
 from ukbol.data.pantheon import rebuild_pantheon_tables
 from ukbol.data.uksi import rebuild_uksi_tables
+from ukbol.utils import log
 
 
 @click.group(cls=FlaskGroup, create_app=create_app)
@@ -21,14 +24,103 @@ def cli():
 
 
 @cli.command("rebuild-uksi")
-def rebuild_uksi():
-    rebuild_uksi_tables()
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="The number of pages to request from NBN at once.",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Cache the NBN pages in this directory so that a failed rebuild can resume.",
+)
+@click.option(
+    "--from-snapshot",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Rebuild from this snapshot file instead of downloading from NBN.",
+)
+@click.option(
+    "--save-snapshot",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="Write a gzipped JSON lines snapshot of the NBN data to this path.",
+)
+def rebuild_uksi(
+    workers: int,
+    cache_dir: Path | None,
+    from_snapshot: Path | None,
+    save_snapshot: Path | None,
+):
+    rebuild_uksi_tables(workers, cache_dir, from_snapshot, save_snapshot)
 
 
 @cli.command("rebuild-bold")
 @click.argument("bold_snapshot", type=click.Path(exists=True, dir_okay=False))
-def rebuild_bold(bold_snapshot: Path):
-    rebuild_bold_tables(bold_snapshot)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="The number of processes to parse the TSV with. With more than one, the TSV "
+    "is parsed in parallel while the results are written to the database.",
+)
+@click.option(
+    "--writers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="The number of database connections to write the parsed TSV with when using "
+    "more than one worker.",
+)
+@click.option(
+    "--raw",
+    is_flag=True,
+    default=False,
+    help="Stream the TSV straight into the database and clean the values there instead "
+    "of parsing it in Python. The --workers and --writers options are ignored.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only add, update, and remove the specimens which have changed since the "
+    "last import, matching them on their processid.",
+)
+@click.option(
+    "--index-workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="The number of indexes to build at once after the specimens are loaded.",
+)
+@click.option(
+    "--maintenance-work-mem",
+    default=None,
+    help="The maintenance_work_mem to use for each index build, e.g. 1GB. Defaults to "
+    "the database server's setting.",
+)
+def rebuild_bold(
+    bold_snapshot: Path,
+    workers: int,
+    writers: int,
+    raw: bool,
+    incremental: bool,
+    index_workers: int,
+    maintenance_work_mem: str | None,
+):
+    rebuild_bold_tables(
+        bold_snapshot,
+        index_workers,
+        maintenance_work_mem,
+        workers,
+        writers,
+        raw,
+        incremental,
+    )
 
 
 @cli.command("rebuild-pantheon")
@@ -39,5 +131,54 @@ def rebuild_pantheon(pantheon_snapshot: Path):
     rebuild_pantheon_tables(pantheon_snapshot)
 
 
+@cli.command("warm-cache")
+@click.argument("taxon_ids", nargs=-1)
+@click.option(
+    "--rank",
+    default=None,
+    help="Warm the cache for every taxon at or above this rank, e.g. family.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="The number of requests to make at once.",
+)
+@click.option(
+    "--include-descendants",
+    is_flag=True,
+    default=False,
+    help="Also warm the BIN summaries which include each taxon's descendants.",
+)
+def warm_cache(
+    taxon_ids: tuple[str, ...],
+    rank: str | None,
+    workers: int,
+    include_descendants: bool,
+):
+    """
+    Precomputes the BIN summaries, children, and parents of the given taxa, or of all
+    the taxa at or above the given rank, and stores them in the shared response cache
+    directory set by RESPONSE_CACHE_DIR. Run this after a rebuild.
+    """
+    if not current_app.config.get("RESPONSE_CACHE_DIR"):
+        raise click.UsageError("RESPONSE_CACHE_DIR must be set to warm the cache")
+    if not taxon_ids and rank is None:
+        raise click.UsageError("Either taxon IDs or --rank must be given")
+
+    current_app.config["RESPONSE_CACHE"] = True
+    taxon_ids = list(taxon_ids)
+    if rank is not None:
+        taxon_ids.extend(get_taxa_at_or_above_rank(rank))
+    # remove duplicates, keeping the order
+    taxon_ids = list(dict.fromkeys(taxon_ids))
+    log(f"Warming the cache for {len(taxon_ids)} taxa")
+    warmed = warm_response_cache(
+        current_app._get_current_object(), taxon_ids, workers, include_descendants
+    )
+    log(f"Cached {warmed} responses")
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,138 @@
+from sqlalchemy import (
+    ColumnElement,
+    Select,
+    String,
+    any_,
+    bindparam,
+    func,
+    insert,
+    union_all,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
+
+from ukbol.extensions import db
+from ukbol.model import BinSummary, Specimen, Synonym, Taxon, TaxonBin
+
+
+def in_bins(column: ColumnElement, bin_uris: list[str]) -> ColumnElement[bool]:
+    """
+    Returns a filter clause matching the given column against the given BIN URIs. The
+    BIN URIs are sent as a single array parameter so that any number of them can be
+    used.
+
+    :param column: the column containing BIN URIs
+    :param bin_uris: the BIN URIs to match
+    :return: a filter clause
+    """
+    return column == any_(bindparam("bin_uris", bin_uris, type_=ARRAY(String)))
+
+
+def get_bin_summaries_select(bin_uris: list[str] | None = None) -> Select:
+    """
+    Returns a select which aggregates the current data in the Specimen table into BIN
+    summaries with the same columns as the BinSummary table: the BIN URI, the total
+    specimen count, the GB specimen count, and a list of [identification, count] pairs
+    in descending count order. The counting is all done in the database by grouping on
+    the BIN and identification so only the aggregated rows are returned.
+
+    :param bin_uris: the BIN URIs to summarise, defaults to None which means all BINs
+                     are summarised
+    :return: a select statement
+    """
+    # count the specimens for each name in each BIN first
+    name_counts = (
+        db.select(
+            Specimen.bin_uri,
+            Specimen.identification,
+            func.count().label("count"),
+            func.count().filter(Specimen.country_iso == "GB").label("uk_count"),
+        )
+        .filter(Specimen.bin_uri.isnot(None))
+        .group_by(Specimen.bin_uri, Specimen.identification)
+    )
+    if bin_uris is not None:
+        name_counts = name_counts.filter(in_bins(Specimen.bin_uri, bin_uris))
+    name_counts = name_counts.subquery()
+    # then roll those counts up to the BIN level
+    return db.select(
+        name_counts.c.bin_uri,
+        func.sum(name_counts.c.count).label("count"),
+        func.sum(name_counts.c.uk_count).label("uk_count"),
+        func.jsonb_agg(
+            aggregate_order_by(
+                func.jsonb_build_array(
+                    name_counts.c.identification, name_counts.c.count
+                ),
+                name_counts.c.count.desc(),
+                name_counts.c.identification,
+            )
+        ).label("names"),
+    ).group_by(name_counts.c.bin_uri)
+
+
+def rebuild_bin_summaries(bin_uris: list[str] | None = None):
+    """
+    Replace the data in the BinSummary table with aggregated counts derived from the
+    current data in the Specimen table. Each BIN gets a row with its total specimen
+    count, GB specimen count and a list of the identifications within the BIN along
+    with their counts. This is all done in the database with a single insert/select
+    (see get_bin_summaries_select).
+
+    If a list of BIN URIs is given, only the summaries of those BINs are replaced. This
+    is used after an incremental import to refresh just the BINs which have changed.
+
+    :param bin_uris: the BIN URIs to rebuild the summaries of, defaults to None which
+                     means all BINs are rebuilt
+    """
+    delete_query = BinSummary.query
+    if bin_uris is not None:
+        delete_query = delete_query.filter(in_bins(BinSummary.bin_uri, bin_uris))
+    delete_query.delete(synchronize_session=False)
+
+    db.session.execute(
+        insert(BinSummary).from_select(
+            ["bin_uri", "count", "uk_count", "names"],
+            get_bin_summaries_select(bin_uris),
+        )
+    )
+    db.session.commit()
+
+
+def rebuild_taxon_bins(bin_uris: list[str] | None = None):
+    """
+    Replace the data in the TaxonBin table with links between each taxon and the BINs
+    that contain specimens identified with the taxon's name or any of its synonyms'
+    names. This depends on both the taxonomy and the specimens so needs to be called
+    whenever either of them are rebuilt.
+
+    If a list of BIN URIs is given, only the links to those BINs are replaced. This is
+    used after an incremental import to refresh just the BINs which have changed.
+
+    :param bin_uris: the BIN URIs to rebuild the links of, defaults to None which means
+                     all links are rebuilt
+    """
+    delete_query = TaxonBin.query
+    if bin_uris is not None:
+        delete_query = delete_query.filter(in_bins(TaxonBin.bin_uri, bin_uris))
+    delete_query.delete(synchronize_session=False)
+
+    # gather up all the names each taxon has
+    names = union_all(
+        db.select(Taxon.id.label("taxon_id"), Taxon.name),
+        db.select(Synonym.taxon_id, Synonym.name),
+    ).subquery()
+    # find the BINs associated with the names (ignore None BIN URIs)
+    taxon_bins = (
+        db.select(names.c.taxon_id, Specimen.bin_uri)
+        .distinct()
+        # todo: should we also match on rank?
+        .join(Specimen, Specimen.identification == names.c.name)
+        .filter(Specimen.bin_uri.isnot(None))
+    )
+    if bin_uris is not None:
+        taxon_bins = taxon_bins.filter(in_bins(Specimen.bin_uri, bin_uris))
+
+    db.session.execute(
+        insert(TaxonBin).from_select(["taxon_id", "bin_uri"], taxon_bins)
+    )
+    db.session.commit()
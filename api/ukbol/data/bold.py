@@ -1,15 +1,77 @@
 import csv
+import math
 import os
+import re
 import sys
 import tarfile
-from io import TextIOWrapper
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date
+from functools import partial
+from io import StringIO, TextIOWrapper
 from itertools import batched
+from multiprocessing import get_context
+from operator import itemgetter
 from pathlib import Path
+from queue import Queue
+from typing import IO, Callable, Container, Iterable, Iterator, NamedTuple
 
-from ukbol.data.utils import update_status
+from sqlalchemy import TableClause, column, table, text
+
+from ukbol.data.bins import rebuild_bin_summaries, rebuild_taxon_bins
+from ukbol.data.utils import (
+    build_staging_indexes,
+    create_staging_table,
+    drop_staging_table,
+    get_copy_sql,
+    get_staging_name,
+    iter_in_executor,
+    swap_in_staging_tables,
+    update_status,
+)
 from ukbol.extensions import db
-from ukbol.model import Specimen
-from ukbol.utils import log
+from ukbol.model import BinSummary, Specimen, SpecimenDetail
+from ukbol.utils import PhaseTimer, log
+
+# the number of bytes of the BOLD TSV handed to a worker process at a time when parsing
+# the TSV in parallel
+CHUNK_SIZE = 4 * 1024 * 1024
+# some fields in the source tsv have different names in the database, mainly because
+# they're invalid as python or postgresql names
+COLUMN_MAPPING = {
+    "class": "cls",
+    "country/ocean": "country_ocean",
+    "province/state": "province_state",
+}
+# we lowercase the identification and rank on ingest for matching purposes
+LOWERCASE_COLUMNS = ("identification", "identification_rank")
+# the date columns of the Specimen table and the columns of the tsv they're parsed from,
+# the original values are kept in the SpecimenDetail table
+PARSED_DATE_COLUMNS = {
+    "collection_start": "collection_date_start",
+    "collection_end": "collection_date_end",
+}
+# the columns of the Specimen table which aren't loaded straight from the tsv
+DERIVED_COLUMNS = ("id", *PARSED_DATE_COLUMNS, "latitude", "longitude")
+# only full dates are parsed, partial dates like 2019-05 are left as NULLs
+DATE_PATTERN = r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$"
+# the numbers in coord values which are parsed, this is a subset of what PostgreSQL
+# accepts as a double precision value which excludes NaN and Infinity
+NUMBER_PATTERN = r"^\s*[+-]?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]+)?\s*$"
+DATE_REGEX = re.compile(DATE_PATTERN)
+NUMBER_REGEX = re.compile(NUMBER_PATTERN)
+# a PostgreSQL regex matching values which are empty or only contain the characters
+# str.strip removes, so that the raw loading path blanks exactly the values clean_row
+# does (PostgreSQL's own whitespace classes depend on the database's locale)
+BLANK_PATTERN = "^[{}]*$".format(
+    "".join(
+        f"\\u{ord(char):04x}"
+        for char in map(chr, range(sys.maxunicode + 1))
+        if char.isspace()
+    )
+)
+# the unindexed table the tsv is loaded into by the raw loading path before it is split
+# into the Specimen and SpecimenDetail staging tables
+LOAD_TABLE = "specimen_load"
 
 
 def get_tsv_name(tar: tarfile.TarFile) -> str:
@@ -30,93 +92,929 @@ def get_tsv_name(tar: tarfile.TarFile) -> str:
     raise Exception("Could not find .tsv file in BOLD data package")
 
 
-def rebuild_bold_tables(bold_snapshot: Path):
+def get_tsv_reader(lines: Iterable[str]) -> Iterator[list[str]]:
     """
-    Given the path to a BOLD snapshot, read the TSV in that snapshot and replace the
-    current data in the Specimen table with the data. All old data is deleted.
+    Returns a csv reader configured to read the given lines from a BOLD TSV.
 
-    :param bold_snapshot: Path to the BOLD snapshot
+    :param lines: the lines to read
+    :return: a csv reader
+    """
+    return csv.reader(
+        lines,
+        # it's a tsv file
+        dialect=csv.excel_tab,
+        # nothing is double-quoted but there is at least one entry in a dump I have seen
+        # where there is a single double quote as a value which breaks everything if
+        # it's handled in the default fashion. Single-quotes are used but only in string
+        # array values so we can safely allow the reader to ignore them too
+        quoting=csv.QUOTE_NONE,
+    )
+
+
+def clean_row(row: list[str], to_lower: Container[int]) -> list[str | None]:
+    """
+    Do some light value management on a row from the BOLD TSV, converting "None" and ""
+    values to actual None values, plus lowercasing the values at the given indexes.
+
+    :param row: the row of values
+    :param to_lower: the indexes of the values to lowercase
+    :return: the cleaned row of values
+    """
+    return [
+        None
+        if value == "None" or not value.strip()
+        else value.lower()
+        if i in to_lower
+        else value
+        for i, value in enumerate(row)
+    ]
+
+
+def escape_copy_value(value: str | None) -> str:
+    """
+    Escapes the given value for use in the text format of PostgreSQL's COPY.
+
+    :param value: the value
+    :return: the escaped value
+    """
+    if value is None:
+        return "\\N"
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def parse_date(value: str | None) -> str | None:
+    """
+    Checks the given value is a full date in the same way as split_specimens does,
+    returning it if it is and None if it isn't.
+
+    :param value: the value
+    :return: the value or None
+    """
+    if value is None or not DATE_REGEX.fullmatch(value):
+        return None
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return None
+    return value
+
+
+def parse_coord(value: str | None) -> tuple[str | None, str | None]:
+    """
+    Parses the latitude and longitude from the given coord value in the same way as
+    split_specimens does. Coord values look like "[18.677, -88.395]".
+
+    :param value: the coord value
+    :return: the latitude and longitude as strings, or Nones if they can't be parsed
+    """
+    if value is None:
+        return None, None
+    parts = value.strip("[]").split(",")
+    numbers = []
+    for i in range(2):
+        number = None
+        if i < len(parts) and NUMBER_REGEX.fullmatch(parts[i]):
+            parsed = float(parts[i])
+            if math.isfinite(parsed):
+                number = repr(parsed)
+        numbers.append(number)
+    return numbers[0], numbers[1]
+
+
+def get_picker(indexes: list[int]) -> Callable[[list], tuple]:
+    """
+    Returns a function which picks the values at the given indexes out of a row, as a
+    tuple.
+
+    :param indexes: the indexes of the values to pick
+    :return: the picker function
+    """
+    if not indexes:
+        return lambda row: ()
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    # itemgetter is a lot faster than picking the values out one by one in Python
+    return itemgetter(*indexes)
+
+
+class SpecimenRowSplitter:
+    """
+    Splits the cleaned rows of the BOLD TSV into rows for the Specimen and
+    SpecimenDetail staging tables, parsing the Specimen table's derived values from the
+    TSV's values (see parse_date and parse_coord). This means the rows can be copied
+    straight into the staging tables without going through the load table.
+    """
+
+    def __init__(self, columns: list[str]):
+        """
+        :param columns: the names of the columns in the TSV, in order
+        """
+        self.columns = columns
+        specimen_names = {col.name for col in Specimen.__table__.columns}
+        specimen_indexes = [
+            i for i, name in enumerate(columns) if name in specimen_names
+        ]
+        detail_indexes = [
+            i for i, name in enumerate(columns) if name not in specimen_names
+        ]
+        self.pick_specimen_values = get_picker(specimen_indexes)
+        self.pick_detail_values = get_picker(detail_indexes)
+        self.date_indexes = [
+            columns.index(date_column)
+            for date_column in PARSED_DATE_COLUMNS.values()
+            if date_column in columns
+        ]
+        self.coord_index = columns.index("coord") if "coord" in columns else None
+
+        self.specimen_columns = [
+            "id",
+            *(columns[i] for i in specimen_indexes),
+            *(
+                column_name
+                for column_name, date_column in PARSED_DATE_COLUMNS.items()
+                if date_column in columns
+            ),
+        ]
+        if self.coord_index is not None:
+            self.specimen_columns.extend(("latitude", "longitude"))
+        self.detail_columns = ["specimen_id", *(columns[i] for i in detail_indexes)]
+
+    def __reduce__(self):
+        # the pickers can't always be pickled so rebuild the splitter from its columns
+        return SpecimenRowSplitter, (self.columns,)
+
+    def split(
+        self, row: list[str | None], specimen_id: int
+    ) -> tuple[tuple[str | None, ...], tuple[str | None, ...]]:
+        """
+        Splits the given cleaned row into the values for the specimen_columns and the
+        values for the detail_columns.
+
+        :param row: the cleaned row of values from the TSV
+        :param specimen_id: the id to give the specimen
+        :return: the specimen values and the detail values
+        """
+        specimen_id = str(specimen_id)
+        specimen_row = (
+            specimen_id,
+            *self.pick_specimen_values(row),
+            *[parse_date(row[i]) for i in self.date_indexes],
+        )
+        if self.coord_index is not None:
+            specimen_row += parse_coord(row[self.coord_index])
+        return specimen_row, (specimen_id, *self.pick_detail_values(row))
+
+
+def count_lines(chunk: bytes) -> int:
+    """
+    Returns the number of lines in the given chunk of the BOLD TSV. Nothing in the TSV
+    is quoted (see get_tsv_reader) so this is also the number of rows.
+
+    :param chunk: a chunk of the BOLD TSV containing only whole lines
+    :return: the number of lines
+    """
+    return chunk.count(b"\n") + (not chunk.endswith(b"\n"))
+
+
+def number_chunks(chunks: Iterable[bytes]) -> Iterable[tuple[bytes, int]]:
+    """
+    Pairs each of the given chunks of the BOLD TSV with the id of the first row in it,
+    numbering the rows from 1.
+
+    :param chunks: the chunks of the BOLD TSV, each containing only whole lines
+    :return: an iterable of (chunk, first id) pairs
+    """
+    first_id = 1
+    for chunk in chunks:
+        yield chunk, first_id
+        first_id += count_lines(chunk)
+
+
+def encode_rows(rows: Iterable[list[str | None]]) -> bytes:
+    """
+    Encodes the given rows in the text format of PostgreSQL's COPY.
+
+    :param rows: the rows of values
+    :return: the encoded rows
+    """
+    lines = ["\t".join(map(escape_copy_value, row)) for row in rows]
+    # add the trailing newline for the last line
+    lines.append("")
+    return "\n".join(lines).encode("utf-8")
+
+
+def encode_chunk(
+    numbered_chunk: tuple[bytes, int],
+    splitter: SpecimenRowSplitter,
+    to_lower: tuple[int, ...],
+) -> tuple[bytes, bytes, int]:
+    """
+    Parses and cleans the rows in the given chunk of the BOLD TSV, splits them into
+    Specimen and SpecimenDetail rows, and encodes them in the text format of
+    PostgreSQL's COPY, ready to be written to the staging tables without any further
+    processing. This is run in worker processes so that the parsing work is spread
+    over multiple CPUs.
+
+    :param numbered_chunk: a chunk of the BOLD TSV containing only whole lines and the
+                           id to give the first row in it (see number_chunks)
+    :param splitter: the splitter to split the rows with
+    :param to_lower: the indexes of the values to lowercase
+    :return: the encoded Specimen rows, the encoded SpecimenDetail rows, and the number
+             of rows encoded
+    """
+    chunk, first_id = numbered_chunk
+    specimen_rows = []
+    detail_rows = []
+    reader = get_tsv_reader(StringIO(chunk.decode("utf-8"), newline=""))
+    for specimen_id, row in enumerate(reader, start=first_id):
+        specimen_row, detail_row = splitter.split(clean_row(row, to_lower), specimen_id)
+        specimen_rows.append(specimen_row)
+        detail_rows.append(detail_row)
+    # the ids are handed out by line so a row which isn't a line would mean clashes
+    if len(specimen_rows) != count_lines(chunk):
+        raise Exception("Found a row in the BOLD TSV which doesn't match its line")
+    return encode_rows(specimen_rows), encode_rows(detail_rows), len(specimen_rows)
+
+
+def iter_chunks(stream: IO[bytes], chunk_size: int) -> Iterable[bytes]:
+    """
+    Reads the given binary stream in chunks of roughly the given size, making sure that
+    each chunk only contains whole lines.
+
+    :param stream: the binary stream to read
+    :param chunk_size: the number of bytes to read at a time
+    :return: an iterable of chunks
+    """
+    remainder = b""
+    while block := stream.read(chunk_size):
+        block = remainder + block
+        end = block.rfind(b"\n") + 1
+        if end:
+            yield block[:end]
+        remainder = block[end:]
+    if remainder:
+        yield remainder
+
+
+def get_tsv_columns() -> list[str]:
+    """
+    Returns the names of the columns in the Specimen and SpecimenDetail tables which
+    are loaded from the BOLD TSV.
+
+    :return: a list of column names
+    """
+    return [
+        *(
+            col.name
+            for col in Specimen.__table__.columns
+            if col.name not in DERIVED_COLUMNS
+        ),
+        *(
+            col.name
+            for col in SpecimenDetail.__table__.columns
+            if col.name != "specimen_id"
+        ),
+    ]
+
+
+def get_specimen_id_sequence() -> str:
+    """
+    Returns the name of the sequence the Specimen table's ids come from.
+
+    :return: the sequence name
+    """
+    return db.session.execute(
+        text("SELECT pg_get_serial_sequence(:table, 'id')"),
+        {"table": Specimen.__table__.name},
+    ).scalar()
+
+
+def reset_specimen_id_sequence():
+    """
+    Sets the Specimen table's id sequence to carry on from the largest id in the table.
+    The specimens are numbered from 1 in each load rather than being given ids from the
+    sequence (see create_load_table) so this needs to be done whenever all the
+    specimens are replaced.
+    """
+    db.session.execute(
+        text(
+            f"""
+            SELECT setval(
+                CAST(:sequence AS regclass),
+                (SELECT coalesce(max(id), 0) + 1 FROM {Specimen.__table__.name}),
+                false
+            )
+            """
+        ),
+        {"sequence": get_specimen_id_sequence()},
+    )
+    db.session.commit()
+
+
+def create_load_table(columns: list[str]) -> TableClause:
+    """
+    Creates the table the BOLD TSV is loaded into, with a text column for each of the
+    given columns. The table is unlogged as it only exists while a rebuild is running.
+    Each row is numbered from 1 by an identity column so that the rows can be split into
+    the Specimen and SpecimenDetail tables and still be linked. These ids are only
+    unique within the load, they don't use up any of the Specimen table's id sequence.
+
+    :param columns: the names of the columns in the TSV
+    :return: a table clause representing the load table
     """
-    log("Removing existing data...")
-    Specimen.query.delete()
+    col_defs = ", ".join(f'"{column}" text' for column in columns)
+    db.session.execute(text(f"DROP TABLE IF EXISTS {LOAD_TABLE}"))
+    db.session.execute(
+        text(
+            f"CREATE UNLOGGED TABLE {LOAD_TABLE} "
+            f"(id integer GENERATED ALWAYS AS IDENTITY, {col_defs})"
+        )
+    )
     db.session.commit()
+    return table(LOAD_TABLE, column("id"), *(column(name) for name in columns))
+
+
+def split_specimens(columns: list[str]) -> int:
+    """
+    Inserts the rows in the load table into the Specimen and SpecimenDetail staging
+    tables. The collection dates are parsed into date values and the latitude and
+    longitude are parsed from the coord value, with any values which can't be parsed
+    becoming NULLs. The original values are all kept in the SpecimenDetail table.
+
+    The values in the load table are cleaned as they are inserted, matching what
+    clean_row does, i.e. blank values are converted to NULLs and the LOWERCASE_COLUMNS
+    are lowercased.
+
+    :param columns: the names of the columns in the load table, apart from the id
+    :return: the number of specimens inserted
+    """
+    values = ["id"]
+    for column_name in columns:
+        value = f'"{column_name}"'
+        value = f"CASE WHEN {value} ~ '{BLANK_PATTERN}' THEN NULL ELSE {value} END"
+        if column_name in LOWERCASE_COLUMNS:
+            value = f"lower({value})"
+        values.append(f'{value} AS "{column_name}"')
+    source = f"(SELECT {', '.join(values)} FROM {LOAD_TABLE}) AS l"
+
+    def parse(value: str, pattern: str, type_name: str) -> str:
+        return (
+            f"CASE WHEN {value} ~ '{pattern}' AND pg_input_is_valid({value}, "
+            f"'{type_name}') THEN CAST({value} AS {type_name}) END"
+        )
+
+    specimen_values = {"id": "l.id"}
+    for specimen_column in Specimen.__table__.columns:
+        if specimen_column.name in columns:
+            specimen_values[specimen_column.name] = f'l."{specimen_column.name}"'
+    for column_name, date_column in PARSED_DATE_COLUMNS.items():
+        if date_column in columns:
+            value = f'l."{date_column}"'
+            specimen_values[column_name] = parse(value, DATE_PATTERN, "date")
+    if "coord" in columns:
+        # coord values look like "[18.677, -88.395]"
+        for i, column_name in enumerate(("latitude", "longitude"), start=1):
+            value = f"split_part(btrim(l.coord, '[]'), ',', {i})"
+            specimen_values[column_name] = parse(
+                value, NUMBER_PATTERN, "double precision"
+            )
+
+    detail_values = {"specimen_id": "l.id"}
+    for detail_column in SpecimenDetail.__table__.columns:
+        if detail_column.name in columns:
+            detail_values[detail_column.name] = f'l."{detail_column.name}"'
 
+    inserts = [
+        (get_staging_name(Specimen.__table__), specimen_values),
+        (get_staging_name(SpecimenDetail.__table__), detail_values),
+    ]
+    counts = []
+    for staging_name, table_values in inserts:
+        col_str = ", ".join(f'"{name}"' for name in table_values)
+        result = db.session.execute(
+            text(
+                f"INSERT INTO {staging_name} ({col_str}) "
+                f"SELECT {', '.join(table_values.values())} FROM {source}"
+            )
+        )
+        counts.append(result.rowcount)
+    db.session.commit()
+    return counts[0]
+
+
+def load_specimens(
+    bold_snapshot: Path, workers: int = 1, writers: int = 1, raw: bool = False
+) -> int:
+    """
+    Read the TSV in the given BOLD snapshot and load the specimens in it into the
+    Specimen and SpecimenDetail staging tables. The specimens are numbered from 1 so
+    that the rows in the two tables can be linked.
+
+    If raw is True, the TSV is streamed straight into an unindexed load table without
+    being parsed here at all and is then cleaned and split into the staging tables by
+    the database (see load_specimens_raw and split_specimens). The workers and writers
+    are ignored in this case.
+
+    Otherwise, the rows are parsed, cleaned, and split here and copied straight into the
+    staging tables (see SpecimenRowSplitter). If more than one worker is requested, the
+    TSV is split into chunks which are parsed, cleaned, split, and encoded by a pool of
+    worker processes. The encoded chunks are then written to the database by the given
+    number of writer threads, each with their own connection. With one worker, the TSV
+    is read and written from this process alone.
+
+    :param bold_snapshot: Path to the BOLD snapshot
+    :param workers: the number of processes to parse the TSV with, defaults to 1
+    :param writers: the number of connections to write to the database with when using
+                    more than one worker, defaults to 1
+    :param raw: whether to stream the TSV straight into the database, defaults to False
+    :return: the number of specimens loaded
+    """
     # increase the field size limit to avoid errors when reading the BOLD tsv
     csv.field_size_limit(sys.maxsize)
 
+    specimen_staging_table = create_staging_table(Specimen.__table__)
+    detail_staging_table = create_staging_table(SpecimenDetail.__table__)
+
     log("Reading tsv from zip, this may take a bit of time...")
     with tarfile.open(bold_snapshot) as tar:
         tsv_file_name = get_tsv_name(tar)
         raw_tsv = tar.extractfile(tsv_file_name)
-        text_tsv = TextIOWrapper(raw_tsv, encoding="utf-8", newline="")
-        reader = csv.reader(
-            text_tsv,
-            # it's a tsv file
-            dialect=csv.excel_tab,
-            # nothing is double-quoted but there is at least one entry in a dump I have
-            # seen where there is a single double quote as a value which breaks
-            # everything if it's handled in the default fashion. Single-quotes are used
-            # but only in string array values so we can safely allow the reader to
-            # ignore them too
-            quoting=csv.QUOTE_NONE,
-        )
 
-        # some fields in the source tsv have different names in the database, mainly
-        # because they're invalid as python or postgresql names
-        mapping = {
-            "class": "cls",
-            "country/ocean": "country_ocean",
-            "province/state": "province_state",
-        }
         # take the order of the tsv's fields, but replace the names we've changed
-        columns = [mapping.get(field, field) for field in next(reader)]
+        header = next(get_tsv_reader([raw_tsv.readline().decode("utf-8")]))
+        columns = [COLUMN_MAPPING.get(field, field) for field in header]
         # double-check the columns we're going to use are actually in the database model
-        for column in columns:
-            assert column in Specimen.__table__.columns, "TSV fields must match model"
+        tsv_columns = get_tsv_columns()
+        for column_name in columns:
+            assert column_name in tsv_columns, "TSV fields must match model"
 
-        # quote the column names for the copy sql
-        col_str = ", ".join(f'"{column}"' for column in columns)
-        copy_sql = f"COPY {Specimen.__table__.name} ({col_str}) FROM STDIN"
+        log("Loading data into database...")
+        if raw:
+            load_table = create_load_table(columns)
+            try:
+                load_specimens_raw(raw_tsv, load_table, columns)
+                log("Splitting specimens into staging tables...")
+                count = split_specimens(columns)
+            finally:
+                db.session.rollback()
+                db.session.execute(text(f"DROP TABLE IF EXISTS {LOAD_TABLE}"))
+                db.session.commit()
+        else:
+            splitter = SpecimenRowSplitter(columns)
+            copy_sqls = (
+                get_copy_sql(specimen_staging_table, splitter.specimen_columns),
+                get_copy_sql(detail_staging_table, splitter.detail_columns),
+            )
+            to_lower = tuple(columns.index(name) for name in LOWERCASE_COLUMNS)
+            if workers > 1:
+                count = load_specimens_in_parallel(
+                    raw_tsv, splitter, copy_sqls, to_lower, workers, writers
+                )
+            else:
+                count = load_specimens_serially(raw_tsv, splitter, copy_sqls, to_lower)
 
-        # we lowercase the identification and rank on ingest for matching purposes
-        to_lower = (
-            columns.index("identification"),
-            columns.index("identification_rank"),
-        )
+    log(f"{count} specimens loaded")
+    return count
+
+
+def load_specimens_serially(
+    raw_tsv: IO[bytes],
+    splitter: SpecimenRowSplitter,
+    copy_sqls: tuple[str, str],
+    to_lower: tuple[int, ...],
+) -> int:
+    """
+    Loads the specimens from the given BOLD TSV stream into the staging tables, parsing,
+    cleaning, and splitting each row in this process. The stream should be positioned
+    after the header line.
+
+    :param raw_tsv: the binary BOLD TSV stream
+    :param splitter: the splitter to split the rows with
+    :param copy_sqls: the COPY SQL to write the Specimen rows and the SpecimenDetail
+                      rows with
+    :param to_lower: the indexes of the values to lowercase
+    :return: the number of specimens loaded
+    """
+    specimen_copy_sql, detail_copy_sql = copy_sqls
+    text_tsv = TextIOWrapper(raw_tsv, encoding="utf-8", newline="")
+    reader = get_tsv_reader(text_tsv)
+    try:
+        # need a raw connection so that we can use a psycopg cursor for the copy
+        raw_connection = db.engine.raw_connection()
+        count = 0
+        batch_size = 100_000
+        # use copy to get the data in efficiently, but do it in transactions of 100,000
+        # records instead of one massive transaction to avoid a getting a massive hang
+        # at the end. Nothing reads the staging tables until they are swapped in so it
+        # doesn't matter that they are seen partially loaded
+        for batch in batched(reader, batch_size):
+            specimen_rows = []
+            detail_rows = []
+            for specimen_id, row in enumerate(batch, start=count + 1):
+                specimen_row, detail_row = splitter.split(
+                    clean_row(row, to_lower), specimen_id
+                )
+                specimen_rows.append(specimen_row)
+                detail_rows.append(detail_row)
+            with raw_connection.transaction():
+                with raw_connection.cursor() as psycopg_cursor:
+                    with psycopg_cursor.copy(specimen_copy_sql) as copy:
+                        for specimen_row in specimen_rows:
+                            copy.write_row(specimen_row)
+                    with psycopg_cursor.copy(detail_copy_sql) as copy:
+                        for detail_row in detail_rows:
+                            copy.write_row(detail_row)
+            count += len(batch)
+            log(f"{count} written so far...")
+    finally:
+        raw_connection.close()
+
+    return count
+
+
+def load_specimens_raw(
+    raw_tsv: IO[bytes], load_table: TableClause, columns: list[str]
+) -> int:
+    """
+    Loads the specimens from the given BOLD TSV stream into the load table without doing
+    any per-value work in Python. The stream should be positioned after the header line.
+
+    The TSV bytes are copied as they are into the load table, leaving the values to be
+    cleaned when they are split into the staging tables (see split_specimens).
+
+    The TSV is copied using the CSV format with a quote character that doesn't appear
+    in the data as nothing in the TSV is quoted (see get_tsv_reader) and, unlike the
+    text format, the CSV format doesn't treat backslashes as escapes. The "None" values
+    used for missing data in the TSV are converted to NULLs by the copy itself.
+
+    :param raw_tsv: the binary BOLD TSV stream
+    :param load_table: the load table
+    :param columns: the names of the columns in the TSV, in order
+    :return: the number of specimens loaded
+    """
+    copy_sql = (
+        f"{get_copy_sql(load_table, columns)} "
+        f"WITH (FORMAT csv, DELIMITER E'\\t', QUOTE E'\\x01', NULL 'None')"
+    )
+    # need a raw connection so that we can use a psycopg cursor for the copy
+    raw_connection = db.engine.raw_connection()
+    try:
+        with raw_connection.transaction():
+            with raw_connection.cursor() as psycopg_cursor:
+                with psycopg_cursor.copy(copy_sql) as copy:
+                    while data := raw_tsv.read(CHUNK_SIZE):
+                        copy.write(data)
+                count = psycopg_cursor.rowcount
+    finally:
+        raw_connection.close()
+
+    log(f"{count} written")
+    return count
+
+
+def load_specimens_in_parallel(
+    raw_tsv: IO[bytes],
+    splitter: SpecimenRowSplitter,
+    copy_sqls: tuple[str, str],
+    to_lower: tuple[int, ...],
+    workers: int,
+    writers: int,
+) -> int:
+    """
+    Loads the specimens from the given BOLD TSV stream into the staging tables using a
+    pool of worker processes to parse, split, and encode chunks of the TSV and a pool of
+    writer threads to copy the encoded chunks into the database. The stream should be
+    positioned after the header line.
+
+    :param raw_tsv: the binary BOLD TSV stream
+    :param splitter: the splitter to split the rows with
+    :param copy_sqls: the COPY SQL to write the encoded Specimen rows and SpecimenDetail
+                      rows with
+    :param to_lower: the indexes of the values to lowercase
+    :param workers: the number of worker processes
+    :param writers: the number of writer threads
+    :return: the number of specimens loaded
+    """
+    # each writer gets its own raw connection so that we can use a psycopg cursor for
+    # the copy
+    connections = Queue()
+    for _ in range(writers):
+        connections.put(db.engine.raw_connection())
 
+    def write_chunk(encoded: tuple[bytes, bytes, int]) -> int:
+        specimen_data, detail_data, rows = encoded
+        raw_connection = connections.get()
         try:
-            # need a raw connection so that we can use a psycopg cursor for the copy
-            raw_connection = db.engine.raw_connection()
-            log("Loading data into database...")
-            count = 0
-            batch_size = 100_000
-            # use copy to get the data in efficiently, but do it in transactions of
-            # 100,000 records instead of one massive transaction to avoid a getting a
-            # massive hang at the end
-            for batch in batched(reader, batch_size):
-                with raw_connection.transaction():
-                    with raw_connection.cursor() as psycopg_cursor:
+            # each chunk is written in its own transaction, nothing reads the staging
+            # tables until they are swapped in so it doesn't matter that they are seen
+            # partially loaded
+            with raw_connection.transaction():
+                with raw_connection.cursor() as psycopg_cursor:
+                    for copy_sql, data in zip(copy_sqls, (specimen_data, detail_data)):
                         with psycopg_cursor.copy(copy_sql) as copy:
-                            for row in batch:
-                                # do some light value management, converting "None" and
-                                # "" values to actual None values, plus lowercase a
-                                # couple of columns
-                                copy.write_row(
-                                    [
-                                        None
-                                        if value == "None" or not value.strip()
-                                        else value.lower()
-                                        if i in to_lower
-                                        else value
-                                        for i, value in enumerate(row)
-                                    ]
-                                )
-                            count += len(batch)
-                log(f"{count} written so far...")
+                            copy.write(data)
         finally:
-            raw_connection.close()
+            connections.put(raw_connection)
+        return rows
+
+    count = 0
+    try:
+        # use spawn so that the worker processes don't inherit this process's database
+        # connections and threads
+        with (
+            ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as parsers,
+            ThreadPoolExecutor(writers) as writer_pool,
+        ):
+            chunks = number_chunks(iter_chunks(raw_tsv, CHUNK_SIZE))
+            encoded_chunks = iter_in_executor(
+                parsers,
+                partial(encode_chunk, splitter=splitter, to_lower=to_lower),
+                chunks,
+                workers * 2,
+            )
+            for rows in iter_in_executor(
+                writer_pool, write_chunk, encoded_chunks, writers * 2
+            ):
+                if (count + rows) // 100_000 > count // 100_000:
+                    log(f"{count + rows} written so far...")
+                count += rows
+    finally:
+        while not connections.empty():
+            connections.get().close()
+
+    log(f"{count} written")
+    return count
+
+
+class SpecimenChanges(NamedTuple):
+    added: int
+    updated: int
+    removed: int
+    # the BINs which the changed specimens were in before or are in after the changes
+    bin_uris: list[str]
+
+
+def apply_specimen_changes() -> SpecimenChanges:
+    """
+    Updates the Specimen and SpecimenDetail tables to match the data in their staging
+    tables by only adding, updating, and removing the specimens which differ between
+    them, rather than replacing all the data. Specimens are matched using their
+    processid and a hash of all their values is used to find the ones which have
+    changed. The changes are made in a single transaction so they are seen all at once.
+
+    :return: the number of specimens added, updated, and removed and the affected BINs
+    """
+    live_name = Specimen.__table__.name
+    staging_name = get_staging_name(Specimen.__table__)
+    detail_name = SpecimenDetail.__table__.name
+    detail_staging_name = get_staging_name(SpecimenDetail.__table__)
+    columns = [
+        column.name for column in Specimen.__table__.columns if column.name != "id"
+    ]
+    detail_columns = [
+        column.name
+        for column in SpecimenDetail.__table__.columns
+        if column.name != "specimen_id"
+    ]
+
+    def row_hash(alias: str, detail_alias: str) -> str:
+        values = ", ".join(
+            [
+                *(f'{alias}."{column}"' for column in columns),
+                *(f'{detail_alias}."{column}"' for column in detail_columns),
+            ]
+        )
+        return f"md5(CAST(ROW({values}) AS text))"
+
+    db.session.execute(text(f"ANALYZE {staging_name}"))
+    db.session.execute(text(f"ANALYZE {detail_staging_name}"))
+    duplicates = db.session.execute(
+        text(f"SELECT count(*) - count(DISTINCT processid) FROM {staging_name}")
+    ).scalar()
+    if duplicates:
+        raise Exception(
+            f"Found {duplicates} specimens without a unique processid, cannot import "
+            "incrementally"
+        )
+
+    # find the specimens which need to be changed. The live specimen's id is used to
+    # find the specimens to update and remove, the staging specimen's id to find the
+    # new values
+    db.session.execute(
+        text(
+            f"""
+            CREATE TEMPORARY TABLE specimen_changes ON COMMIT DROP AS
+            SELECT s.id, st.id AS staging_id,
+                CASE
+                    WHEN s.id IS NULL THEN 'added'
+                    WHEN st.id IS NULL THEN 'removed'
+                    ELSE 'updated'
+                END AS change
+            FROM (
+                {live_name} s LEFT JOIN {detail_name} d ON d.specimen_id = s.id
+            ) FULL JOIN (
+                {staging_name} st
+                    LEFT JOIN {detail_staging_name} dt ON dt.specimen_id = st.id
+            ) ON st.processid = s.processid
+            WHERE s.id IS NULL
+               OR st.id IS NULL
+               OR {row_hash("s", "d")} <> {row_hash("st", "dt")}
+            """
+        )
+    )
+    counts = dict(
+        db.session.execute(
+            text("SELECT change, count(*) FROM specimen_changes GROUP BY change")
+        ).all()
+    )
+    # find the BINs the changes will affect before making them so that we get both the
+    # old and new BINs of the updated specimens
+    bin_uris = db.session.scalars(
+        text(
+            f"""
+            SELECT s.bin_uri
+            FROM {live_name} s JOIN specimen_changes c ON c.id = s.id
+            WHERE s.bin_uri IS NOT NULL
+            UNION
+            SELECT st.bin_uri
+            FROM {staging_name} st JOIN specimen_changes c ON c.staging_id = st.id
+            WHERE st.bin_uri IS NOT NULL
+            """
+        )
+    ).all()
+
+    # the removed specimens' details are removed by the foreign key's cascade
+    db.session.execute(
+        text(
+            f"""
+            DELETE FROM {live_name}
+            WHERE id IN (SELECT id FROM specimen_changes WHERE change = 'removed')
+            """
+        )
+    )
+    assignments = ", ".join(f'"{column}" = st."{column}"' for column in columns)
+    db.session.execute(
+        text(
+            f"""
+            UPDATE {live_name} s SET {assignments}
+            FROM specimen_changes c JOIN {staging_name} st ON st.id = c.staging_id
+            WHERE c.change = 'updated' AND s.id = c.id
+            """
+        )
+    )
+    # the ids the specimens were loaded with are only unique within the load so the new
+    # specimens are given ids from the Specimen table's sequence, only using up as many
+    # values from it as there are new specimens
+    db.session.execute(
+        text(
+            """
+            UPDATE specimen_changes SET id = nextval(CAST(:sequence AS regclass))
+            WHERE change = 'added'
+            """
+        ),
+        {"sequence": get_specimen_id_sequence()},
+    )
+    col_str = ", ".join(f'"{column}"' for column in ["id", *columns])
+    values = ", ".join(f'st."{column}"' for column in columns)
+    db.session.execute(
+        text(
+            f"""
+            INSERT INTO {live_name} ({col_str})
+            SELECT c.id, {values}
+            FROM specimen_changes c JOIN {staging_name} st ON st.id = c.staging_id
+            WHERE c.change = 'added'
+            """
+        )
+    )
+    detail_col_str = ", ".join(f'"{column}"' for column in detail_columns)
+    detail_values = ", ".join(f'dt."{column}"' for column in detail_columns)
+    detail_assignments = ", ".join(
+        f'"{column}" = excluded."{column}"' for column in detail_columns
+    )
+    db.session.execute(
+        text(
+            f"""
+            INSERT INTO {detail_name} (specimen_id, {detail_col_str})
+            SELECT c.id, {detail_values}
+            FROM specimen_changes c
+                JOIN {detail_staging_name} dt ON dt.specimen_id = c.staging_id
+            WHERE c.change <> 'removed'
+            ON CONFLICT (specimen_id) DO UPDATE SET {detail_assignments}
+            """
+        )
+    )
+    db.session.commit()
+
+    return SpecimenChanges(
+        counts.get("added", 0),
+        counts.get("updated", 0),
+        counts.get("removed", 0),
+        bin_uris,
+    )
+
+
+def rebuild_bold_tables(
+    bold_snapshot: Path,
+    index_workers: int = 1,
+    maintenance_work_mem: str | None = None,
+    workers: int = 1,
+    writers: int = 1,
+    raw: bool = False,
+    incremental: bool = False,
+):
+    """
+    Given the path to a BOLD snapshot, read the TSV in that snapshot and replace the
+    current data in the Specimen and SpecimenDetail tables with the data. The data is
+    loaded into staging tables without any indexes, then the indexes are built in
+    parallel, and then the staging tables are swapped in for the live tables. This means
+    the old data can still be used while the rebuild is running. Once the specimens are
+    loaded, the BIN summaries and the taxon to BIN lookup are rebuilt from them.
+
+    If incremental is True, the staging tables are instead compared to the live tables
+    and only the specimens which have been added, updated, or removed are changed (see
+    apply_specimen_changes). Only the BIN summaries and taxon to BIN links of the BINs
+    affected by the changes are rebuilt. The counts of each kind of change are recorded
+    in the data source status.
+
+    The time taken by each phase of the rebuild is reported at the end.
+
+    :param bold_snapshot: Path to the BOLD snapshot
+    :param index_workers: the number of indexes to build at once, defaults to 1
+    :param maintenance_work_mem: the maintenance_work_mem to use for each index build
+                                 (e.g. "1GB"), defaults to None which means the server's
+                                 setting is used
+    :param workers: the number of processes to parse the TSV with, defaults to 1
+    :param writers: the number of connections to write to the database with when using
+                    more than one worker, defaults to 1
+    :param raw: whether to stream the TSV straight into the database and clean it there
+                instead of parsing it in Python, defaults to False
+    :param incremental: whether to only change the specimens which differ from the
+                        current data, defaults to False
+    """
+    timer = PhaseTimer()
+
+    with timer.phase("Loading specimens"):
+        load_specimens(bold_snapshot, workers, writers, raw)
 
     version = os.environ.get("UKBOL_BOLD_DATA_VERSION", None)
+    if incremental:
+        with timer.phase("Applying changes"):
+            try:
+                changes = apply_specimen_changes()
+            finally:
+                drop_staging_table(Specimen.__table__)
+                drop_staging_table(SpecimenDetail.__table__)
+        bin_uris = changes.bin_uris
+        log(
+            f"Added {changes.added}, updated {changes.updated}, and removed "
+            f"{changes.removed} specimens, affecting {len(bin_uris)} BINs"
+        )
+    else:
+        with timer.phase("Building indexes"):
+            build_staging_indexes(
+                Specimen.__table__,
+                SpecimenDetail.__table__,
+                workers=index_workers,
+                maintenance_work_mem=maintenance_work_mem,
+            )
+
+        with timer.phase("Swapping in specimens"):
+            swap_in_staging_tables(Specimen.__table__, SpecimenDetail.__table__)
+            reset_specimen_id_sequence()
+
+        # rebuild the summaries and lookup for all BINs
+        bin_uris = None
+        changes = None
+        log(f"Added {Specimen.query.count()} specimens")
+
+    with timer.phase("Rebuilding BIN summaries"):
+        rebuild_bin_summaries(bin_uris)
+    log(f"Summarised {BinSummary.query.count()} BINs")
+
+    with timer.phase("Rebuilding taxon to BIN lookup"):
+        rebuild_taxon_bins(bin_uris)
+
+    # the status is only updated once the derived tables are rebuilt as it changes the
+    # data version, which the response cache and export jobs are keyed on. Updating it
+    # any earlier would let responses built from the old derived data be stored under
+    # the new version
     specimen_count = Specimen.query.count()
-    update_status("bold-specimens", specimen_count, version)
-    log(f"Added {specimen_count} specimens")
+    if changes is None:
+        update_status("bold-specimens", specimen_count, version)
+    else:
+        update_status(
+            "bold-specimens",
+            specimen_count,
+            version,
+            changes.added,
+            changes.updated,
+            changes.removed,
+        )
+
+    timer.report()
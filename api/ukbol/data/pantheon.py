@@ -6,41 +6,45 @@ from itertools import batched
 from pathlib import Path
 from typing import Iterable
 
-from ukbol.data.utils import update_status
+from sqlalchemy import insert
+
+from ukbol.data.utils import (
+    build_staging_indexes,
+    create_staging_table,
+    swap_in_staging_tables,
+    update_status,
+)
 from ukbol.extensions import db
 from ukbol.model import PantheonSpecies
 from ukbol.utils import log
 
 
-def iter_records(rows: Iterable[dict[str, str]]) -> Iterable[PantheonSpecies]:
+def iter_records(rows: Iterable[dict[str, str]]) -> Iterable[dict[str, str | None]]:
     """
     Given an iterable of rows from the PANTHEON csv snapshot as dicts, return an
-    iterable of PantheonSpecies objects created from them.
+    iterable of dicts which can be inserted into the PantheonSpecies table.
 
     :param rows: the rows as dicts
-    :return: an iterable of PantheonSpecies objects
+    :return: an iterable of dicts of PantheonSpecies column values
     """
     for row in rows:
-        yield PantheonSpecies(
-            **{
-                # convert field names to lowercase with underscores instead of spaces to
-                # match our table model, and convert empty str values into Nones
-                field.replace(" ", "_").lower(): value if value.strip() else None
-                for field, value in row.items()
-            }
-        )
+        yield {
+            # convert field names to lowercase with underscores instead of spaces to
+            # match our table model, and convert empty str values into Nones
+            field.replace(" ", "_").lower(): value if value.strip() else None
+            for field, value in row.items()
+        }
 
 
 def rebuild_pantheon_tables(pantheon_snapshot: Path):
     """
     Given the path to a PANTHEON CSV snapshot, read the file and replace the current
-    data in the PantheonSpecies table with the data. All old data is deleted.
+    data in the PantheonSpecies table with the data. The data is loaded into a staging
+    table which is swapped in for the PantheonSpecies table once it is complete.
 
     :param pantheon_snapshot: Path to the PANTHEON CSV snapshot
     """
-    log("Removing existing data...")
-    PantheonSpecies.query.delete()
-    db.session.commit()
+    staging_table = create_staging_table(PantheonSpecies.__table__)
 
     # increase the field size limit to avoid errors when reading the PANTHEON csv
     csv.field_size_limit(sys.maxsize)
@@ -52,12 +56,15 @@ def rebuild_pantheon_tables(pantheon_snapshot: Path):
         log("Loading data into database...")
         count = 0
         for batch in batched(iter_records(reader), 1000):
-            db.session.add_all(batch)
+            db.session.execute(insert(staging_table), list(batch))
             db.session.commit()
             count += len(batch)
             if count % 1000 == 0:
                 log(f"{count} so far...")
 
+    build_staging_indexes(PantheonSpecies.__table__)
+    swap_in_staging_tables(PantheonSpecies.__table__)
+
     version = os.environ.get("UKBOL_PANTHEON_DATA_VERSION", None)
     species_count = PantheonSpecies.query.count()
     update_status("pantheon-species", species_count, version)
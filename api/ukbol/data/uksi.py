@@ -1,90 +1,263 @@
+import gzip
+import json
+import shutil
+import sys
 from collections import deque
-from itertools import batched
-from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, count
+from pathlib import Path
+from typing import Iterable, NamedTuple
 
-import networkx as nx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
 
-from ukbol.data.utils import get, update_status
+from ukbol.data.bins import rebuild_taxon_bins
+from ukbol.data.utils import (
+    build_staging_indexes,
+    create_staging_table,
+    get,
+    get_copy_sql,
+    iter_in_executor,
+    swap_in_staging_tables,
+    update_status,
+)
 from ukbol.extensions import db
 from ukbol.model import Synonym, Taxon
 from ukbol.utils import log
 
 USER_AGENT = "UKBoL taxonomy updater"
+NBN_SEARCH_URL = "https://species-ws.nbnatlas.org/search"
+# their API seems to cope well with us trawling it for all its data and 200 seems to be
+# an ok chunk size
+PAGE_SIZE = 200
+# failed requests are retried this many times, waiting BACKOFF_FACTOR * 2^(n - 1)
+# seconds between each retry
+RETRIES = 5
+BACKOFF_FACTOR = 1
 # the names we want to be the root taxa
 ROOT_NAMES = ["animalia", "chromista", "fungi", "plantae"]
 # some ranks we just want to ignore and not add to the database
 UNACCEPTABLE_RANKS = ["unranked", "unknown", "functional group"]
+# the subdirectory of the cache directory the NBN pages are cached in, this is ours to
+# remove once a rebuild has completed without touching anything else in the directory
+NBN_PAGE_CACHE_DIR = "nbn-pages"
 
 
-def get_from_nbn() -> Iterable[dict]:
+def create_nbn_session(workers: int) -> requests.Session:
     """
-    Retrieves all taxon data from NBN using their species search endpoint and yields the
-    individual records as a continuous stream of dicts.
+    Creates a requests Session for talking to the NBN API with a connection pool big
+    enough for the given number of workers and automatic retries with backoff.
 
-    :return: yields dicts
+    :param workers: the number of threads which will be using the session at once
+    :return: a Session object
     """
-    url = "https://species-ws.nbnatlas.org/search"
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(pool_maxsize=workers, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["user-agent"] = USER_AGENT
+    return session
+
+
+def get_nbn_page(
+    session: requests.Session, url: str, start: int, cache_dir: Path | None = None
+) -> dict:
+    """
+    Retrieves a single page of taxon data from the NBN species search endpoint, starting
+    at the given row offset, and returns the "searchResults" part of the response. If a
+    cache directory is given, the page is written to it after it is retrieved and read
+    from it instead of NBN if it is already there.
+
+    :param session: the Session to use for the request
+    :param url: the URL of the search endpoint
+    :param start: the row offset of the page
+    :param cache_dir: the directory to cache the page in, optional
+    :return: the searchResults dict from the response
+    """
+    cache_file = cache_dir / f"{start}-{PAGE_SIZE}.json" if cache_dir else None
+    if cache_file is not None and cache_file.exists():
+        with cache_file.open() as f:
+            return json.load(f)
+
     params = {
         # this seems to work, but no idea how stable this is
         "fq": "idxtype:TAXON",
-        # their API seems to cope well with us trawling it for all its data and 200
-        # seems to be an ok chunk size
-        "pageSize": 200,
+        "pageSize": PAGE_SIZE,
         # fyi: this isn't a page number, it's a pure row number offset
-        "start": 0,
+        "start": start,
     }
+    r = session.get(url, params=params, timeout=60)
+    r.raise_for_status()
+    search_results = r.json()["searchResults"]
 
-    count = 0
-    log("Downloading taxonomy data from NBN API...")
-    while True:
-        r = requests.get(url, params=params, headers={"user-agent": USER_AGENT})
-        data = r.json()
-        results = data["searchResults"]["results"]
-        if not results:
-            break
-        else:
-            count += len(results)
+    if cache_file is not None:
+        # write to a temp file first so that we never leave a partial page in the cache
+        temp_file = cache_file.with_suffix(".tmp")
+        with temp_file.open("w") as f:
+            json.dump(search_results, f)
+        temp_file.replace(cache_file)
+
+    return search_results
+
+
+def get_from_nbn(
+    workers: int = 4, cache_dir: Path | None = None, url: str | None = None
+) -> Iterable[dict]:
+    """
+    Retrieves all taxon data from NBN using their species search endpoint and yields the
+    individual records as a continuous stream of dicts.
+
+    The first page is retrieved on its own to find out how many records there are and
+    then the rest of the pages are retrieved in parallel using the given number of
+    worker threads. The records are still yielded in order. Failed requests are retried
+    with a backoff. If a cache directory is given then each page is written to it as it
+    is retrieved and pages already in it are used instead of requesting them again,
+    which means an interrupted harvest can be resumed. The pages are written to the
+    NBN_PAGE_CACHE_DIR subdirectory of the cache directory.
+
+    :param workers: the number of pages to request at once
+    :param cache_dir: the directory to cache the pages in, optional
+    :param url: the URL of the search endpoint, defaults to NBN_SEARCH_URL
+    :return: yields dicts
+    """
+    if url is None:
+        url = NBN_SEARCH_URL
+    if cache_dir is not None:
+        cache_dir = cache_dir / NBN_PAGE_CACHE_DIR
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    session = create_nbn_session(workers)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    get_page = partial(get_nbn_page, session, url, cache_dir=cache_dir)
+
+    try:
+        log("Downloading taxonomy data from NBN API...")
+        first_page = get_page(0)
+        total = first_page["totalRecords"]
+        # the pages we know about from the total record count
+        known_starts = range(PAGE_SIZE, total, PAGE_SIZE)
+        # the total can change while we're harvesting so once we've got all the pages we
+        # know about, carry on getting pages one at a time until we get an empty one
+        extra_starts = count((len(known_starts) + 1) * PAGE_SIZE, PAGE_SIZE)
+        # limit how many pages are requested ahead of the ones being consumed so that
+        # we don't end up holding most of the taxonomy in memory
+        pages = chain(
+            [first_page],
+            iter_in_executor(executor, get_page, known_starts, workers * 2),
+            map(get_page, extra_starts),
+        )
+
+        record_count = 0
+        for page in pages:
+            results = page["results"]
+            if not results:
+                break
+            record_count += len(results)
             yield from results
-            params["start"] += len(results)
-        # log some progress info every 10,000 records
-        if count % 10000 == 0:
-            log(f"{count}/{data['searchResults']['totalRecords']}")
-    log(f"Downloaded {count} records from NBN API...")
+            # log some progress info every 10,000 records
+            if record_count % 10000 == 0:
+                log(f"{record_count}/{total}")
+        log(f"Downloaded {record_count} records from NBN API...")
+    finally:
+        executor.shutdown(cancel_futures=True)
+        session.close()
+
+
+def read_snapshot(snapshot: Path) -> Iterable[dict]:
+    """
+    Reads the NBN records from a gzipped JSON lines snapshot file created by
+    write_snapshot and yields them as dicts.
 
+    :param snapshot: the Path to the snapshot file
+    :return: yields dicts
+    """
+    log(f"Reading taxonomy data from snapshot {snapshot}...")
+    with gzip.open(snapshot, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_snapshot(records: Iterable[dict], snapshot: Path) -> Iterable[dict]:
+    """
+    Writes the given NBN records to a gzipped JSON lines snapshot file as they are
+    yielded back to the caller. The snapshot is written to a temporary file alongside
+    the target path and only moved into place once all the records have been written so
+    that a failed harvest never leaves a partial snapshot behind.
 
-def iter_taxa(graph: nx.DiGraph, *root_ids) -> Iterable[Taxon]:
+    :param records: the records to write
+    :param snapshot: the Path to write the snapshot file to
+    :return: yields the records
     """
-    Given a directed taxonomy graph, yield the roots and all the taxa below them in a
-    breadth first fashion so that they can be inserted into the database successfully
-    without creating any dependency issues.
+    snapshot.parent.mkdir(parents=True, exist_ok=True)
+    temp_snapshot = snapshot.with_name(f"{snapshot.name}.tmp")
+    with gzip.open(temp_snapshot, "wt", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record))
+            f.write("\n")
+            yield record
+    temp_snapshot.replace(snapshot)
+    log(f"Wrote taxonomy snapshot to {snapshot}")
+
+
+class TaxonRecord(NamedTuple):
+    id: str
+    name: str
+    authorship: str | None
+    rank: str
+    parent_id: str | None
+
+
+class SynonymRecord(NamedTuple):
+    id: str
+    name: str
+    authorship: str | None
+    rank: str
+    taxon_id: str
+
+
+def iter_taxa(
+    taxa: dict[str, TaxonRecord], children: dict[str, list[str]], *root_ids
+) -> Iterable[TaxonRecord]:
+    """
+    Given the taxa and the IDs of each taxon's children, yield the roots and all the
+    taxa below them in a breadth first fashion so that they can be inserted into the
+    database successfully without creating any dependency issues.
 
     Some taxa will be skipped based a few different rules to try and filter out some of
     the mess in the UKSI taxonomy on NBN.
 
-    :param graph: the taxonomy graph
+    :param taxa: a dict of taxon IDs to TaxonRecords
+    :param children: a dict of taxon IDs to the IDs of their children
     :param root_ids: the taxon IDs to use as the roots
-    :return: yields Taxon objects
+    :return: yields TaxonRecords
     """
     # create a queue with the root IDs to start with
     id_queue = deque(root_ids)
     while id_queue:
         taxon_id = id_queue.popleft()
-        taxon = graph.nodes[taxon_id]["taxon"]
+        taxon = taxa[taxon_id]
         # grab the parent taxon
-        parent_id = next(graph.predecessors(taxon_id))
-        parent = graph.nodes[parent_id]["taxon"]
+        parent = taxa.get(taxon.parent_id)
 
         # ignore some ranks that we really don't want
         if taxon.rank in UNACCEPTABLE_RANKS:
             continue
         # if this is a species, and it's not under a genus, ignore it
-        if taxon.rank == "species" and parent.rank != "genus":
+        if taxon.rank == "species" and (parent is None or parent.rank != "genus"):
             continue
 
         # if the taxon ID is a root ID, set the parent to None
         if taxon_id in root_ids:
-            taxon.parent_id = None
+            taxon = taxon._replace(parent_id=None)
 
         yield taxon
 
@@ -93,27 +266,73 @@ def iter_taxa(graph: nx.DiGraph, *root_ids) -> Iterable[Taxon]:
             continue
 
         # add the children to the queue
-        id_queue.extend(graph.successors(taxon_id))
+        id_queue.extend(children.get(taxon_id, ()))
+
+
+def get_nested_sets(taxa: list[TaxonRecord]) -> dict[str, tuple[int, int]]:
+    """
+    Given a list of taxa which form a forest (i.e. every taxon's parent is either None
+    or another taxon in the list), return the nested set left and right values for each
+    taxon. These are assigned using a depth first traversal of each tree so that all
+    the descendants of a taxon have left values between the taxon's left and right
+    values, and all the ancestors of a taxon have a lower left value and a higher right
+    value than the taxon.
+
+    :param taxa: the list of TaxonRecords
+    :return: a dict of taxon IDs to (left, right) tuples
+    """
+    children = {}
+    roots = []
+    for taxon in taxa:
+        if taxon.parent_id is None:
+            roots.append(taxon.id)
+        else:
+            children.setdefault(taxon.parent_id, []).append(taxon.id)
+
+    lefts = {}
+    nested_sets = {}
+    counter = 0
+    # the stack holds taxon IDs and a flag indicating whether we've visited their
+    # children
+    stack = [(root, False) for root in reversed(roots)]
+    while stack:
+        taxon_id, visited = stack.pop()
+        counter += 1
+        if visited:
+            nested_sets[taxon_id] = (lefts.pop(taxon_id), counter)
+        else:
+            lefts[taxon_id] = counter
+            stack.append((taxon_id, True))
+            stack.extend(
+                (child, False) for child in reversed(children.get(taxon_id, ()))
+            )
+    return nested_sets
 
 
-def rebuild_uksi_tables():
+def build_taxonomy(records: Iterable[dict]) -> tuple[list[tuple], list[SynonymRecord]]:
     """
-    Clear out the taxon and synonym tables, and then repopulate them with data derived
-    from the NBN API.
+    Given the records from NBN, build the taxonomy we want to store in the database.
+    The taxa are returned as tuples of the TaxonRecord fields followed by the nested set
+    left and right values, in the order they should be inserted into the database (i.e.
+    parents before children). The synonyms returned are only the ones which link to one
+    of the returned taxa.
+
+    The taxonomy is held as plain tuples in a dict, with a dict of child ID lists
+    linking parents to children, to keep the memory use down as there are hundreds of
+    thousands of taxa.
+
+    :param records: the NBN records
+    :return: a 2-tuple of the taxon rows and the SynonymRecords
     """
-    # we're going to build a directed graph from the taxonomy data so that we can add
-    # the rows into the database in the right order, thus ensuring all the foreign keys
-    # get inserted ok and in the right order (i.e. the referenced row is entered before
-    # the referer)
-    graph = nx.DiGraph()
+    taxa: dict[str, TaxonRecord] = {}
     # collect synonyms in here as we go
     synonyms = []
     # we only want the taxonomy at and below specific taxa, so when we spot them while
     # crawling NBN, we'll add them to the root_ids list below
     root_ids = []
 
-    log("Creating taxonomy graph...")
-    for record in get_from_nbn():
+    log("Creating taxonomy...")
+    for record in records:
         # we only want uksi records
         if get(record, "infoSourceName", lowercase=True) != "uksi":
             continue
@@ -121,81 +340,130 @@ def rebuild_uksi_tables():
         taxon_id = record["guid"]
         # lowercase both the name and the rank to make matching easier
         name = record["scientificName"].lower()
-        rank = record["rank"].lower()
+        rank = sys.intern(record["rank"].lower())
         authorship = record["scientificNameAuthorship"]
 
         if record["taxonomicStatus"] == "synonym":
             synonyms.append(
-                Synonym(
-                    id=taxon_id,
-                    name=name,
-                    authorship=authorship,
-                    rank=rank,
-                    taxon_id=record["acceptedConceptID"],
+                SynonymRecord(
+                    taxon_id, name, authorship, rank, record["acceptedConceptID"]
                 )
             )
         else:
             parent_id = record["parentGuid"]
             if not parent_id:
                 parent_id = None
-            taxon = Taxon(
-                id=taxon_id,
-                name=name,
-                authorship=authorship,
-                rank=rank,
-                parent_id=parent_id,
-            )
-            graph.add_node(taxon.id, taxon=taxon)
+            taxa[taxon_id] = TaxonRecord(taxon_id, name, authorship, rank, parent_id)
             if name in ROOT_NAMES:
-                root_ids.append(taxon.id)
-
-    # add edges linking children to parents
-    for taxon_id, data in graph.nodes(data=True):
-        taxon = data["taxon"]
-        if taxon.parent_id:
-            if taxon.parent_id in graph:
-                # add a link from the parent to this taxon
-                graph.add_edge(taxon.parent_id, taxon_id)
-            else:
-                # the taxon has a link to a parent we don't know, do not create an edge
-                # and remove the parent ID reference from the taxon to avoid breaking
-                # the database's foreign key constraints on the parent ID. There are two
-                # scenarios where this might happen (at least that I can think of):
-                # firstly, the taxon parent isn't in the UKSI part of the NBN taxonomy,
-                # I haven't seen this happen, but I guess it's possible? Secondly, the
-                # taxon links to a parent ID that doesn't exist, which I have seen
-                # happen and is why this code exists in the first place.
-                taxon.parent_id = None
-
-    log("Graph creation complete")
-    log(f"Details: {len(graph.nodes)} nodes, {len(graph.edges)} edges")
+                root_ids.append(taxon_id)
+
+    # link parents to their children. If the taxon has a link to a parent we don't know,
+    # we don't create a link and the taxon won't be reachable from the roots so it won't
+    # end up in the database and break the foreign key constraints on the parent ID.
+    # There are two scenarios where this might happen (at least that I can think of):
+    # firstly, the taxon parent isn't in the UKSI part of the NBN taxonomy, I haven't
+    # seen this happen, but I guess it's possible? Secondly, the taxon links to a parent
+    # ID that doesn't exist, which I have seen happen and is why this code exists in the
+    # first place.
+    children: dict[str, list[str]] = {}
+    link_count = 0
+    for taxon in taxa.values():
+        if taxon.parent_id in taxa:
+            children.setdefault(taxon.parent_id, []).append(taxon.id)
+            link_count += 1
+
+    log("Taxonomy creation complete")
+    log(f"Details: {len(taxa)} taxa, {link_count} parent links")
     log(f"Also found {len(synonyms)} synonyms")
 
-    log("Removing existing data...")
-    Synonym.query.delete()
-    Taxon.query.delete()
-    db.session.commit()
-
-    batch_size = 1000
-    log("Writing taxa to database...")
-    # keep track of the taxon IDs we've actually entered into the database for later
-    added_ids = set()
-    for batch in batched(iter_taxa(graph, *root_ids), batch_size):
-        added_ids.update(taxon.id for taxon in batch)
-        db.session.add_all(batch)
-        db.session.commit()
-
-    log("Writing synonyms to database...")
-    for batch in batched(synonyms, batch_size):
-        # only add synonyms which have a taxon in the database to relate to
-        db.session.add_all(
-            synonym for synonym in batch if synonym.taxon_id in added_ids
-        )
-        db.session.commit()
+    log("Indexing taxonomy...")
+    ordered_taxa = list(iter_taxa(taxa, children, *root_ids))
+    # we don't need these anymore, free them up before creating the rows
+    del taxa, children
+    nested_sets = get_nested_sets(ordered_taxa)
+    taxon_rows = [(*taxon, *nested_sets[taxon.id]) for taxon in ordered_taxa]
+    # only keep synonyms which have a taxon to relate to
+    synonyms = [synonym for synonym in synonyms if synonym.taxon_id in nested_sets]
+    return taxon_rows, synonyms
+
+
+def rebuild_uksi_tables(
+    workers: int = 4,
+    cache_dir: Path | None = None,
+    from_snapshot: Path | None = None,
+    save_snapshot: Path | None = None,
+):
+    """
+    Replace the data in the taxon and synonym tables with data derived from the NBN
+    API. The data is loaded into staging tables which are swapped in for the taxon and
+    synonym tables once they are complete, so the old taxonomy can still be used while
+    the rebuild is running. Once the taxonomy is loaded, the taxon to BIN lookup is
+    rebuilt.
+
+    If a cache directory is given, the pages retrieved from NBN are cached in it so that
+    if the rebuild fails it can be resumed without having to download everything again.
+    The cached pages are removed once the rebuild has completed successfully, anything
+    else in the cache directory is left alone.
+
+    Instead of using the NBN API, the data can be read from a local snapshot file
+    created previously by passing save_snapshot. This avoids having to download the
+    whole taxonomy again when reloading the database.
+
+    :param workers: the number of pages to request from NBN at once
+    :param cache_dir: the directory to cache the NBN pages in, optional
+    :param from_snapshot: a snapshot file to read the data from instead of NBN, optional
+    :param save_snapshot: a path to write a snapshot of the data to, optional
+    """
+    if from_snapshot is not None:
+        records = read_snapshot(from_snapshot)
+    else:
+        records = get_from_nbn(workers, cache_dir)
+    if save_snapshot is not None:
+        records = write_snapshot(records, save_snapshot)
+
+    taxa, synonyms = build_taxonomy(records)
+
+    taxon_columns = [*TaxonRecord._fields, "lft", "rgt"]
+    synonym_columns = SynonymRecord._fields
+
+    taxon_staging_table = create_staging_table(Taxon.__table__)
+    synonym_staging_table = create_staging_table(Synonym.__table__)
+
+    # need a raw connection so that we can use a psycopg cursor for the copy
+    raw_connection = db.engine.raw_connection()
+    try:
+        with raw_connection.transaction():
+            with raw_connection.cursor() as psycopg_cursor:
+                log("Writing taxa to database...")
+                copy_sql = get_copy_sql(taxon_staging_table, taxon_columns)
+                with psycopg_cursor.copy(copy_sql) as copy:
+                    for taxon in taxa:
+                        copy.write_row(taxon)
+
+                log("Writing synonyms to database...")
+                copy_sql = get_copy_sql(synonym_staging_table, synonym_columns)
+                with psycopg_cursor.copy(copy_sql) as copy:
+                    for synonym in synonyms:
+                        copy.write_row(synonym)
+    finally:
+        raw_connection.close()
+
+    # swap both tables in together as the synonyms reference the taxa
+    build_staging_indexes(Taxon.__table__, Synonym.__table__)
+    swap_in_staging_tables(Taxon.__table__, Synonym.__table__)
 
     taxon_count = Taxon.query.count()
     synonym_count = Synonym.query.count()
+    log(f"Added {taxon_count} taxa and {synonym_count} synonyms")
+
+    log("Rebuilding taxon to BIN lookup...")
+    rebuild_taxon_bins()
+    # only update the statuses, and therefore the data version, once the lookup is
+    # rebuilt so that nothing built from the old lookup is cached under the new version
     update_status("uksi-taxa", taxon_count)
     update_status("uksi-synonym", synonym_count)
-    log(f"Added {taxon_count} taxa and {synonym_count} synonyms")
+    if cache_dir is not None and from_snapshot is None:
+        log("Removing NBN page cache...")
+        shutil.rmtree(cache_dir / NBN_PAGE_CACHE_DIR, ignore_errors=True)
+
     log("UKSI derived tables rebuilt")
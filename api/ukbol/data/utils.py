@@ -1,7 +1,24 @@
+import hashlib
+import re
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from datetime import datetime, timezone
+from typing import Callable, Iterable, NamedTuple, Sequence, TypeVar
+
+from psycopg.errors import LockNotAvailable
+from sqlalchemy import Table, TableClause, column, table, text
+from sqlalchemy.exc import OperationalError
 
 from ukbol.extensions import db
 from ukbol.model import DataSourceStatus
+from ukbol.utils import log
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# the data sources the taxon endpoints' responses and the specimen exports depend on
+TAXON_DATA_SOURCES = ("bold-specimens", "uksi-taxa", "uksi-synonym")
 
 
 def get(
@@ -27,17 +44,463 @@ def get(
     return None
 
 
-def update_status(name: str, total: int, version: str | None = None):
+def get_copy_sql(table: TableClause, columns: Sequence[str]) -> str:
+    """
+    Returns the SQL for a COPY FROM STDIN into the given table with the given columns.
+    The column names are quoted as some of them aren't valid PostgreSQL names without
+    it (e.g. "order").
+
+    :param table: the table to copy into
+    :param columns: the columns in the order the values will be written
+    :return: the COPY SQL
+    """
+    col_str = ", ".join(f'"{name}"' for name in columns)
+    return f"COPY {table.name} ({col_str}) FROM STDIN"
+
+
+def get_staging_name(live_table: Table) -> str:
+    """
+    Returns the name of the staging table used when rebuilding the given table.
+
+    :param live_table: the table being rebuilt
+    :return: the staging table's name
+    """
+    return f"{live_table.name}_staging"
+
+
+def drop_staging_table(live_table: Table):
+    """
+    Drops the staging table for the given table, if it exists.
+
+    :param live_table: the table being rebuilt
+    """
+    db.session.execute(text(f"DROP TABLE IF EXISTS {get_staging_name(live_table)}"))
+    db.session.commit()
+
+
+def create_staging_table(live_table: Table) -> TableClause:
+    """
+    Creates an empty staging table with the same columns, defaults, and not null
+    constraints as the given table. No indexes, keys, or foreign keys are created on it
+    so that it can be loaded quickly, these are all created when it is swapped in by
+    swap_in_staging_tables. If a staging table has been left over from a failed rebuild
+    it is dropped first.
+
+    :param live_table: the table to create a staging table for
+    :return: a table clause representing the staging table which can be used to insert
+             into it
+    """
+    drop_staging_table(live_table)
+    staging_name = get_staging_name(live_table)
+    db.session.execute(
+        text(f"CREATE TABLE {staging_name} (LIKE {live_table.name} INCLUDING DEFAULTS)")
+    )
+    db.session.commit()
+    return table(staging_name, *(column(col.name) for col in live_table.columns))
+
+
+def get_indexes(table_name: str) -> list[tuple[str, str, str | None]]:
+    """
+    Returns details of the indexes on the given table from the database's catalog. Each
+    index is represented as a tuple containing the index's name, the SQL definition of
+    the index, and "p" or "u" if the index backs the table's primary key or a unique
+    constraint respectively (None otherwise).
+
+    :param table_name: the name of the table
+    :return: a list of index details
+    """
+    return [
+        tuple(row)
+        for row in db.session.execute(
+            text(
+                """
+                SELECT i.relname, pg_get_indexdef(i.oid), c.contype
+                FROM pg_index x
+                    JOIN pg_class i ON i.oid = x.indexrelid
+                    LEFT JOIN pg_constraint c
+                        ON c.conindid = x.indexrelid AND c.contype IN ('p', 'u')
+                WHERE x.indrelid = CAST(:table AS regclass)
+                ORDER BY c.contype NULLS LAST, i.relname
+                """
+            ),
+            {"table": table_name},
+        )
+    ]
+
+
+def build_staging_indexes(
+    *live_tables: Table, workers: int = 1, maintenance_work_mem: str | None = None
+):
+    """
+    Builds copies of the indexes on the given tables on their staging tables, which
+    must have been created with create_staging_table and then loaded with data. The
+    copies are given temporary names which are switched to the live names when the
+    staging tables are swapped in by swap_in_staging_tables. The staging tables are also
+    analysed so that the query planner has statistics for them as soon as they're live.
+
+    The indexes are built in parallel using a connection per worker. Each build can use
+    up to maintenance_work_mem memory, so the total used can be as much as workers *
+    maintenance_work_mem.
+
+    :param live_tables: the tables being rebuilt
+    :param workers: the number of indexes to build at once, defaults to 1
+    :param maintenance_work_mem: the maintenance_work_mem to use for each index build
+                                 (e.g. "1GB"), defaults to None which means the server's
+                                 setting is used
+    """
+    definitions = []
+    for live_table in live_tables:
+        staging_name = get_staging_name(live_table)
+        for index_name, definition, _ in get_indexes(live_table.name):
+            # rewrite the live index's definition to create it with a temporary name on
+            # the staging table
+            definition, replaced = re.subn(
+                rf"INDEX {index_name} ON (\S+\.)?{live_table.name} ",
+                rf"INDEX {index_name}_staging ON \g<1>{staging_name} ",
+                definition,
+                count=1,
+            )
+            if not replaced:
+                raise Exception(f"Could not recreate index {index_name}")
+            definitions.append((index_name, staging_name, definition))
+
+    # grab the engine now as the worker threads don't have the app context
+    engine = db.engine
+
+    def build_index(index_name: str, staging_name: str, definition: str):
+        log(f"Building index {index_name} on {staging_name}...")
+        with engine.connect() as connection:
+            if maintenance_work_mem is not None:
+                # set it just for this transaction so that the setting doesn't stay with
+                # the connection when it goes back into the pool
+                connection.execute(
+                    text("SELECT set_config('maintenance_work_mem', :value, true)"),
+                    {"value": maintenance_work_mem},
+                )
+            connection.execute(text(definition))
+            connection.commit()
+        log(f"Built index {index_name} on {staging_name}")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(build_index, *details) for details in definitions]
+        # make sure any errors are raised
+        for future in futures:
+            future.result()
+
+    for live_table in live_tables:
+        db.session.execute(text(f"ANALYZE {get_staging_name(live_table)}"))
+    db.session.commit()
+
+
+class ForeignKeyDetails(NamedTuple):
+    name: str
+    table_name: str
+    definition: str
+    columns: list[str]
+    referenced_table_name: str
+    referenced_columns: list[str]
+
+
+def get_foreign_keys(table_names: list[str]) -> list[ForeignKeyDetails]:
+    """
+    Returns details of the foreign keys which point at or from the given tables from
+    the database's catalog.
+
+    :param table_names: the names of the tables
+    :return: a list of ForeignKeyDetails
+    """
+    return [
+        ForeignKeyDetails(*row)
+        for row in db.session.execute(
+            text(
+                """
+                SELECT c.conname,
+                    CAST(CAST(c.conrelid AS regclass) AS text),
+                    pg_get_constraintdef(c.oid),
+                    ARRAY(
+                        SELECT a.attname
+                        FROM unnest(c.conkey) WITH ORDINALITY AS k(attnum, n)
+                            JOIN pg_attribute a
+                                ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+                        ORDER BY k.n
+                    ),
+                    CAST(CAST(c.confrelid AS regclass) AS text),
+                    ARRAY(
+                        SELECT a.attname
+                        FROM unnest(c.confkey) WITH ORDINALITY AS k(attnum, n)
+                            JOIN pg_attribute a
+                                ON a.attrelid = c.confrelid AND a.attnum = k.attnum
+                        ORDER BY k.n
+                    )
+                FROM pg_constraint c
+                WHERE c.contype = 'f'
+                  AND (
+                    c.conrelid = ANY(CAST(:tables AS regclass[]))
+                    OR c.confrelid = ANY(CAST(:tables AS regclass[]))
+                  )
+                ORDER BY c.conname
+                """
+            ),
+            {"tables": table_names},
+        )
+    ]
+
+
+def check_foreign_keys(
+    foreign_keys: list[ForeignKeyDetails], staging_names: dict[str, str]
+):
+    """
+    Checks that the data which will be live after tables are swapped with their staging
+    tables satisfies the given foreign keys, i.e. the staging tables are used in place
+    of the tables they will replace. This is done with an anti-join per foreign key
+    before the swap so that the tables don't have to be scanned while the swap's locks
+    are held. An exception is raised if any foreign key isn't satisfied.
+
+    :param foreign_keys: the foreign keys to check
+    :param staging_names: the names of the tables which will be swapped mapped to the
+                          names of their staging tables
+    """
+
+    def source(table_name: str) -> str:
+        return staging_names.get(table_name, table_name)
+
+    for foreign_key in foreign_keys:
+        # like the foreign keys themselves, rows with any NULLs in them aren't checked
+        not_nulls = " AND ".join(
+            f'r."{name}" IS NOT NULL' for name in foreign_key.columns
+        )
+        matches = " AND ".join(
+            f'p."{referenced}" = r."{name}"'
+            for name, referenced in zip(
+                foreign_key.columns, foreign_key.referenced_columns
+            )
+        )
+        violated = db.session.execute(
+            text(
+                f"""
+                SELECT EXISTS (
+                    SELECT 1 FROM {source(foreign_key.table_name)} r
+                    WHERE {not_nulls}
+                      AND NOT EXISTS (
+                        SELECT 1 FROM {source(foreign_key.referenced_table_name)} p
+                        WHERE {matches}
+                      )
+                )
+                """
+            )
+        ).scalar()
+        if violated:
+            raise Exception(
+                f"Data in {source(foreign_key.table_name)} violates foreign key "
+                f"{foreign_key.name}"
+            )
+
+
+def swap_in_staging_tables(
+    *live_tables: Table,
+    lock_timeout: str = "5s",
+    attempts: int = 5,
+    retry_delay: float = 1,
+):
+    """
+    Replaces each of the given tables with its staging table, which must have been
+    created with create_staging_table, loaded with data, and then had its indexes built
+    with build_staging_indexes.
+
+    Before the swap, the staging data is checked against the foreign keys which point
+    at or from the live tables (see check_foreign_keys) so that the swap doesn't go
+    ahead with data which would break them. Then, in a single transaction, the live
+    tables are dropped, the staging tables are renamed to replace them, their indexes
+    are renamed to the live names, and the keys and foreign keys are recreated. The
+    foreign keys are recreated without checking the data and are validated after the
+    swap is committed, which doesn't block readers or writers. This means anyone reading
+    from the tables sees either all the old data or all the new data, and is only
+    blocked for the brief moment the swap takes.
+
+    The swap needs exclusive locks on the live tables, so it waits at most lock_timeout
+    for each of them rather than queueing behind a long running query, which would block
+    every reader queued up behind the swap too. If a lock can't be acquired in time, the
+    swap is rolled back and tried again after retry_delay seconds, and once all the
+    attempts have failed an exception is raised. The live tables are left in place, as
+    are the staging tables so that the swap can be tried again later.
+
+    Tables which reference each other should be swapped together otherwise the foreign
+    keys won't be satisfied.
+
+    :param live_tables: the tables to replace with their staging tables
+    :param lock_timeout: the maximum time to wait for each lock (e.g. "5s"), defaults
+                         to 5 seconds
+    :param attempts: the number of times to try the swap, defaults to 5
+    :param retry_delay: the number of seconds to wait between attempts, defaults to 1
+    """
+    table_names = [live_table.name for live_table in live_tables]
+    # list of (index name, table name, constraint type or None)
+    indexes = []
+    sequences = []
+
+    for live_table in live_tables:
+        staging_name = get_staging_name(live_table)
+        for index_name, _, constraint_type in get_indexes(live_table.name):
+            indexes.append((index_name, live_table.name, constraint_type))
+
+        # find any sequences used by the live table's primary key so that they can be
+        # moved over to the staging table, otherwise they're dropped with the live table
+        for pk_column in live_table.primary_key.columns:
+            sequence = db.session.execute(
+                text("SELECT pg_get_serial_sequence(:table, :column)"),
+                {"table": live_table.name, "column": pk_column.name},
+            ).scalar()
+            if sequence is not None:
+                sequences.append((sequence, staging_name, pk_column.name))
+
+    foreign_keys = get_foreign_keys(table_names)
+    check_foreign_keys(
+        foreign_keys,
+        {live_table.name: get_staging_name(live_table) for live_table in live_tables},
+    )
+
+    log(f"Swapping in {', '.join(table_names)}...")
+    for attempt in range(1, attempts + 1):
+        try:
+            # set it just for this transaction so that the setting doesn't stay with
+            # the connection when it goes back into the pool
+            db.session.execute(
+                text("SELECT set_config('lock_timeout', :value, true)"),
+                {"value": lock_timeout},
+            )
+            for sequence, staging_name, column_name in sequences:
+                db.session.execute(
+                    text(
+                        f"ALTER SEQUENCE {sequence} "
+                        f"OWNED BY {staging_name}.{column_name}"
+                    )
+                )
+            for live_table in live_tables:
+                # this will also drop any foreign keys referencing the table from other
+                # tables
+                db.session.execute(text(f"DROP TABLE {live_table.name} CASCADE"))
+                staging_name = get_staging_name(live_table)
+                db.session.execute(
+                    text(f"ALTER TABLE {staging_name} RENAME TO {live_table.name}")
+                )
+            for index_name, table_name, constraint_type in indexes:
+                db.session.execute(
+                    text(f"ALTER INDEX {index_name}_staging RENAME TO {index_name}")
+                )
+                if constraint_type is not None:
+                    key = "PRIMARY KEY" if constraint_type == "p" else "UNIQUE"
+                    db.session.execute(
+                        text(
+                            f"ALTER TABLE {table_name} ADD CONSTRAINT {index_name} "
+                            f"{key} USING INDEX {index_name}"
+                        )
+                    )
+            # the data has already been checked so the foreign keys are added without
+            # checking it again, which would scan the tables while the swap's locks are
+            # held
+            for foreign_key in foreign_keys:
+                definition = foreign_key.definition.removesuffix(" NOT VALID")
+                db.session.execute(
+                    text(
+                        f"ALTER TABLE {foreign_key.table_name} ADD CONSTRAINT "
+                        f"{foreign_key.name} {definition} NOT VALID"
+                    )
+                )
+            db.session.commit()
+            break
+        except OperationalError as e:
+            db.session.rollback()
+            if not isinstance(e.orig, LockNotAvailable):
+                raise
+            if attempt == attempts:
+                raise Exception(
+                    f"Could not lock {', '.join(table_names)} to swap them in after "
+                    f"{attempts} attempts"
+                ) from e
+            log(f"Timed out waiting for locks, retrying in {retry_delay}s...")
+            time.sleep(retry_delay)
+
+    # validating only takes a lock which lets reads and writes carry on
+    for foreign_key in foreign_keys:
+        db.session.execute(
+            text(
+                f"ALTER TABLE {foreign_key.table_name} "
+                f"VALIDATE CONSTRAINT {foreign_key.name}"
+            )
+        )
+        db.session.commit()
+
+    # the tables have been replaced under the session's feet so make sure it doesn't use
+    # anything it has already loaded
+    db.session.expire_all()
+
+
+def iter_in_executor(
+    executor: Executor, function: Callable[[T], R], items: Iterable[T], limit: int
+) -> Iterable[R]:
+    """
+    Like executor.map, calls the function with each of the items using the executor and
+    yields the results in order. Unlike executor.map, at most limit items are submitted
+    to the executor at a time, so large or slow to produce iterables of items aren't
+    read into memory all at once.
+
+    :param executor: the executor to call the function with
+    :param function: the function to call
+    :param items: the items to call the function with
+    :param limit: the maximum number of items to have submitted at once
+    :return: the results of the function calls, in the same order as the items
+    """
+    pending: deque[Future[R]] = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def update_status(
+    name: str,
+    total: int,
+    version: str | None = None,
+    added: int | None = None,
+    updated: int | None = None,
+    removed: int | None = None,
+):
     updated_at = datetime.now(timezone.utc)
     status = DataSourceStatus.get(name)
     if status is None:
-        db.session.add(
-            DataSourceStatus(
-                name=name, updated_at=updated_at, version=version, total=total
-            )
-        )
-    else:
-        status.updated_at = updated_at
-        status.version = version
-        status.total = total
+        status = DataSourceStatus(name=name)
+        db.session.add(status)
+    status.updated_at = updated_at
+    status.version = version
+    status.total = total
+    status.added = added
+    status.updated = updated
+    status.removed = removed
     db.session.commit()
+
+
+def get_data_version(names: Iterable[str]) -> str:
+    """
+    Returns a version string for the data from the given data sources, derived from
+    when each of them was last updated and their versions. This changes whenever any of
+    them are reloaded.
+
+    :param names: the names of the data sources
+    :return: the version string
+    """
+    select = (
+        db.select(
+            DataSourceStatus.name,
+            DataSourceStatus.updated_at,
+            DataSourceStatus.version,
+        )
+        .filter(DataSourceStatus.name.in_(list(names)))
+        .order_by(DataSourceStatus.name)
+    )
+    updates = "|".join(
+        f"{name}:{updated_at.isoformat()}:{version}"
+        for name, updated_at, version in db.session.execute(select)
+    )
+    return hashlib.md5(updates.encode("utf-8")).hexdigest()
@@ -0,0 +1,301 @@
+import zlib
+from itertools import batched
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from marshmallow import fields
+from sqlalchemy import ColumnElement, Date, Float, Integer, Select, func
+
+from ukbol.bins import (
+    get_associated_specimen_rows_select,
+    iter_associated_specimen_rows,
+)
+from ukbol.extensions import db
+from ukbol.model import Specimen, SpecimenDetail, Taxon
+from ukbol.schema import SpecimenSchema
+
+# pyarrow is only needed for parquet exports so it's an optional dependency
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# the size of the chunks of data yielded when streaming an export
+EXPORT_CHUNK_SIZE = 64 * 1024
+# the number of rows in each parquet row group
+PARQUET_ROW_GROUP_SIZE = 10_000
+
+
+def get_specimen_export_columns() -> list[ColumnElement]:
+    """
+    Returns the columns to select to export specimens with the same values and names as
+    the SpecimenSchema produces, in the same order. The columns are derived from the
+    schema's fields so that the two stay in step.
+
+    :return: a list of labelled columns
+    """
+    export_columns = []
+    for name, field in SpecimenSchema().dump_fields.items():
+        if name == "identification":
+            # the schema capitalises the identification as we lowercase it on ingest
+            column = func.upper(func.left(Specimen.identification, 1)).concat(
+                func.substr(Specimen.identification, 2)
+            )
+        else:
+            assert not isinstance(field, fields.Function), "Unexpected field"
+            attribute = field.attribute or name
+            if attribute.startswith("detail."):
+                column = SpecimenDetail.__table__.c[attribute.removeprefix("detail.")]
+            else:
+                column = Specimen.__table__.c[attribute]
+        export_columns.append(column.label(field.data_key or name))
+    return export_columns
+
+
+def get_specimen_export_select(
+    taxon: Taxon, include_descendants: bool = False
+) -> Select:
+    """
+    Returns a select which finds the specimens associated with the given taxon (see
+    ukbol.bins.get_associated_specimen_rows_select) with the export columns, in BIN URI
+    order.
+
+    :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: a select statement
+    """
+    return get_associated_specimen_rows_select(
+        taxon, get_specimen_export_columns(), include_descendants
+    ).order_by(Specimen.bin_uri, Specimen.id)
+
+
+def iter_copy_csv(select: Select) -> Iterator[bytes]:
+    """
+    Runs the given select using COPY TO STDOUT in CSV format with a header row and
+    yields the CSV data in chunks as it comes out of the database. The rows are never
+    turned into Python objects so this is about as cheap as exporting can get.
+
+    :param select: the select to export
+    :return: yields chunks of CSV data
+    """
+    # COPY can't take bound parameters so they are bound on the client by psycopg
+    compiled = select.compile(
+        dialect=db.engine.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    copy_sql = f"COPY ({compiled}) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+    # need a raw connection so that we can use a psycopg cursor for the copy
+    raw_connection = db.engine.raw_connection()
+    try:
+        with raw_connection.cursor() as psycopg_cursor:
+            with psycopg_cursor.copy(copy_sql, compiled.params) as copy:
+                # the copy gives us one row at a time, buffer them up into bigger
+                # chunks to avoid lots of tiny writes to the response
+                buffer = bytearray()
+                for data in copy:
+                    buffer += data
+                    if len(buffer) >= EXPORT_CHUNK_SIZE:
+                        yield bytes(buffer)
+                        buffer.clear()
+                if buffer:
+                    yield bytes(buffer)
+    finally:
+        raw_connection.close()
+
+
+def iter_gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Compresses the given chunks of data into a gzip stream, yielding the compressed data
+    as it is produced.
+
+    :param chunks: the chunks of data to compress
+    :return: yields chunks of gzip data
+    """
+    # the wbits value tells zlib to write a gzip header and trailer
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+class ParquetSink:
+    """
+    A write-only file-like object which holds the data written to it until it is
+    drained. This allows a parquet file to be streamed out a row group at a time. The
+    position is tracked across drains as the parquet writer uses it to record where each
+    row group starts.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        """
+        Returns all the data written since the last drain.
+
+        :return: the data
+        """
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def get_parquet_schema(columns: list[ColumnElement]) -> "pyarrow.Schema":
+    """
+    Returns the parquet schema to use for the given export columns.
+
+    :param columns: the labelled export columns
+    :return: a pyarrow schema
+    """
+    arrow_fields = []
+    for column in columns:
+        if isinstance(column.type, Integer):
+            arrow_type = pyarrow.int64()
+        elif isinstance(column.type, Float):
+            arrow_type = pyarrow.float64()
+        elif isinstance(column.type, Date):
+            arrow_type = pyarrow.date32()
+        else:
+            arrow_type = pyarrow.string()
+        arrow_fields.append(pyarrow.field(column.name, arrow_type))
+    return pyarrow.schema(arrow_fields)
+
+
+def export_csv(taxon: Taxon, include_descendants: bool = False) -> Iterator[bytes]:
+    """
+    Exports the specimens associated with the given taxon as CSV (see iter_copy_csv).
+
+    :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: yields chunks of CSV data
+    """
+    return iter_copy_csv(get_specimen_export_select(taxon, include_descendants))
+
+
+def export_csv_gz(taxon: Taxon, include_descendants: bool = False) -> Iterator[bytes]:
+    """
+    Exports the specimens associated with the given taxon as gzipped CSV.
+
+    :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: yields chunks of gzipped CSV data
+    """
+    return iter_gzip(export_csv(taxon, include_descendants))
+
+
+def export_parquet(taxon: Taxon, include_descendants: bool = False) -> Iterator[bytes]:
+    """
+    Exports the specimens associated with the given taxon as a parquet file. The rows
+    are read from the database in batches and each batch is written and yielded as a
+    row group so that the whole file is never held in memory. The columns are the same
+    as the CSV export's but the ids and numbers keep their types.
+
+    :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: yields chunks of the parquet file
+    """
+    select = get_specimen_export_select(taxon, include_descendants)
+    schema = get_parquet_schema(list(select.selected_columns))
+    sink = ParquetSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        rows = db.session.execute(
+            select.execution_options(yield_per=PARQUET_ROW_GROUP_SIZE)
+        )
+        for batch in batched(rows, PARQUET_ROW_GROUP_SIZE):
+            writer.write_batch(pyarrow.record_batch(list(zip(*batch)), schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_fasta(taxon: Taxon, include_descendants: bool = False) -> Iterator[bytes]:
+    """
+    Exports the sequences of the specimens associated with the given taxon as FASTA.
+    The header of each sequence follows BOLD's format, i.e. the processid,
+    identification, marker code, and BIN URI separated by pipes. Specimens without a
+    sequence are left out.
+
+    :param taxon: the Taxon object
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: yields chunks of FASTA data
+    """
+    columns = [
+        Specimen.processid,
+        Specimen.identification,
+        SpecimenDetail.marker_code,
+        Specimen.bin_uri,
+        SpecimenDetail.nuc,
+    ]
+    buffer = []
+    size = 0
+    rows = iter_associated_specimen_rows(taxon, columns, include_descendants)
+    for processid, identification, marker_code, bin_uri, nuc in rows:
+        if not nuc:
+            continue
+        if identification:
+            # capitalise the identification as we lowercase it on ingest
+            identification = identification.capitalize()
+        values = (processid, identification, marker_code, bin_uri)
+        record = f">{'|'.join(value or '' for value in values)}\n{nuc}\n"
+        buffer.append(record)
+        size += len(record)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(buffer).encode("utf-8")
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+class ExportFormat(NamedTuple):
+    extension: str
+    mimetype: str
+    # a function which takes a taxon and include_descendants and yields the export data
+    exporter: Callable[[Taxon, bool], Iterator[bytes]]
+    available: bool = True
+
+
+EXPORT_FORMATS = {
+    "csv": ExportFormat("csv", "text/csv", export_csv),
+    "csv.gz": ExportFormat("csv.gz", "application/gzip", export_csv_gz),
+    "parquet": ExportFormat(
+        "parquet",
+        "application/vnd.apache.parquet",
+        export_parquet,
+        available=pyarrow is not None,
+    ),
+    "fasta": ExportFormat("fasta", "text/x-fasta", export_fasta),
+}
+
+
+def get_available_formats() -> list[str]:
+    """
+    Returns the names of the export formats which can be used, i.e. the ones which have
+    their dependencies installed.
+
+    :return: a list of format names
+    """
+    return [
+        name
+        for name, export_format in EXPORT_FORMATS.items()
+        if export_format.available
+    ]
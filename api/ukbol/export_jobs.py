@@ -0,0 +1,367 @@
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from multiprocessing import get_context
+from pathlib import Path
+from tempfile import gettempdir
+from threading import Lock
+
+from flask import Flask, current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from ukbol.data.utils import TAXON_DATA_SOURCES, get_data_version
+from ukbol.export import EXPORT_FORMATS
+from ukbol.extensions import db
+from ukbol.model import ExportJob, Taxon
+from ukbol.utils import log
+
+# the pool of processes export jobs are run in and a lock to make sure only one thread
+# creates it
+_executor: ProcessPoolExecutor | None = None
+_lock = Lock()
+
+# the app used by the export job processes, created when each process starts
+_worker_app: Flask | None = None
+
+# how often, in seconds, a running export job updates its heartbeat
+HEARTBEAT_INTERVAL = 30
+
+
+def get_export_dir() -> Path:
+    """
+    Returns the directory export files are written to. This is set by the EXPORT_DIR
+    config option and defaults to a ukbol-exports directory in the system's temp dir.
+    The directory is created if it doesn't exist.
+
+    :return: the export directory
+    """
+    export_dir = Path(
+        current_app.config.get("EXPORT_DIR", Path(gettempdir()) / "ukbol-exports")
+    )
+    export_dir.mkdir(parents=True, exist_ok=True)
+    return export_dir
+
+
+def get_export_path(job: ExportJob, export_dir: Path | None = None) -> Path:
+    """
+    Returns the path of the given job's export file.
+
+    :param job: the ExportJob
+    :param export_dir: the export directory, defaults to the one from get_export_dir
+    :return: the path of the export file
+    """
+    if export_dir is None:
+        export_dir = get_export_dir()
+    return export_dir / f"{job.id}.{EXPORT_FORMATS[job.format].extension}"
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Returns the pool of processes export jobs are run in, creating it if needed. The
+    number of processes is set by the EXPORT_WORKERS config option (default: 2).
+
+    :return: a ProcessPoolExecutor
+    """
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=current_app.config.get("EXPORT_WORKERS", 2),
+                # use spawn to avoid forking the app's database connections
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _executor
+
+
+def _discard_executor(executor: ProcessPoolExecutor):
+    """
+    Stops the given pool of processes being used for new export jobs, if it is still
+    the current pool. This is used when the pool breaks so that a new one is created
+    for the next job.
+
+    :param executor: the pool to discard
+    """
+    global _executor
+
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def shutdown_executor():
+    """
+    Shuts down the pool of processes export jobs are run in, waiting for any running
+    jobs to finish.
+    """
+    global _executor
+
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def _init_worker():
+    """
+    Creates the app used to access the database in an export job process.
+    """
+    global _worker_app
+
+    # imported here as the app imports the API which imports this module
+    from ukbol.app import create_app
+
+    _worker_app = create_app()
+
+
+def _run_in_worker(job_id: str, export_dir: str):
+    """
+    Runs the given export job in an export job process (see run_export_job).
+
+    :param job_id: the ExportJob's ID
+    :param export_dir: the directory to write the export file to
+    """
+    with _worker_app.app_context():
+        run_export_job(job_id, Path(export_dir))
+
+
+def get_job_timeout() -> timedelta:
+    """
+    Returns how long a pending or running export job can go without updating its
+    heartbeat before it is presumed dead and can be started again. This is set by the
+    EXPORT_JOB_TIMEOUT config option in seconds (default: 900).
+
+    :return: the timeout
+    """
+    return timedelta(seconds=current_app.config.get("EXPORT_JOB_TIMEOUT", 900))
+
+
+def is_stale(job: ExportJob) -> bool:
+    """
+    Returns whether the given job is pending or running but hasn't updated its heartbeat
+    within the job timeout (see get_job_timeout). This happens when the process running
+    the job crashes or the app is restarted while the job is queued or running.
+
+    :param job: the ExportJob
+    :return: True if the job is stale, False if not
+    """
+    if job.status not in ("pending", "running"):
+        return False
+    cutoff = datetime.now(timezone.utc) - get_job_timeout()
+    return job.heartbeat_at is None or job.heartbeat_at < cutoff
+
+
+def touch_job(job_id: str):
+    """
+    Updates the heartbeat of the given export job. This uses its own connection so that
+    it can be called while the job's export is reading from the session.
+
+    :param job_id: the ExportJob's ID
+    """
+    with db.engine.begin() as connection:
+        connection.execute(
+            update(ExportJob)
+            .filter(ExportJob.id == job_id)
+            .values(heartbeat_at=datetime.now(timezone.utc))
+        )
+
+
+def remove_export_files(job: ExportJob, export_dir: Path):
+    """
+    Removes the given job's export file and any partial files left over from its runs.
+
+    :param job: the ExportJob
+    :param export_dir: the export directory
+    """
+    for path in export_dir.glob(f"{job.id}.*"):
+        path.unlink(missing_ok=True)
+
+
+def remove_old_export_jobs(data_version: str, export_dir: Path):
+    """
+    Removes the export jobs, and their files, which were made from data other than the
+    given version. Jobs which are still pending or running are left alone until they
+    finish or go stale so that their files aren't written after they've been removed.
+
+    :param data_version: the current data version
+    :param export_dir: the export directory
+    """
+    jobs = db.session.scalars(
+        db.select(ExportJob).filter(ExportJob.data_version != data_version)
+    ).all()
+    for job in jobs:
+        if job.status in ("pending", "running") and not is_stale(job):
+            continue
+        remove_export_files(job, export_dir)
+        db.session.delete(job)
+    db.session.commit()
+
+
+def _on_job_done(
+    app: Flask, job_id: str, executor: ProcessPoolExecutor, future: Future
+):
+    """
+    Called when an export job's future is done. Errors inside the job are recorded by
+    run_export_job itself, so this only needs to deal with the job not running at all,
+    e.g. because the process running it crashed or failed to start, in which case the
+    job is marked as failed. If the pool has broken it is discarded so that the next job
+    gets a new one.
+
+    :param app: the app to access the database with
+    :param job_id: the ExportJob's ID
+    :param executor: the pool the job was submitted to
+    :param future: the job's future
+    """
+    if future.cancelled():
+        error = "Export was cancelled"
+    elif future.exception() is not None:
+        exception = future.exception()
+        if isinstance(exception, BrokenProcessPool):
+            _discard_executor(executor)
+        error = f"Export failed to run: {exception!r}"
+    else:
+        return
+
+    with app.app_context():
+        job = ExportJob.get(job_id)
+        if job is not None and job.status in ("pending", "running"):
+            log(f"Export job {job_id} failed: {error}")
+            job.status = "failed"
+            job.error = error
+            job.completed_at = datetime.now(timezone.utc)
+            db.session.commit()
+
+
+def create_export_job(
+    taxon: Taxon, export_format: str, include_descendants: bool = False
+) -> ExportJob:
+    """
+    Returns an ExportJob for the given taxon and export options, starting it in the
+    background if it is new. If a job for the same taxon, options, and data version
+    already exists it is returned instead so that concurrent and repeated requests share
+    the same file. Jobs which failed, whose files have gone missing, or which have gone
+    stale (see is_stale) are started again. The existing job is locked while this is
+    decided so that only one request can start it again.
+
+    The jobs and files from previous versions of the data are removed along the way
+    (see remove_old_export_jobs).
+
+    :param taxon: the Taxon to export the specimens of
+    :param export_format: the name of the export format (see EXPORT_FORMATS)
+    :param include_descendants: whether to include the BINs of the taxon's descendants
+    :return: the ExportJob
+    """
+    export_dir = get_export_dir()
+    data_version = get_data_version(TAXON_DATA_SOURCES)
+    remove_old_export_jobs(data_version, export_dir)
+    filters = {
+        "taxon_id": taxon.id,
+        "format": export_format,
+        "include_descendants": include_descendants,
+        "data_version": data_version,
+    }
+    job = db.session.scalars(
+        db.select(ExportJob).filter_by(**filters).with_for_update()
+    ).first()
+
+    if job is not None:
+        missing = job.status == "complete" and not get_export_path(job).exists()
+        if job.status != "failed" and not missing and not is_stale(job):
+            # release the lock
+            db.session.commit()
+            return job
+        # start the job again
+        job.status = "pending"
+        job.heartbeat_at = datetime.now(timezone.utc)
+        job.completed_at = None
+        job.size = None
+        job.error = None
+        db.session.commit()
+    else:
+        extension = EXPORT_FORMATS[export_format].extension
+        now = datetime.now(timezone.utc)
+        job = ExportJob(
+            id=uuid.uuid4().hex,
+            status="pending",
+            file_name=f"{taxon.name.replace(' ', '_')}_specimens.{extension}",
+            created_at=now,
+            heartbeat_at=now,
+            **filters,
+        )
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another request created the same job at the same time, use theirs
+            db.session.rollback()
+            return db.session.scalars(db.select(ExportJob).filter_by(**filters)).one()
+
+    executor = get_executor()
+    future = executor.submit(_run_in_worker, job.id, str(export_dir))
+    future.add_done_callback(
+        partial(_on_job_done, current_app._get_current_object(), job.id, executor)
+    )
+    return job
+
+
+def run_export_job(job_id: str, export_dir: Path):
+    """
+    Runs the given export job, writing the export file and updating the job's status as
+    it goes. The job's heartbeat is updated regularly while it runs so that it isn't
+    presumed dead (see is_stale). The file is written to a temporary path first and
+    moved into place once it is complete so that a partial file is never served. The
+    temporary path is unique to the run so that a stale run which is somehow still going
+    can't write to the same file as the run which replaced it.
+
+    If the job is already complete, or is being run by another process, nothing is done.
+
+    :param job_id: the ExportJob's ID
+    :param export_dir: the directory to write the export file to
+    """
+    job = db.session.scalars(
+        db.select(ExportJob).filter_by(id=job_id).with_for_update()
+    ).first()
+    if (
+        job is None
+        or job.status == "complete"
+        or (job.status == "running" and not is_stale(job))
+    ):
+        db.session.rollback()
+        return
+
+    job.status = "running"
+    job.heartbeat_at = datetime.now(timezone.utc)
+    db.session.commit()
+
+    path = get_export_path(job, export_dir)
+    partial_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.part")
+    try:
+        taxon = Taxon.get(job.taxon_id)
+        if taxon is None:
+            raise Exception(f"Taxon {job.taxon_id} no longer exists")
+        exporter = EXPORT_FORMATS[job.format].exporter
+        next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+        with partial_path.open("wb") as f:
+            for chunk in exporter(taxon, job.include_descendants):
+                f.write(chunk)
+                if time.monotonic() >= next_heartbeat:
+                    touch_job(job.id)
+                    next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+        partial_path.replace(path)
+    except Exception as e:
+        db.session.rollback()
+        partial_path.unlink(missing_ok=True)
+        log(f"Export job {job.id} failed: {e}")
+        job.status = "failed"
+        job.error = str(e)
+    else:
+        job.status = "complete"
+        job.size = path.stat().st_size
+    job.completed_at = datetime.now(timezone.utc)
+    db.session.commit()
@@ -1,7 +1,8 @@
-from datetime import datetime
+from datetime import date, datetime
 from typing import Any, List, Self
 
-from sqlalchemy import DateTime, ForeignKey
+from sqlalchemy import BigInteger, DateTime, ForeignKey, Index, UniqueConstraint
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from ukbol.extensions import db
@@ -9,16 +10,31 @@ from ukbol.extensions import db
 
 # imported from uksi
 class Taxon(db.Model):
+    __table_args__ = (
+        # backs the prefix matching of short suggestion queries
+        Index(
+            "ix_taxon_name_prefix", "name", postgresql_ops={"name": "text_pattern_ops"}
+        ),
+    )
+
     id: Mapped[str] = mapped_column(primary_key=True)
     name: Mapped[str]
     authorship: Mapped[str | None]
     rank: Mapped[str] = mapped_column(index=True)
     parent_id: Mapped[int | None] = mapped_column(ForeignKey("taxon.id"), index=True)
+    # nested set interval bounds, all descendants of this taxon have a left value
+    # between this taxon's left and right values
+    lft: Mapped[int | None] = mapped_column(index=True)
+    rgt: Mapped[int | None]
 
     # relationships
     parent: Mapped["Taxon"] = relationship(back_populates="children", remote_side=[id])
-    children: Mapped[List["Taxon"]] = relationship(back_populates="parent")
-    synonyms: Mapped[List["Synonym"]] = relationship(back_populates="taxon")
+    children: Mapped[List["Taxon"]] = relationship(
+        back_populates="parent", order_by="Taxon.name"
+    )
+    synonyms: Mapped[List["Synonym"]] = relationship(
+        back_populates="taxon", order_by="Synonym.id"
+    )
 
     @classmethod
     def get(cls, ident: Any) -> Self | None:
@@ -27,6 +43,15 @@ class Taxon(db.Model):
 
 # imported from uksi
 class Synonym(db.Model):
+    __table_args__ = (
+        # backs the prefix matching of short suggestion queries
+        Index(
+            "ix_synonym_name_prefix",
+            "name",
+            postgresql_ops={"name": "text_pattern_ops"},
+        ),
+    )
+
     id: Mapped[str] = mapped_column(primary_key=True)
     name: Mapped[str]
     authorship: Mapped[str | None]
@@ -41,17 +66,44 @@ class Synonym(db.Model):
         return db.session.get(cls, ident)
 
 
-# imported from BOLD
+# imported from BOLD. To keep this table narrow, and therefore quick to scan, it only
+# holds the values used to find and summarise specimens, typed where possible. All the
+# other values from BOLD are held in the SpecimenDetail table
 class Specimen(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     processid: Mapped[str | None]
+    bin_uri: Mapped[str | None] = mapped_column(index=True)
+    identification: Mapped[str | None] = mapped_column(index=True)
+    identification_rank: Mapped[str | None] = mapped_column(index=True)
+    country_iso: Mapped[str | None] = mapped_column(index=True)
+    # parsed from the collection_date_start, collection_date_end, and coord values in
+    # the BOLD data, the original values are kept in the SpecimenDetail
+    collection_start: Mapped[date | None]
+    collection_end: Mapped[date | None]
+    latitude: Mapped[float | None]
+    longitude: Mapped[float | None]
+
+    detail: Mapped["SpecimenDetail"] = relationship(
+        back_populates="specimen", cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    @classmethod
+    def get(cls, ident: Any) -> Self | None:
+        return db.session.get(cls, ident)
+
+
+# the values from BOLD for each specimen which aren't needed to find or summarise them,
+# one row per Specimen
+class SpecimenDetail(db.Model):
+    specimen_id: Mapped[int] = mapped_column(
+        ForeignKey("specimen.id", ondelete="CASCADE"), primary_key=True
+    )
     sampleid: Mapped[str | None]
     fieldid: Mapped[str | None]
     museumid: Mapped[str | None]
     record_id: Mapped[str | None]
     specimenid: Mapped[str | None]
     processid_minted_date: Mapped[str | None]
-    bin_uri: Mapped[str | None] = mapped_column(index=True)
     bin_created_date: Mapped[str | None]
     collection_code: Mapped[str | None]
     inst: Mapped[str | None]
@@ -67,9 +119,7 @@ class Specimen(db.Model):
     species: Mapped[str | None]
     subspecies: Mapped[str | None]
     species_reference: Mapped[str | None]
-    identification: Mapped[str | None] = mapped_column(index=True)
     identification_method: Mapped[str | None]
-    identification_rank: Mapped[str | None] = mapped_column(index=True)
     identified_by: Mapped[str | None]
     identifier_email: Mapped[str | None]
     taxonomy_notes: Mapped[str | None]
@@ -91,7 +141,6 @@ class Specimen(db.Model):
     collection_notes: Mapped[str | None]
     geoid: Mapped[str | None]
     country_ocean: Mapped[str | None]
-    country_iso: Mapped[str | None] = mapped_column(index=True)
     province_state: Mapped[str | None]
     region: Mapped[str | None]
     sector: Mapped[str | None]
@@ -121,9 +170,27 @@ class Specimen(db.Model):
     realm: Mapped[str | None]
     sovereign_inst: Mapped[str | None]
 
+    specimen: Mapped[Specimen] = relationship(back_populates="detail")
+
+
+# derived from the BOLD specimens, one row per BIN
+class BinSummary(db.Model):
+    bin_uri: Mapped[str] = mapped_column(primary_key=True)
+    count: Mapped[int]
+    uk_count: Mapped[int]
+    # a list of [identification, count] pairs in descending count order
+    names: Mapped[list] = mapped_column(JSONB)
+
     @classmethod
-    def get(cls, ident: Any) -> Self | None:
-        return db.session.get(cls, ident)
+    def get(cls, bin_uri: str) -> Self | None:
+        return db.session.get(cls, bin_uri)
+
+
+# derived from the taxonomy and the BOLD specimens, links each taxon to the BINs its
+# name, or the names of its synonyms, appear in
+class TaxonBin(db.Model):
+    taxon_id: Mapped[str] = mapped_column(primary_key=True)
+    bin_uri: Mapped[str] = mapped_column(primary_key=True)
 
 
 # imported from PANTHEON
@@ -152,7 +219,44 @@ class DataSourceStatus(db.Model):
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
     version: Mapped[str | None]
     total: Mapped[int]
+    # the number of records added, updated, and removed by the last import if it was
+    # incremental, these are all None if the last import replaced all the data
+    added: Mapped[int | None]
+    updated: Mapped[int | None]
+    removed: Mapped[int | None]
 
     @classmethod
     def get(cls, name: str) -> Self | None:
         return db.session.get(cls, name)
+
+
+# an export of the specimens associated with a taxon, written to a file in the
+# background. Jobs are unique on the options and the version of the data so that
+# requests for the same export share the same file
+class ExportJob(db.Model):
+    __table_args__ = (
+        UniqueConstraint("taxon_id", "format", "include_descendants", "data_version"),
+    )
+
+    id: Mapped[str] = mapped_column(primary_key=True)
+    # not a foreign key as the taxon table is replaced when the taxonomy is rebuilt
+    taxon_id: Mapped[str]
+    format: Mapped[str]
+    include_descendants: Mapped[bool]
+    data_version: Mapped[str]
+    # one of pending, running, complete, or failed
+    status: Mapped[str]
+    # the name the file is given when it is downloaded
+    file_name: Mapped[str]
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    # updated when the job is started and regularly while it runs, pending and running
+    # jobs which haven't updated this for a while are presumed dead
+    heartbeat_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+    completed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+    # the size of the file in bytes
+    size: Mapped[int | None] = mapped_column(BigInteger)
+    error: Mapped[str | None]
+
+    @classmethod
+    def get(cls, ident: str) -> Self | None:
+        return db.session.get(cls, ident)
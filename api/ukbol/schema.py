@@ -1,7 +1,14 @@
 from marshmallow import fields
 
 from ukbol.extensions import ma
-from ukbol.model import DataSourceStatus, Specimen, Synonym, Taxon
+from ukbol.model import (
+    DataSourceStatus,
+    ExportJob,
+    Specimen,
+    SpecimenDetail,
+    Synonym,
+    Taxon,
+)
 
 
 class SynonymSchema(ma.SQLAlchemyAutoSchema):
@@ -39,92 +46,116 @@ class TaxonSuggestionSchema(ma.SQLAlchemySchema):
     rank = ma.auto_field()
 
 
+def detail_field(column_name: str, **kwargs) -> fields.Field:
+    """
+    Returns a field for the given column of the SpecimenDetail model which gets its
+    value from a Specimen object's detail.
+
+    :param column_name: the name of the SpecimenDetail column
+    :param kwargs: any other arguments to pass to the field
+    :return: a field
+    """
+    return ma.auto_field(
+        column_name,
+        model=SpecimenDetail,
+        attribute=f"detail.{column_name}",
+        **kwargs,
+    )
+
+
 class SpecimenSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Specimen
+        # these are parsed from the collection dates and coord values for querying, the
+        # original values are output instead
+        exclude = ("collection_start", "collection_end", "latitude", "longitude")
 
     id = ma.auto_field()
     processid = ma.auto_field()
-    sampleid = ma.auto_field()
-    fieldid = ma.auto_field()
-    museumid = ma.auto_field()
-    record_id = ma.auto_field()
-    specimenid = ma.auto_field()
-    processid_minted_date = ma.auto_field()
+    sampleid = detail_field("sampleid")
+    fieldid = detail_field("fieldid")
+    museumid = detail_field("museumid")
+    record_id = detail_field("record_id")
+    specimenid = detail_field("specimenid")
+    processid_minted_date = detail_field("processid_minted_date")
     bin_uri = ma.auto_field()
-    bin_created_date = ma.auto_field()
-    collection_code = ma.auto_field()
-    inst = ma.auto_field()
-    taxid = ma.auto_field()
-    kingdom = ma.auto_field()
-    phylum = ma.auto_field()
-    cls = ma.auto_field(data_key="class")
-    order = ma.auto_field()
-    family = ma.auto_field()
-    subfamily = ma.auto_field()
-    tribe = ma.auto_field()
-    genus = ma.auto_field()
-    species = ma.auto_field()
-    subspecies = ma.auto_field()
-    species_reference = ma.auto_field()
+    bin_created_date = detail_field("bin_created_date")
+    collection_code = detail_field("collection_code")
+    inst = detail_field("inst")
+    taxid = detail_field("taxid")
+    kingdom = detail_field("kingdom")
+    phylum = detail_field("phylum")
+    cls = detail_field("cls", data_key="class")
+    order = detail_field("order")
+    family = detail_field("family")
+    subfamily = detail_field("subfamily")
+    tribe = detail_field("tribe")
+    genus = detail_field("genus")
+    species = detail_field("species")
+    subspecies = detail_field("subspecies")
+    species_reference = detail_field("species_reference")
     # capitalise the identification when outputting as we lowercase it on ingest
-    identification = ma.Function(lambda specimen: specimen.identification.capitalize())
-    identification_method = ma.auto_field()
+    identification = ma.Function(
+        lambda specimen: (
+            specimen.identification.capitalize() if specimen.identification else None
+        )
+    )
+    identification_method = detail_field("identification_method")
     identification_rank = ma.auto_field()
-    identified_by = ma.auto_field()
-    identifier_email = ma.auto_field()
-    taxonomy_notes = ma.auto_field()
-    sex = ma.auto_field()
-    reproduction = ma.auto_field()
-    life_stage = ma.auto_field()
-    short_note = ma.auto_field()
-    notes = ma.auto_field()
-    voucher_type = ma.auto_field()
-    tissue_type = ma.auto_field()
-    specimen_linkout = ma.auto_field()
-    associated_specimens = ma.auto_field()
-    associated_taxa = ma.auto_field()
-    collectors = ma.auto_field()
-    collection_date_start = ma.auto_field()
-    collection_date_end = ma.auto_field()
-    collection_event_id = ma.auto_field()
-    collection_time = ma.auto_field()
-    collection_notes = ma.auto_field()
-    geoid = ma.auto_field()
-    country_ocean = ma.auto_field(data_key="country/ocean")
+    identified_by = detail_field("identified_by")
+    identifier_email = detail_field("identifier_email")
+    taxonomy_notes = detail_field("taxonomy_notes")
+    sex = detail_field("sex")
+    reproduction = detail_field("reproduction")
+    life_stage = detail_field("life_stage")
+    short_note = detail_field("short_note")
+    notes = detail_field("notes")
+    voucher_type = detail_field("voucher_type")
+    tissue_type = detail_field("tissue_type")
+    specimen_linkout = detail_field("specimen_linkout")
+    associated_specimens = detail_field("associated_specimens")
+    associated_taxa = detail_field("associated_taxa")
+    collectors = detail_field("collectors")
+    collection_date_start = detail_field("collection_date_start")
+    collection_date_end = detail_field("collection_date_end")
+    collection_event_id = detail_field("collection_event_id")
+    collection_time = detail_field("collection_time")
+    collection_notes = detail_field("collection_notes")
+    geoid = detail_field("geoid")
+    country_ocean = detail_field("country_ocean", data_key="country/ocean")
     country_iso = ma.auto_field()
-    province_state = ma.auto_field(data_key="province/state")
-    region = ma.auto_field()
-    sector = ma.auto_field()
-    site = ma.auto_field()
-    site_code = ma.auto_field()
-    coord = ma.auto_field()
-    coord_accuracy = ma.auto_field()
-    coord_source = ma.auto_field()
-    elev = ma.auto_field()
-    elev_accuracy = ma.auto_field()
-    depth = ma.auto_field()
-    depth_accuracy = ma.auto_field()
-    habitat = ma.auto_field()
-    sampling_protocol = ma.auto_field()
-    nuc = ma.auto_field()
-    nuc_basecount = ma.auto_field()
-    insdc_acs = ma.auto_field()
-    funding_src = ma.auto_field()
-    marker_code = ma.auto_field()
-    primers_forward = ma.auto_field()
-    primers_reverse = ma.auto_field()
-    sequence_run_site = ma.auto_field()
-    sequence_upload_date = ma.auto_field()
-    bold_recordset_code_arr = ma.auto_field()
-    ecoregion = ma.auto_field()
-    biome = ma.auto_field()
-    realm = ma.auto_field()
-    sovereign_inst = ma.auto_field()
+    province_state = detail_field("province_state", data_key="province/state")
+    region = detail_field("region")
+    sector = detail_field("sector")
+    site = detail_field("site")
+    site_code = detail_field("site_code")
+    coord = detail_field("coord")
+    coord_accuracy = detail_field("coord_accuracy")
+    coord_source = detail_field("coord_source")
+    elev = detail_field("elev")
+    elev_accuracy = detail_field("elev_accuracy")
+    depth = detail_field("depth")
+    depth_accuracy = detail_field("depth_accuracy")
+    habitat = detail_field("habitat")
+    sampling_protocol = detail_field("sampling_protocol")
+    nuc = detail_field("nuc")
+    nuc_basecount = detail_field("nuc_basecount")
+    insdc_acs = detail_field("insdc_acs")
+    funding_src = detail_field("funding_src")
+    marker_code = detail_field("marker_code")
+    primers_forward = detail_field("primers_forward")
+    primers_reverse = detail_field("primers_reverse")
+    sequence_run_site = detail_field("sequence_run_site")
+    sequence_upload_date = detail_field("sequence_upload_date")
+    bold_recordset_code_arr = detail_field("bold_recordset_code_arr")
+    ecoregion = detail_field("ecoregion")
+    biome = detail_field("biome")
+    realm = detail_field("realm")
+    sovereign_inst = detail_field("sovereign_inst")
 
 
 class TaxonBinSchema(ma.Schema):
-    bin = fields.Str()
+    bin = fields.Str(attribute="bin_uri")
     count = fields.Integer()
     uk_count = fields.Integer()
     names = fields.List(fields.Tuple((fields.Str(), fields.Integer())))
@@ -138,3 +169,21 @@ class DataSourceStatusSchema(ma.SQLAlchemySchema):
     updated_at = ma.auto_field()
     version = ma.auto_field()
     total = ma.auto_field()
+    added = ma.auto_field()
+    updated = ma.auto_field()
+    removed = ma.auto_field()
+
+
+class ExportJobSchema(ma.SQLAlchemySchema):
+    class Meta:
+        model = ExportJob
+
+    id = ma.auto_field()
+    taxon_id = ma.auto_field()
+    format = ma.auto_field()
+    include_descendants = ma.auto_field()
+    status = ma.auto_field()
+    created_at = ma.auto_field()
+    completed_at = ma.auto_field()
+    size = ma.auto_field()
+    error = ma.auto_field()
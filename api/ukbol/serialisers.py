@@ -0,0 +1,222 @@
+import re
+from typing import Any, Callable
+
+from flask.json.provider import DefaultJSONProvider
+from marshmallow import Schema, fields, missing
+from marshmallow_sqlalchemy.fields import Related
+
+# orjson is only needed for faster JSON encoding so it's an optional dependency
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the field types which output the values they are given as they are, the values we
+# get from the database are already the right types so there's nothing to convert
+PASSTHROUGH_FIELDS = (fields.String, fields.Integer, fields.Float, fields.Boolean)
+# matches the characters the standard library's JSON encoder escapes when ensure_ascii
+# is on
+NON_ASCII_REGEX = re.compile(r"[^\x00-\x7f]")
+
+
+def _get_getter(path: str) -> Callable[[Any], Any]:
+    """
+    Returns a function which gets the value at the given, possibly dotted, attribute
+    path from an object. Like marshmallow, if any of the objects along the path are
+    None or don't have the attribute, missing is returned.
+
+    :param path: the attribute path
+    :return: a getter function
+    """
+    names = path.split(".")
+
+    def getter(obj: Any) -> Any:
+        for name in names:
+            if obj is None:
+                return missing
+            obj = getattr(obj, name, missing)
+            if obj is missing:
+                return missing
+        return obj
+
+    return getter
+
+
+def _get_converter(field: fields.Field) -> Callable[[Any], Any] | None:
+    """
+    Returns a function which converts a non-None value in the same way as the given
+    field's serialisation does, or None if the value doesn't need converting.
+
+    :param field: the marshmallow field
+    :return: a converter function or None
+    :raises TypeError: if the field type isn't supported
+    """
+    if isinstance(field, fields.Nested):
+        serialiser = LeanSerialiser(field.schema)
+        if field.many:
+            return lambda value: [serialiser.dump_one(item) for item in value]
+        return serialiser.dump_one
+    if isinstance(field, Related):
+        keys = [prop.key for prop in field.related_keys]
+        if len(keys) == 1:
+            key = keys[0]
+            return lambda value: getattr(value, key, None)
+        return lambda value: {key: getattr(value, key, None) for key in keys}
+    if isinstance(field, fields.List):
+        inner = _get_converter(field.inner)
+        if inner is None:
+            return list
+        return lambda value: [None if item is None else inner(item) for item in value]
+    if isinstance(field, fields.Tuple):
+        inners = [_get_converter(inner) for inner in field.tuple_fields]
+        return lambda value: tuple(
+            item if inner is None or item is None else inner(item)
+            for inner, item in zip(inners, value)
+        )
+    if isinstance(field, fields.DateTime):
+        data_format = field.format or field.DEFAULT_FORMAT
+        format_func = field.SERIALIZATION_FUNCS.get(data_format)
+        if format_func is not None:
+            return format_func
+        return lambda value: value.strftime(data_format)
+    if isinstance(field, fields.Integer) and field.as_string:
+        return str
+    if isinstance(field, PASSTHROUGH_FIELDS):
+        return None
+    raise TypeError(f"Unsupported field type {type(field).__name__}")
+
+
+class LeanSerialiser:
+    """
+    A serialiser which produces the same output as a marshmallow schema but without
+    the overhead marshmallow adds to every field of every object it dumps. The schema's
+    fields are compiled into a list of (key, getter, converter) tuples once, up front,
+    and then dumping an object is just a loop over them. Only the field types we use
+    are supported, others raise a TypeError when the serialiser is created.
+    """
+
+    def __init__(self, schema: Schema):
+        """
+        :param schema: the marshmallow schema instance to produce the same output as
+        """
+        self.fields = []
+        for name, field in schema.dump_fields.items():
+            if field.dump_default is not missing:
+                raise TypeError(f"Unsupported dump_default on {name}")
+            key = field.data_key or name
+            if isinstance(field, fields.Function):
+                # functions get the whole object and their result isn't converted
+                self.fields.append((key, field.serialize_func, None))
+            else:
+                getter = _get_getter(field.attribute or name)
+                self.fields.append((key, getter, _get_converter(field)))
+
+    def dump_one(self, obj: Any) -> dict:
+        """
+        Serialises the given object.
+
+        :param obj: the object to serialise
+        :return: a dict
+        """
+        data = {}
+        for key, getter, converter in self.fields:
+            value = getter(obj)
+            if value is missing:
+                continue
+            if converter is not None and value is not None:
+                value = converter(value)
+            data[key] = value
+        return data
+
+    def dump(self, obj: Any, many: bool = False) -> dict | list[dict]:
+        """
+        Serialises the given object, or objects if many is True, in the same way as the
+        schema's dump method.
+
+        :param obj: the object or an iterable of objects to serialise
+        :param many: whether obj is an iterable of objects
+        :return: a dict or a list of dicts
+        """
+        if many:
+            return [self.dump_one(item) for item in obj]
+        return self.dump_one(obj)
+
+
+def _escape_non_ascii_char(match: re.Match) -> str:
+    """
+    Returns the JSON escape for the matched character in the same form as the standard
+    library's JSON encoder, i.e. a lowercase \\uXXXX escape, or a surrogate pair of them
+    for characters outside the basic multilingual plane.
+
+    :param match: the match of a single non-ASCII character
+    :return: the escaped character
+    """
+    code = ord(match.group())
+    if code > 0xFFFF:
+        code -= 0x10000
+        return f"\\u{0xD800 | (code >> 10):04x}\\u{0xDC00 | (code & 0x3FF):04x}"
+    return f"\\u{code:04x}"
+
+
+def escape_non_ascii(data: bytes) -> bytes:
+    """
+    Escapes the non-ASCII characters in the given UTF-8 encoded JSON in the same way as
+    the standard library's JSON encoder does when ensure_ascii is on. Non-ASCII
+    characters can only appear inside strings in JSON so they can be replaced without
+    parsing it.
+
+    :param data: the JSON
+    :return: the JSON with only ASCII characters in it
+    """
+    if data.isascii():
+        return data
+    return NON_ASCII_REGEX.sub(_escape_non_ascii_char, data.decode("utf-8")).encode(
+        "ascii"
+    )
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    A JSON provider which uses orjson to encode JSON responses, if it is installed,
+    instead of the standard library. dumps is left to the default provider as its
+    output format (e.g. the spaces after separators) is relied on by things like the
+    tojson filter and is rarely on a hot path.
+
+    The responses are byte for byte the same as the default provider's for the data the
+    API returns: non-ASCII characters are escaped when ensure_ascii is on, as it is by
+    default, and dates and dataclasses are passed through to the default provider's
+    conversion so they come out the same way too. The only difference is in floats big
+    or small enough to be written with an exponent, which orjson writes without a "+"
+    (e.g. 1e16 rather than 1e+16).
+    """
+
+    def response(self, *args: Any, **kwargs: Any):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(
+            self._encode(obj, indent) + b"\n", mimetype=self.mimetype
+        )
+
+    def _encode(self, obj: Any, indent: bool) -> bytes:
+        """
+        Encodes the given object as JSON using orjson.
+
+        :param obj: the object to encode
+        :param indent: whether to indent the output
+        :return: the JSON as bytes
+        """
+        option = (
+            orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_PASSTHROUGH_DATACLASS
+            | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        data = orjson.dumps(obj, default=self.default, option=option)
+        if self.ensure_ascii:
+            data = escape_non_ascii(data)
+        return data
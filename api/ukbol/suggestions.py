@@ -0,0 +1,95 @@
+from sqlalchemy import Select, case, func, union_all
+
+from ukbol.extensions import db
+from ukbol.model import Synonym, Taxon
+
+# queries shorter than this can't use the trigram indexes, so they are only matched
+# against the start of names
+MIN_CONTAINS_LENGTH = 3
+
+
+def get_prefix_pattern(query: str) -> str:
+    """
+    Returns a LIKE pattern which matches strings starting with the given query. The
+    pattern is built here rather than in the database so that it is a constant which
+    the prefix indexes can be used with. It should be used with "/" as the escape
+    character.
+
+    :param query: the query string
+    :return: the LIKE pattern
+    """
+    escaped = query.replace("/", "//").replace("%", "/%").replace("_", "/_")
+    return f"{escaped}%"
+
+
+def get_suggestions_select(
+    query: str,
+    ranks: list[str] | None = None,
+    ignore_ranks: list[str] | None = None,
+) -> Select:
+    """
+    Given a query string, return a select which finds taxa with names, or synonyms with
+    names, which contain the query. The taxa are ranked so that the best matches come
+    first:
+
+        - exact name matches
+        - names starting with the query
+        - names with a word starting with the query
+        - names containing the query anywhere
+
+    Within each of these groups shorter names are preferred, and then names are ordered
+    alphabetically. A taxon is ranked by its best matching name. The name matching is
+    backed by trigram indexes on the taxon and synonym name columns (see the migrations)
+    so this is quick even though the query can match anywhere in the names.
+
+    Queries shorter than MIN_CONTAINS_LENGTH are too short for the trigram indexes to
+    help with, so they only match names starting with the query, using the prefix
+    indexes on the name columns instead. Otherwise, a short query would have to be
+    checked against every name.
+
+    If no query is provided then all taxa are matched, in name order.
+
+    :param query: the query string
+    :param ranks: if provided, only include taxa with these ranks
+    :param ignore_ranks: if provided, exclude taxa with these ranks
+    :return: a select statement to find suggested taxa
+    """
+    select = db.select(Taxon)
+
+    # names are all lowercase in the database
+    query = query.strip().lower()
+    if query:
+        if len(query) < MIN_CONTAINS_LENGTH:
+            pattern = get_prefix_pattern(query)
+            taxon_filter = Taxon.name.like(pattern, escape="/")
+            synonym_filter = Synonym.name.like(pattern, escape="/")
+        else:
+            taxon_filter = Taxon.name.contains(query, autoescape=True)
+            synonym_filter = Synonym.name.contains(query, autoescape=True)
+        matches = union_all(
+            db.select(Taxon.id.label("taxon_id"), Taxon.name).filter(taxon_filter),
+            db.select(Synonym.taxon_id, Synonym.name).filter(synonym_filter),
+        ).subquery()
+        score = case(
+            (matches.c.name == query, 0),
+            (matches.c.name.startswith(query, autoescape=True), 1),
+            (matches.c.name.contains(f" {query}", autoescape=True), 2),
+            else_=3,
+        )
+        best_matches = (
+            db.select(matches.c.taxon_id, func.min(score).label("score"))
+            .group_by(matches.c.taxon_id)
+            .subquery()
+        )
+        select = select.join(best_matches, best_matches.c.taxon_id == Taxon.id)
+        select = select.order_by(best_matches.c.score, func.length(Taxon.name))
+
+    # ranks are all lowercase in the database too
+    if ranks:
+        select = select.filter(Taxon.rank.in_([rank.lower() for rank in ranks]))
+    if ignore_ranks:
+        select = select.filter(
+            Taxon.rank.not_in([rank.lower() for rank in ignore_ranks])
+        )
+
+    return select.order_by(Taxon.name)
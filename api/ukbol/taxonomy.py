@@ -0,0 +1,259 @@
+import time
+from array import array
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+from typing import Callable, Self
+
+from flask import abort, current_app
+
+from ukbol.extensions import db
+from ukbol.model import DataSourceStatus, Synonym, Taxon
+
+
+class TaxonomySnapshot:
+    """
+    A compact, in-memory copy of the taxonomy which can be used to serve the taxonomy
+    navigation endpoints without querying the database. Taxa are referred to internally
+    by their index in the ids list and the tree structure is held in arrays of these
+    indexes: one holding each taxon's parent and a pair holding the children of every
+    taxon (the children of the taxon at index i are in child_indexes between
+    child_offsets[i] and child_offsets[i + 1]).
+
+    The taxa are indexed in name order so that the children of each taxon are also in
+    name order.
+    """
+
+    def __init__(
+        self,
+        version: datetime | None,
+        taxa: list[tuple[str, str, str | None, str, str | None]],
+        synonyms: list[tuple[str, str, str | None, str, str]],
+    ):
+        """
+        :param version: the updated_at value of the uksi-taxa data source status
+        :param taxa: a list of (id, name, authorship, rank, parent_id) tuples in name
+                     order
+        :param synonyms: a list of (id, name, authorship, rank, taxon_id) tuples
+        """
+        self.version = version
+        self.ids = [taxon[0] for taxon in taxa]
+        self.names = [taxon[1] for taxon in taxa]
+        self.authorships = [taxon[2] for taxon in taxa]
+        self.ranks = [taxon[3] for taxon in taxa]
+        self.index = {taxon_id: i for i, taxon_id in enumerate(self.ids)}
+
+        self.parents = array("i", [-1] * len(taxa))
+        child_counts = [0] * len(taxa)
+        for i, taxon in enumerate(taxa):
+            parent = self.index.get(taxon[4], -1)
+            self.parents[i] = parent
+            if parent != -1:
+                child_counts[parent] += 1
+
+        self.child_offsets = array("i", [0] * (len(taxa) + 1))
+        for i, child_count in enumerate(child_counts):
+            self.child_offsets[i + 1] = self.child_offsets[i] + child_count
+        self.child_indexes = array("i", [0] * len(taxa))
+        positions = array("i", self.child_offsets[:-1])
+        for i, parent in enumerate(self.parents):
+            if parent != -1:
+                self.child_indexes[positions[parent]] = i
+                positions[parent] += 1
+
+        self.roots = [i for i, parent in enumerate(self.parents) if parent == -1]
+
+        # most taxa don't have synonyms so only store the ones that do
+        self.synonyms: dict[int, list[dict]] = {}
+        for synonym_id, name, authorship, rank, taxon_id in synonyms:
+            if taxon_id in self.index:
+                self.synonyms.setdefault(self.index[taxon_id], []).append(
+                    {
+                        "id": synonym_id,
+                        "name": name,
+                        "authorship": authorship,
+                        "rank": rank,
+                        "taxon": taxon_id,
+                    }
+                )
+
+    @classmethod
+    def load(cls, version: datetime | None) -> Self:
+        """
+        Creates a new snapshot from the taxonomy in the database.
+
+        :param version: the updated_at value of the uksi-taxa data source status
+        :return: a new TaxonomySnapshot
+        """
+        taxa = db.session.execute(
+            db.select(
+                Taxon.id, Taxon.name, Taxon.authorship, Taxon.rank, Taxon.parent_id
+            ).order_by(Taxon.name, Taxon.id)
+        )
+        synonyms = db.session.execute(
+            db.select(
+                Synonym.id,
+                Synonym.name,
+                Synonym.authorship,
+                Synonym.rank,
+                Synonym.taxon_id,
+            ).order_by(Synonym.id)
+        )
+        return cls(version, list(taxa.tuples()), list(synonyms.tuples()))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, taxon_id: str) -> bool:
+        return taxon_id in self.index
+
+    def _get_index(self, taxon_id: str) -> int:
+        """
+        Returns the index of the taxon with the given ID. If the taxon doesn't exist, a
+        404 is raised.
+
+        :param taxon_id: the taxon ID
+        :return: the index of the taxon
+        """
+        index = self.index.get(taxon_id)
+        if index is None:
+            abort(404)
+        return index
+
+    def _get_children(self, index: int) -> array:
+        """
+        Returns the indexes of the children of the taxon at the given index.
+
+        :param index: the taxon's index
+        :return: an array of indexes
+        """
+        return self.child_indexes[
+            self.child_offsets[index] : self.child_offsets[index + 1]
+        ]
+
+    def dump(self, index: int) -> dict:
+        """
+        Returns the taxon at the given index as a dict in the same form as TaxonSchema
+        creates.
+
+        :param index: the taxon's index
+        :return: a dict
+        """
+        parent = self.parents[index]
+        return {
+            "id": self.ids[index],
+            "name": self.names[index],
+            "authorship": self.authorships[index],
+            "rank": self.ranks[index],
+            "parent": self.ids[parent] if parent != -1 else None,
+            "children": [self.ids[child] for child in self._get_children(index)],
+            "synonyms": self.synonyms.get(index, []),
+        }
+
+    def get_roots(self) -> list[dict]:
+        """
+        :return: the dumped taxa at the root of the taxonomy, in name order
+        """
+        return [self.dump(index) for index in self.roots]
+
+    def get_ranks(self) -> list[str]:
+        """
+        :return: the distinct ranks in the taxonomy
+        """
+        return sorted(set(self.ranks))
+
+    def get_children(self, taxon_id: str) -> list[dict]:
+        """
+        :param taxon_id: the taxon ID
+        :return: the dumped children of the given taxon, in name order
+        """
+        return [
+            self.dump(child) for child in self._get_children(self._get_index(taxon_id))
+        ]
+
+    def get_parents(self, taxon_id: str) -> list[str]:
+        """
+        :param taxon_id: the taxon ID
+        :return: the IDs of the given taxon's parents, in order up the tree
+        """
+        parents = []
+        parent = self.parents[self._get_index(taxon_id)]
+        while parent != -1:
+            parents.append(self.ids[parent])
+            parent = self.parents[parent]
+        return parents
+
+
+# the current snapshot, the time we last checked it was up to date, and a lock to make
+# sure only one thread (re)loads it at a time
+_snapshot: TaxonomySnapshot | None = None
+_last_checked: float | None = None
+_lock = Lock()
+
+
+def get_taxonomy_snapshot() -> TaxonomySnapshot | None:
+    """
+    Returns the taxonomy snapshot, if it is enabled via the TAXONOMY_CACHE config
+    option. The snapshot is loaded on first use and then reloaded whenever the
+    updated_at value of the uksi-taxa data source status changes. The status is checked
+    at most once every TAXONOMY_CACHE_CHECK_INTERVAL seconds (default: 60) so that most
+    requests don't hit the database at all.
+
+    :return: the TaxonomySnapshot or None if the snapshot isn't enabled
+    """
+    global _snapshot, _last_checked
+
+    if not current_app.config.get("TAXONOMY_CACHE", False):
+        return None
+
+    check_interval = current_app.config.get("TAXONOMY_CACHE_CHECK_INTERVAL", 60)
+    now = time.monotonic()
+    if (
+        _snapshot is not None
+        and _last_checked is not None
+        and now - _last_checked < check_interval
+    ):
+        return _snapshot
+
+    with _lock:
+        status = DataSourceStatus.get("uksi-taxa")
+        version = status.updated_at if status is not None else None
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = TaxonomySnapshot.load(version)
+        _last_checked = now
+        return _snapshot
+
+
+def clear_taxonomy_snapshot():
+    """
+    Removes the current taxonomy snapshot, forcing it to be reloaded next time it is
+    used.
+    """
+    global _snapshot, _last_checked
+
+    with _lock:
+        _snapshot = None
+        _last_checked = None
+
+
+def taxonomy_snapshot(snapshot_func: Callable):
+    """
+    Decorator which serves the wrapped endpoint from the taxonomy snapshot, if it is
+    enabled, by calling the given snapshot_func with the snapshot and the endpoint's
+    kwargs. If the snapshot isn't enabled, the wrapped endpoint is called as normal.
+
+    :param snapshot_func: a function which takes the snapshot and the kwargs
+    :return: a decorator
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            snapshot = get_taxonomy_snapshot()
+            if snapshot is None:
+                return func(*args, **kwargs)
+            return snapshot_func(snapshot, **kwargs)
+
+        return wrapper
+
+    return decorator
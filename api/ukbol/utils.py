@@ -1,4 +1,9 @@
+import base64
+import json
+from contextlib import contextmanager
 from datetime import datetime
+from time import perf_counter
+from typing import Iterator
 
 
 def log(message: str):
@@ -20,3 +25,93 @@ def clamp(value: int, minimum: int, maximum: int) -> int:
     :return: the clamped value
     """
     return max(min(value, maximum), minimum)
+
+
+def parse_bool(value: str) -> bool:
+    """
+    Parses the given string value as a boolean. Values such as "true", "1" and "yes"
+    are treated as True (case-insensitively), everything else is False. This is useful
+    as the type parameter when retrieving query parameters from the request.
+
+    :param value: the string value
+    :return: True or False
+    """
+    return value.strip().lower() in {"true", "1", "yes", "on"}
+
+
+def parse_list(value: str) -> list[str]:
+    """
+    Parses the given comma-separated string value into a list of values. Whitespace
+    around each value is removed and empty values are ignored. This is useful as the
+    type parameter when retrieving query parameters from the request.
+
+    :param value: the comma-separated string value
+    :return: a list of strings
+    """
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def encode_cursor(values: list) -> str:
+    """
+    Encodes the given list of JSON serialisable values as an opaque, URL safe cursor
+    token for use in keyset pagination.
+
+    :param values: the values to encode
+    :return: the cursor token
+    """
+    data = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str) -> list:
+    """
+    Decodes the given cursor token created by encode_cursor back into the list of
+    values it holds.
+
+    :param token: the cursor token
+    :return: the list of values
+    :raises ValueError: if the token isn't a valid cursor
+    """
+    try:
+        # add back the padding removed when encoding
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(data)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+    if not isinstance(values, list):
+        raise ValueError(f"Invalid cursor: {token}")
+    return values
+
+
+class PhaseTimer:
+    """
+    Times the phases of a long-running process, such as a data rebuild, so that they
+    can be reported on.
+    """
+
+    def __init__(self):
+        # phase name -> seconds taken
+        self.timings: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Context manager which times the code run within it as the named phase. The time
+        taken is logged when the phase completes.
+
+        :param name: the name of the phase
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = perf_counter() - start
+            log(f"{name} took {self.timings[name]:.2f} seconds")
+
+    def report(self):
+        """
+        Logs the time taken by each phase and the total time taken.
+        """
+        for name, seconds in self.timings.items():
+            log(f"{name}: {seconds:.2f} seconds")
+        log(f"Total: {sum(self.timings.values()):.2f} seconds")